@@ -0,0 +1,961 @@
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import zlib
+from collections import defaultdict
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Sized,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+from bitarray import bitarray
+from blocklib.candidate_blocks_generator import CandidateBlockingResult
+from blocklib.encoding import flip_bloom_filter
+from blocklib.pprlindex import ReversedIndexResult
+from blocklib.pprllambdafold import PPRLIndexLambdaFold
+from blocklib.pprlpsig import PPRLIndexPSignature
+from blocklib.signature_generator import generate_signatures
+from blocklib.stats import reversed_index_per_strategy_stats, reversed_index_stats
+from blocklib.utils import check_header
+from blocklib.validation import validate_blocking_schema
+from clkhash.serialization import deserialize_bitarray
+
+from .serialization import ClkArray
+
+log = logging.getLogger("anonlink")
+
+DEFAULT_BLOCKING_CHUNK_SIZE = 10000
+
+# BINARY BLOCK FILE
+#   A numpy .npz archive with the arrays
+#     block_keys  the distinct block keys as utf-8 byte strings,
+#     offsets     int64, the blocks of record i are block_ids[offsets[i]:offsets[i + 1]],
+#     block_ids   indices into block_keys, in the order of the JSON output,
+#     meta        the JSON metadata of the blocking as a 0-d string array.
+# Records are identified by their number, so there is one more offset
+# than records.
+BINARY_BLOCK_ARRAYS = ("block_keys", "offsets", "block_ids", "meta")
+_NPZ_MAGIC = b"PK\x03\x04"
+
+# BLOCKING STATE FILE
+#   A magic string (4 bytes) followed by the zlib compressed JSON of the
+# blocking state. A block file whose state is in such a file has the entry
+#     "state_file": {"name": <path relative to the block file>, "sha256": <hex digest>}
+# in its metadata instead of "state", where the digest is that of the
+# whole state file.
+STATE_MAGIC = b"BKST"
+
+
+def chunked(records: Iterable[Any], chunk_size: int) -> Iterator[List[Any]]:
+    """Split an iterable of records into lists of `chunk_size` records."""
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_row_chunks(
+    input_f: Union[TextIO, Iterable[str]],
+    header: bool = True,
+    chunk_size: int = DEFAULT_BLOCKING_CHUNK_SIZE,
+) -> Tuple[Optional[List[str]], Iterator[List[Tuple[str, ...]]]]:
+    """Read the rows of a CSV file in chunks, for blocking.
+
+    Whitespace around each entry is stripped, as done by
+    :func:`anonlinkclient.utils.generate_candidate_blocks_from_csv`.
+
+    :param input_f: A file-like object of csv data.
+    :param header: Set to `False` if the CSV file does not have a header.
+    :param chunk_size: Number of rows per chunk.
+    :return: The column names, or `None` without a header, and a
+        generator of lists of rows.
+    """
+    reader = csv.reader(input_f)
+    column_names = next(reader) if header else None
+    rows = (tuple(element.strip() for element in line) for line in reader)
+    return column_names, chunked(rows, chunk_size)
+
+
+def generate_candidate_blocks_streaming(
+    chunks: Iterable[Sequence[Any]],
+    blocking_config: Dict,
+    header: Optional[List[str]] = None,
+    workers: Optional[int] = 1,
+) -> Tuple[CandidateBlockingResult, int]:
+    """Generate candidate blocks from chunks of records.
+
+    This gives the same blocks, state and statistics as
+    :func:`blocklib.generate_candidate_blocks` on all the records at once,
+    but the records are processed one chunk at a time and only the block
+    index is kept in memory.
+
+    The block keys of each chunk are computed independently, by a pool of
+    `workers` processes if there is more than one, and the indexes of
+    the chunks are merged in input order.
+
+    :param chunks: An iterable of sequences of records. Records are tuples
+        of strings, or CLKs as bitarrays or base64 strings for lambda-fold
+        blocking with `input-clks` set.
+    :param blocking_config: The blocking configuration.
+    :param header: The column names, required if the blocking features
+        are given by name.
+    :param workers: Number of worker processes. `None` uses one per core,
+        `1` blocks in the calling process.
+    :return: The candidate blocking result and the number of records.
+    """
+    blocking_model = validate_blocking_schema(blocking_config)
+    algorithm = blocking_model.type.value
+    config = blocking_model.config
+
+    blocking_features = config.blocking_features
+    feature_type = type(blocking_features[0])
+    if not all(type(x) == feature_type for x in blocking_features[1:]):
+        raise ValueError(
+            "All feature types should be the same - either feature name or "
+            "feature index"
+        )
+    if feature_type == str and not header:
+        raise ValueError("Header must not be None if blocking features are string")
+
+    chunks = iter(chunks)
+    first_chunk = next(chunks, None)
+    if first_chunk is not None:
+        chunks = itertools.chain([first_chunk], chunks)
+    feature_to_index = None
+    if header and feature_type == str and first_chunk and _is_row(first_chunk[0]):
+        check_header(header, first_chunk[0])
+        feature_to_index = {name: ind for ind, name in enumerate(header)}
+
+    if algorithm == "p-sig":
+        state = PPRLIndexPSignature(config)
+        state.set_blocking_features_index(state.blocking_features, feature_to_index)
+        indexer = _ChunkIndexer(
+            state, len(state.signature_strategies), feature_to_index=feature_to_index
+        )
+    elif algorithm == "lambda-fold":
+        state = PPRLIndexLambdaFold(config)
+        state.set_blocking_features_index(state.blocking_features, feature_to_index)
+        if state.input_clks and state.record_id_col is not None:
+            raise ValueError("A record id column is not supported when blocking CLKs")
+        table_indices = None
+        if first_chunk:
+            # the length of the filters is only known from the first one
+            bf_len = len(_lambda_fold_filter(state, first_chunk[0]))
+            rng = random.Random(state.random_state)
+            table_indices = [
+                rng.sample(range(bf_len), state.K) for _ in range(state.mylambda)
+            ]
+        indexer = _ChunkIndexer(state, state.mylambda, table_indices=table_indices)
+    else:
+        raise NotImplementedError(
+            "The algorithm {} is not supported yet".format(algorithm)
+        )
+
+    reversed_indexes = [
+        defaultdict(list) for _ in range(indexer.index_count)
+    ]  # type: List[Dict[str, List[Any]]]
+    count = 0
+    for chunk_indexes, chunk_count in _index_chunks(chunks, indexer, workers):
+        for reversed_index, chunk_index in zip(reversed_indexes, chunk_indexes):
+            for key, rec_ids in chunk_index.items():
+                reversed_index[key].extend(rec_ids)
+        count += chunk_count
+
+    if algorithm == "p-sig":
+        result = _psig_reversed_index(state, reversed_indexes, count)
+    else:
+        invert_index = {}  # type: Dict[Any, List[Any]]
+        for table in reversed_indexes:
+            invert_index.update(table)
+        result = ReversedIndexResult(invert_index, reversed_index_stats(invert_index))
+    return CandidateBlockingResult(result, state), count
+
+
+def _is_row(record) -> bool:
+    return not isinstance(record, (str, bitarray))
+
+
+def _lambda_fold_filter(state: PPRLIndexLambdaFold, record) -> Any:
+    if not state.input_clks:
+        return state.__record_to_bf__(record, state.blocking_features_index)
+    return deserialize_bitarray(record) if isinstance(record, str) else record
+
+
+class _ChunkIndexer:
+    """Computes the block keys of a chunk of records.
+
+    For P-Sig there is a reversed index per signature strategy, for
+    lambda-fold one per table. The indexes of consecutive chunks are
+    merged by concatenating the record ids of each key.
+    """
+
+    def __init__(
+        self,
+        state: Union[PPRLIndexPSignature, PPRLIndexLambdaFold],
+        index_count: int,
+        feature_to_index: Optional[Dict[str, int]] = None,
+        table_indices: Optional[List[List[int]]] = None,
+    ):
+        self.state = state
+        self.index_count = index_count
+        self.feature_to_index = feature_to_index
+        self.table_indices = table_indices
+
+    def index_chunk(
+        self, chunk: Sequence[Any], start: int
+    ) -> Tuple[List[Dict[str, List[Any]]], int]:
+        """Index a chunk whose first record is record number `start`."""
+        indexes = [
+            defaultdict(list) for _ in range(self.index_count)
+        ]  # type: List[Dict[str, List[Any]]]
+        state = self.state
+        if isinstance(state, PPRLIndexPSignature):
+            for rec_id, rec in enumerate(chunk, start):
+                if state.rec_id_col is not None:
+                    rec_id = rec[state.rec_id_col]
+                signatures = generate_signatures(
+                    state.signature_strategies,
+                    rec,
+                    state.null_sentinel,
+                    self.feature_to_index,
+                )
+                for strategy_index, signature in signatures:
+                    indexes[strategy_index][signature].append(rec_id)
+        else:
+            assert self.table_indices is not None
+            for rec_id, rec in enumerate(chunk, start):
+                if state.record_id_col is not None:
+                    rec_id = rec[state.record_id_col]
+                clk = _lambda_fold_filter(state, rec)
+                for i, indices in enumerate(self.table_indices):
+                    block_key = "".join(["1" if clk[ind] else "0" for ind in indices])
+                    indexes[i]["{}{}".format(i, block_key)].append(rec_id)
+        return indexes, len(chunk)
+
+
+_worker_indexer = None  # type: Optional[_ChunkIndexer]
+
+
+def _init_worker(indexer: _ChunkIndexer):
+    global _worker_indexer
+    _worker_indexer = indexer
+
+
+def _index_chunk_in_worker(chunk: Sequence[Any], start: int):
+    assert _worker_indexer is not None
+    return _worker_indexer.index_chunk(chunk, start)
+
+
+def _index_chunks(
+    chunks: Iterable[Sequence[Any]], indexer: _ChunkIndexer, workers: Optional[int]
+) -> Iterator[Tuple[List[Dict[str, List[Any]]], int]]:
+    """Index chunks of records, yielding the results in input order."""
+    start = 0
+    if workers == 1:
+        for chunk in chunks:
+            yield indexer.index_chunk(chunk, start)
+            start += len(chunk)
+        return
+
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(indexer,)
+    ) as executor:
+        pending = collections.deque()  # type: collections.deque
+        for chunk in chunks:
+            pending.append(executor.submit(_index_chunk_in_worker, chunk, start))
+            start += len(chunk)
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _psig_reversed_index(
+    state: PPRLIndexPSignature,
+    reversed_index_per_strategy: List[Dict[str, List[Any]]],
+    count: int,
+) -> ReversedIndexResult:
+    """Mirrors the rest of PPRLIndexPSignature.build_reversed_index."""
+    # filtering only looks at the number of records
+    reversed_index_per_strategy = [
+        state.filter_reversed_index(range(count), reversed_index)
+        for reversed_index in reversed_index_per_strategy
+    ]
+    strategy_stats = reversed_index_per_strategy_stats(
+        reversed_index_per_strategy, count
+    )
+    filtered_reversed_index = reversed_index_per_strategy[0]
+    for rev_idx in reversed_index_per_strategy[1:]:
+        filtered_reversed_index.update(rev_idx)
+    if len(filtered_reversed_index) == 0:
+        raise ValueError("P-Sig: All records are filtered out!")
+
+    entities = set()
+    for rec_ids in filtered_reversed_index.values():
+        entities.update(rec_ids)
+    coverage = len(entities) / count
+    del entities
+    if coverage < 1:
+        log.warning(
+            "The P-Sig configuration leads to incomplete coverage ({}%)".format(
+                round(coverage * 100, 2)
+            )
+        )
+
+    num_hash_func = state.blocking_config.number_of_hash_functions
+    bf_len = state.blocking_config.bloom_filter_length
+    reversed_index = {}  # type: Dict[str, List[Any]]
+    for signature, rec_ids in filtered_reversed_index.items():
+        bf_set = str(tuple(flip_bloom_filter(signature, bf_len, num_hash_func)))
+        if bf_set in reversed_index:
+            reversed_index[bf_set].extend(rec_ids)
+        else:
+            reversed_index[bf_set] = rec_ids
+
+    stats = reversed_index_stats(reversed_index)
+    stats["statistics_per_strategy"] = strategy_stats
+    stats["coverage"] = coverage
+    return ReversedIndexResult(reversed_index, stats)
+
+
+def record_blocks(blocks: Dict[Any, Sequence[Any]]) -> Iterator[Tuple[Any, List[Any]]]:
+    """Invert a block index into the blocks of every record.
+
+    Integer record ids are inverted with two flat arrays instead of a
+    dictionary of lists. The blocks of a record are in the order of
+    `blocks`.
+
+    :param blocks: A mapping from block ids to record ids.
+    :return: A generator of pairs of a record id and its block ids.
+    """
+    first_id = next(itertools.chain.from_iterable(blocks.values()), None)
+    if not isinstance(first_id, (int, np.integer)):
+        # record ids from a record id column
+        record_to_blocks = defaultdict(list)  # type: Dict[Any, List[Any]]
+        for block_id, rec_ids in blocks.items():
+            for rec_id in rec_ids:
+                record_to_blocks[rec_id].append(block_id)
+        yield from record_to_blocks.items()
+        return
+    block_keys = list(blocks)
+    csr = blocks_to_csr(blocks)
+    for rec_id in range(csr.record_count):
+        start, end = csr.offsets[rec_id], csr.offsets[rec_id + 1]
+        if start != end:
+            yield rec_id, [block_keys[b] for b in csr.block_ids[start:end]]
+
+
+def dump_blocks(
+    record_to_blocks: Iterable[Tuple[Any, List[Any]]],
+    meta: Dict[str, Any],
+    block_f: TextIO,
+):
+    """Write a block file record by record.
+
+    The output is the JSON document written by `anonlink block`, i.e.
+    `{"blocks": {record id: [block ids]}, "meta": meta}`, but the blocks
+    of each record are serialized as they are produced.
+
+    :param record_to_blocks: Pairs of a record id and its block ids.
+    :param meta: The metadata of the blocking.
+    :param block_f: A file-like object to write the JSON document to.
+    """
+    block_f.write('{\n    "blocks": {')
+    separator = "\n"
+    for rec_id, block_ids in record_to_blocks:
+        block_f.write(separator)
+        block_f.write(
+            "        {}: {}".format(json.dumps(str(rec_id)), json.dumps(block_ids))
+        )
+        separator = ",\n"
+    block_f.write('\n    },\n    "meta": ')
+    meta_json = json.dumps(meta, indent=4).replace("\n", "\n    ")
+    block_f.write(meta_json)
+    block_f.write("\n}")
+
+
+def _is_record_number(rec_id: str, record_count: int) -> bool:
+    """Whether `rec_id` is the number of one of `record_count` records."""
+    try:
+        number = int(rec_id)
+    except ValueError:
+        return False
+    return str(number) == rec_id and 0 <= number < record_count
+
+
+class CsrBlocks(NamedTuple):
+    """The blocks of every record in compressed sparse row form.
+
+    :ivar block_keys: The distinct block keys, as utf-8 byte strings.
+    :ivar offsets: The blocks of record `i` are
+        `block_ids[offsets[i]:offsets[i + 1]]`.
+    :ivar block_ids: Indices into `block_keys`.
+    """
+
+    block_keys: np.ndarray
+    offsets: np.ndarray
+    block_ids: np.ndarray
+
+    @property
+    def record_count(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_record_blocks(
+        cls, rec_to_blocks: Dict[str, Sequence[str]], record_count: int
+    ) -> "CsrBlocks":
+        """Convert the `blocks` of a JSON block file.
+
+        :param rec_to_blocks: A mapping from record numbers, as strings,
+            to block keys.
+        :param record_count: The number of records.
+        :raises ValueError: If a record is not a number below
+            `record_count`, e.g. for blocks keyed by a record id column.
+        """
+        for rec_id in rec_to_blocks:
+            if not _is_record_number(rec_id, record_count):
+                raise ValueError(
+                    "The block file has blocks for record {!r}, expected record "
+                    "numbers below {}".format(rec_id, record_count)
+                )
+        key_ids = {}  # type: Dict[bytes, int]
+        offsets = np.zeros(record_count + 1, dtype=np.int64)
+        block_ids = []  # type: List[int]
+        for rec_id in range(record_count):
+            for key in rec_to_blocks.get(str(rec_id), ()):
+                block_ids.append(key_ids.setdefault(key.encode(), len(key_ids)))
+            offsets[rec_id + 1] = len(block_ids)
+        block_keys = np.array(list(key_ids), dtype=np.bytes_)
+        return cls(block_keys, offsets, np.array(block_ids, dtype=_id_dtype(key_ids)))
+
+    def record_to_blocks(
+        self, key_ids: Optional[Dict[bytes, int]] = None
+    ) -> Dict[int, List[int]]:
+        """Map every record number to integer ids of its blocks.
+
+        :param key_ids: A dictionary from block keys to ids, extended with
+            new keys. Share it between the block files of all parties so
+            equal keys get equal ids.
+        """
+        if key_ids is None:
+            key_ids = {}
+        ids = np.fromiter(
+            (key_ids.setdefault(bytes(key), len(key_ids)) for key in self.block_keys),
+            dtype=np.int64,
+            count=len(self.block_keys),
+        )[self.block_ids].tolist()
+        offsets = self.offsets.tolist()
+        return {
+            rec_id: ids[offsets[rec_id] : offsets[rec_id + 1]]
+            for rec_id in range(self.record_count)
+        }
+
+
+def _id_dtype(block_keys: Sized) -> type:
+    return np.uint32 if len(block_keys) < 2**32 else np.int64
+
+
+def blocks_to_csr(
+    blocks: Dict[Any, Sequence[int]], record_count: Optional[int] = None
+) -> CsrBlocks:
+    """Invert a block index with integer record ids into CSR form.
+
+    :param blocks: A mapping from block keys to record numbers.
+    :param record_count: The number of records. Defaults to one more than
+        the largest record number.
+    :return: The blocks of every record, in the order of `blocks`.
+    """
+    sizes = np.fromiter((len(rec_ids) for rec_ids in blocks.values()), dtype=np.int64)
+    records = np.fromiter(
+        itertools.chain.from_iterable(blocks.values()),
+        dtype=np.int64,
+        count=int(sizes.sum()),
+    )
+    if record_count is None:
+        record_count = int(records.max()) + 1 if len(records) else 0
+    entry_blocks = np.repeat(np.arange(len(blocks), dtype=_id_dtype(blocks)), sizes)
+    order = np.argsort(records, kind="stable")
+    block_ids = entry_blocks[order]
+    del entry_blocks
+    offsets = np.zeros(record_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(records, minlength=record_count), out=offsets[1:])
+    block_keys = np.array([str(key).encode() for key in blocks], dtype=np.bytes_)
+    return CsrBlocks(block_keys, offsets, block_ids)
+
+
+def dump_blocks_binary(csr: CsrBlocks, meta: Dict[str, Any], block_f: BinaryIO):
+    """Write blocks in the binary block format.
+
+    :param csr: The blocks of every record.
+    :param meta: The metadata of the blocking.
+    :param block_f: A binary file-like object to write to.
+    """
+    np.savez_compressed(
+        block_f,
+        block_keys=csr.block_keys,
+        offsets=csr.offsets,
+        block_ids=csr.block_ids,
+        meta=np.array(json.dumps(meta)),
+    )
+
+
+def load_blocks_binary(path: str) -> Tuple[CsrBlocks, Dict[str, Any]]:
+    """Read a binary block file.
+
+    :param path: The path of the file.
+    :return: The blocks of every record and the metadata of the blocking.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        if set(archive.files) != set(BINARY_BLOCK_ARRAYS):
+            raise ValueError("Not a binary block file")
+        csr = CsrBlocks(archive["block_keys"], archive["offsets"], archive["block_ids"])
+        meta = json.loads(str(archive["meta"]))
+    return csr, meta
+
+
+def is_binary_block_file(block_f) -> bool:
+    """Check whether an opened block file is in the binary block format.
+
+    :param block_f: A file-like object or a path.
+    """
+    path = (
+        block_f
+        if isinstance(block_f, (str, os.PathLike))
+        else getattr(block_f, "name", None)
+    )
+    if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(_NPZ_MAGIC)) == _NPZ_MAGIC
+
+
+def dump_blocking_state(state: Dict[str, Any], state_f: BinaryIO) -> str:
+    """Write the blocking state to a blocking state file.
+
+    :param state: The blocking state, as in the `state` entry of the
+        metadata of a block file.
+    :param state_f: A binary file-like object to write to.
+    :return: The SHA-256 hex digest of the written file.
+    """
+    data = STATE_MAGIC + zlib.compress(
+        json.dumps(state, separators=(",", ":"), sort_keys=True).encode(), 9
+    )
+    state_f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_blocking_state(path: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """Read a blocking state file.
+
+    :param path: The path of the file.
+    :param sha256: The expected SHA-256 hex digest of the file.
+    :raises ValueError: If the file is not a blocking state file or does
+        not have the expected digest.
+    :return: The blocking state.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError(
+            "The blocking state file {} does not belong to the blocks".format(path)
+        )
+    if not data.startswith(STATE_MAGIC):
+        raise ValueError("Not a blocking state file")
+    return json.loads(zlib.decompress(data[len(STATE_MAGIC) :]))
+
+
+def read_blocking_state(meta: Dict[str, Any], block_path: str) -> Dict[str, Any]:
+    """The blocking state of a block file, embedded or in a state file.
+
+    :param meta: The metadata of the block file.
+    :param block_path: The path of the block file, which a state file is
+        relative to.
+    :raises ValueError: If the metadata has no blocking state.
+    :return: The blocking state.
+    """
+    if "state" in meta:
+        return meta["state"]
+    if "state_file" not in meta:
+        raise ValueError("The block file has no blocking state")
+    reference = meta["state_file"]
+    path = os.path.join(os.path.dirname(block_path), reference["name"])
+    return load_blocking_state(path, reference["sha256"])
+
+
+def read_blocks(
+    block_f: TextIO, record_count: Optional[int] = None
+) -> Tuple[CsrBlocks, Dict[str, Any]]:
+    """Read a JSON or binary block file.
+
+    :param block_f: A file-like object of the block file.
+    :param record_count: The number of records that were blocked. Defaults
+        to the count recorded in the metadata of the file.
+    :raises ValueError: If the file is invalid or has blocks for a
+        different number of records, or for records that are not numbered
+        below `record_count`.
+    :return: The blocks of every record and the metadata of the blocking.
+    """
+    if is_binary_block_file(block_f):
+        csr, meta = load_blocks_binary(block_f.name)
+        if record_count is not None and csr.record_count != record_count:
+            raise ValueError(
+                "The block file has blocks for {} records, expected {}".format(
+                    csr.record_count, record_count
+                )
+            )
+        return csr, meta
+    try:
+        block_json = json.load(block_f)
+        rec_to_blocks = block_json["blocks"]
+    except (ValueError, KeyError) as e:
+        raise ValueError("Invalid Blocks") from e
+    meta = block_json.get("meta", {})
+    if record_count is None:
+        try:
+            record_count = sum(meta["source"]["clk_count"])
+        except (KeyError, TypeError):
+            record_count = max(
+                (int(r) + 1 for r in rec_to_blocks if r.isdigit()), default=0
+            )
+    return CsrBlocks.from_record_blocks(rec_to_blocks, record_count), meta
+
+
+def load_blocks(block_f: TextIO, record_count: int) -> CsrBlocks:
+    """Read the blocks of a JSON or binary block file.
+
+    :param block_f: A file-like object of the block file.
+    :param record_count: The number of records that were blocked.
+    :return: The blocks of every record.
+    """
+    csr, _ = read_blocks(block_f, record_count)
+    return csr
+
+
+class BlockStats(NamedTuple):
+    """The cost of comparing the records of several parties' blocks.
+
+    :ivar record_counts: The number of records of every party.
+    :ivar unblocked_counts: The number of records of every party that
+        are in no block.
+    :ivar block_count: The number of distinct blocks of all parties.
+    :ivar comparisons: The number of record comparisons done when
+        finding similarities, as every block is compared on its own.
+    :ivar naive_comparisons: The number of comparisons without blocking.
+    :ivar reduction_ratio: The fraction of comparisons saved by blocking.
+    :ivar largest_blocks: The blocks causing the most comparisons, as
+        tuples of the block key, its size per party and its comparisons.
+    :ivar size_histogram: The number of blocks by size, as tuples of the
+        smallest and largest size of a bin and the number of blocks. The
+        bins are powers of two.
+    """
+
+    record_counts: List[int]
+    unblocked_counts: List[int]
+    block_count: int
+    comparisons: int
+    naive_comparisons: int
+    reduction_ratio: float
+    largest_blocks: List[Tuple[str, List[int], int]]
+    size_histogram: List[Tuple[int, int, int]]
+
+
+def block_sizes(parties: Sequence[CsrBlocks]) -> Tuple[np.ndarray, np.ndarray]:
+    """Count the records of every party in every block.
+
+    :param parties: The blocks of every party.
+    :return: The distinct block keys of all parties and an array with
+        the number of records of every party (rows) in every block
+        (columns).
+    """
+    keys, key_ids = _intern_block_keys(parties)
+    sizes = np.zeros((len(parties), len(keys)), dtype=np.int64)
+    for party, csr in enumerate(parties):
+        sizes[party] = np.bincount(key_ids[party][csr.block_ids], minlength=len(keys))
+    return keys, sizes
+
+
+def _intern_block_keys(
+    parties: Sequence[CsrBlocks],
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """The distinct block keys of all parties, and for every party the
+    index of each of its block keys in them."""
+    all_keys = np.concatenate(
+        [csr.block_keys for csr in parties] or [np.array([], dtype=np.bytes_)]
+    )
+    keys, inverse = np.unique(all_keys, return_inverse=True)
+    splits = np.cumsum([len(csr.block_keys) for csr in parties])[:-1]
+    return keys, np.split(inverse.ravel(), splits)
+
+
+def _pair_comparisons(sizes: np.ndarray) -> np.ndarray:
+    """The comparisons between all pairs of parties, for sizes of blocks
+    per party in the first axis."""
+    totals = sizes.sum(axis=0)
+    return (totals * totals - (sizes * sizes).sum(axis=0)) // 2
+
+
+def compute_block_stats(parties: Sequence[CsrBlocks], largest: int = 10) -> BlockStats:
+    """Compute how many comparisons the blocks of several parties cause.
+
+    Records are compared with the records of the other parties in every
+    block they have in common, so two records sharing several blocks
+    count once per shared block.
+
+    :param parties: The blocks of every party.
+    :param largest: The number of blocks to report in `largest_blocks`.
+    :return: The blocking statistics.
+    """
+    keys, sizes = block_sizes(parties)
+    totals = sizes.sum(axis=0)
+    block_comparisons = _pair_comparisons(sizes)
+    comparisons = int(block_comparisons.sum())
+
+    record_counts = [csr.record_count for csr in parties]
+    naive_comparisons = (
+        sum(record_counts) ** 2 - sum(n * n for n in record_counts)
+    ) // 2
+    reduction_ratio = 1 - comparisons / naive_comparisons if naive_comparisons else 0.0
+    unblocked_counts = [
+        int(np.count_nonzero(np.diff(csr.offsets) == 0)) for csr in parties
+    ]
+
+    largest = min(largest, len(keys))
+    top = np.argpartition(-block_comparisons, largest - 1)[:largest] if largest else []
+    top = sorted(top, key=lambda b: (-block_comparisons[b], b))
+    largest_blocks = [
+        (keys[b].decode(), sizes[:, b].tolist(), int(block_comparisons[b])) for b in top
+    ]
+
+    size_histogram = []  # type: List[Tuple[int, int, int]]
+    if len(totals):
+        exponents = np.log2(totals[totals > 0]).astype(np.int64)
+        for exponent, count in enumerate(np.bincount(exponents)):
+            if count:
+                size_histogram.append(
+                    (2**exponent, 2 ** (exponent + 1) - 1, int(count))
+                )
+
+    return BlockStats(
+        record_counts,
+        unblocked_counts,
+        len(keys),
+        comparisons,
+        naive_comparisons,
+        reduction_ratio,
+        largest_blocks,
+        size_histogram,
+    )
+
+
+class LargeBlockReport(NamedTuple):
+    """The effect of bounding the cost of large blocks.
+
+    :ivar block_count: The number of blocks above the budget.
+    :ivar cost_before: The cost of these blocks, as the number of
+        comparisons between the parties, or as the number of records when
+        capping the blocks of a single party.
+    :ivar cost_after: Their cost after splitting or subsampling.
+    :ivar expected_recall: An estimate of the fraction of the matches in
+        these blocks that are still compared. It is not a bound: splitting
+        assumes the chosen bits of a match differ independently, and
+        matches sharing another block are still found.
+    """
+
+    block_count: int
+    cost_before: int
+    cost_after: int
+    expected_recall: float
+
+
+def _block_rng(key: Any, seed: int) -> random.Random:
+    # the same key gets the same random choices for all parties
+    return random.Random("{}:{!r}".format(seed, key))
+
+
+def cap_block_sizes(
+    blocks: Dict[Any, List[Any]], max_size: int, seed: int = 0
+) -> Tuple[Dict[Any, List[Any]], LargeBlockReport]:
+    """Subsample the blocks of a single party to at most `max_size` records.
+
+    This bounds the cost of the largest blocks, e.g. of a common surname,
+    without knowing the blocks of the other parties. A match in a capped
+    block is only compared if its record is in the sample.
+
+    :param blocks: A mapping from block keys to record ids.
+    :param max_size: The largest number of records to keep in a block.
+    :param seed: Seed for choosing the records to keep.
+    :return: The capped blocks and a report of the capped blocks, with
+        costs counted in records.
+    """
+    capped = {}  # type: Dict[Any, List[Any]]
+    block_count = before = after = 0
+    for key, rec_ids in blocks.items():
+        if len(rec_ids) > max_size:
+            kept = sorted(_block_rng(key, seed).sample(range(len(rec_ids)), max_size))
+            capped[key] = [rec_ids[i] for i in kept]
+            block_count += 1
+            before += len(rec_ids)
+            after += max_size
+        else:
+            capped[key] = rec_ids
+    recall = after / before if before else 1.0
+    return capped, LargeBlockReport(block_count, before, after, recall)
+
+
+def bound_block_comparisons(
+    parties: Sequence[CsrBlocks],
+    clks: Sequence[ClkArray],
+    max_comparisons: int,
+    method: str = "split",
+    threshold: float = 0.8,
+    seed: int = 0,
+    max_split_bits: int = 16,
+) -> Tuple[List[CsrBlocks], LargeBlockReport]:
+    """Bound the comparisons caused by every block of several parties.
+
+    Blocks causing more than `max_comparisons` comparisons between the
+    parties are either
+
+    - split, with a secondary key made of CLK bits at positions chosen by
+      the block key, using as few bits as needed to bring every part
+      under the budget, or
+    - subsampled, keeping the same fraction of the records of every
+      party.
+
+    Both depend on the block key only, so all parties make the same
+    choices. The expected recall of a split block estimates the
+    probability that two CLKs with a similarity of `threshold` agree on
+    all the chosen bits, that of a subsampled block is the fraction of
+    comparisons kept.
+
+    :param parties: The blocks of every party.
+    :param clks: The CLKs of every party.
+    :param max_comparisons: The budget of comparisons per block.
+    :param method: `"split"` or `"sample"`.
+    :param threshold: The similarity threshold of the matching.
+    :param seed: Seed for choosing bits or records.
+    :param max_split_bits: The largest number of bits used to split a block.
+    :return: The new blocks of every party and a report of the large blocks.
+    :raises ValueError: If the CLKs of the parties differ in length.
+    """
+    if method not in {"split", "sample"}:
+        raise ValueError("Unknown method {} for large blocks".format(method))
+    lengths = sorted({party_clks.bits for party_clks in clks})
+    if len(lengths) > 1:
+        raise ValueError(
+            "The CLKs of all parties must have the same length, got {} bits".format(
+                " and ".join(map(str, lengths))
+            )
+        )
+    keys, key_ids = _intern_block_keys(parties)
+    sizes = np.zeros((len(parties), len(keys)), dtype=np.int64)
+    entry_keys = []  # the global key of every entry of every party
+    for party, csr in enumerate(parties):
+        entry_keys.append(key_ids[party][csr.block_ids])
+        sizes[party] = np.bincount(entry_keys[party], minlength=len(keys))
+    block_comparisons = _pair_comparisons(sizes)
+    large = np.flatnonzero(block_comparisons > max_comparisons)
+
+    entry_records = [
+        np.repeat(np.arange(csr.record_count), np.diff(csr.offsets)) for csr in parties
+    ]
+    orders = [np.argsort(keys_, kind="stable") for keys_ in entry_keys]
+    new_keys = [list(csr.block_keys) for csr in parties]
+    new_block_ids = [csr.block_ids.astype(np.int64) for csr in parties]
+    keep = [np.ones(len(csr.block_ids), dtype=bool) for csr in parties]
+
+    if method == "split" and len(large):
+        popcounts = [party_clks.popcounts() for party_clks in clks]
+    before = int(block_comparisons[large].sum())
+    after = 0
+    kept_matches = 0.0
+    for block in large:
+        key = bytes(keys[block])
+        rng = _block_rng(key, seed)
+        entries = []
+        for party in range(len(parties)):
+            order, party_keys = orders[party], entry_keys[party]
+            start, end = np.searchsorted(party_keys[order], [block, block + 1])
+            entries.append(order[start:end])
+
+        if method == "split":
+            records = [entry_records[p][entries[p]] for p in range(len(parties))]
+            bits = clks[0].bits if len(clks) else 0
+            positions = rng.sample(range(bits), min(max_split_bits, bits))
+            codes = [np.zeros(len(r), dtype=np.int64) for r in records]
+            split_bits = 0
+            cost = block_comparisons[block : block + 1]
+            for split_bits, position in enumerate(positions, 1):
+                for p, r in enumerate(records):
+                    byte = clks[p].array[r, position // 8]
+                    codes[p] = (codes[p] << 1) | ((byte >> (7 - position % 8)) & 1)
+                sub_sizes = np.stack(
+                    [np.bincount(c, minlength=2**split_bits) for c in codes]
+                )
+                cost = _pair_comparisons(sub_sizes)
+                if cost.max() <= max_comparisons:
+                    break
+            after += int(cost.sum())
+            if split_bits:
+                for p, code in enumerate(codes):
+                    sub_keys = {}  # type: Dict[int, int]
+                    for entry, c in zip(entries[p], code.tolist()):
+                        if c not in sub_keys:
+                            sub_keys[c] = len(new_keys[p])
+                            sub_key = "{:0{}b}".format(c, split_bits).encode()
+                            new_keys[p].append(key + b"/" + sub_key)
+                        new_block_ids[p][entry] = sub_keys[c]
+                block_popcounts = np.concatenate(
+                    [popcounts[p][r] for p, r in enumerate(records)]
+                )
+                # the fraction of the bits in which two CLKs with a
+                # similarity of `threshold` differ
+                differing = 2 * block_popcounts.mean() * (1 - threshold) / bits
+                recall = max(0.0, 1 - differing) ** split_bits
+            else:
+                recall = 1.0
+        else:
+            fraction = (max_comparisons / block_comparisons[block]) ** 0.5
+            kept_sizes = []
+            for p, party_entries in enumerate(entries):
+                size = len(party_entries)
+                kept = max(1, int(fraction * size)) if size else 0
+                dropped = rng.sample(range(size), size - kept)
+                keep[p][party_entries[dropped]] = False
+                kept_sizes.append(kept)
+            cost = int(_pair_comparisons(np.array(kept_sizes)[:, None])[0])
+            after += cost
+            recall = cost / block_comparisons[block]
+        kept_matches += recall * block_comparisons[block]
+
+    bounded = []
+    for p, csr in enumerate(parties):
+        block_keys = np.array(new_keys[p], dtype=np.bytes_)
+        block_ids = new_block_ids[p][keep[p]].astype(_id_dtype(block_keys))
+        offsets = np.zeros(csr.record_count + 1, dtype=np.int64)
+        counts = np.bincount(entry_records[p][keep[p]], minlength=csr.record_count)
+        np.cumsum(counts, out=offsets[1:])
+        bounded.append(CsrBlocks(block_keys, offsets, block_ids))
+    recall = kept_matches / before if before else 1.0
+    return bounded, LargeBlockReport(len(large), before, after, recall)
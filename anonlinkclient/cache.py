@@ -0,0 +1,202 @@
+import hashlib
+import hmac
+import json
+import re
+import sqlite3
+import time
+from typing import AnyStr, Dict, Iterable, Sequence, Tuple
+
+from bitarray import bitarray
+from clkhash.schema import Schema
+
+DEFAULT_MAX_ENTRIES = 2**22
+
+# Number of digests looked up per query, well below SQLite's limit on the
+# number of host parameters.
+_QUERY_BATCH = 500
+
+_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS clks (
+    context BLOB NOT NULL,
+    row BLOB NOT NULL,
+    clk BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (context, row)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS clks_last_used ON clks (last_used);
+"""
+
+
+def describe_settings(value):
+    """A JSON compatible description of a schema object, for fingerprinting."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, bytes):
+        return {"bytes": value.hex()}
+    if isinstance(value, re.Pattern):
+        return {"pattern": value.pattern, "flags": value.flags}
+    if isinstance(value, (list, tuple)):
+        return [describe_settings(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {"set": sorted(repr(v) for v in value)}
+    if isinstance(value, dict):
+        return {str(k): describe_settings(v) for k, v in value.items()}
+    if not hasattr(value, "__dict__"):
+        return {"type": type(value).__qualname__, "repr": repr(value)}
+    return {
+        "type": type(value).__qualname__,
+        "attributes": describe_settings(vars(value)),
+    }
+
+
+def schema_fingerprint(schema: Schema) -> bytes:
+    """Digest of every setting of a schema that could affect the CLKs.
+
+    :param schema: A clkhash schema.
+    :return: The SHA-256 digest of a canonical description of the schema.
+    """
+    description = json.dumps(describe_settings(schema), sort_keys=True)
+    return hashlib.sha256(description.encode("utf-8")).digest()
+
+
+def secret_fingerprint(secret: AnyStr) -> bytes:
+    """One-way fingerprint identifying a secret without revealing it.
+
+    :param secret: The secret used to encode the data.
+    :return: An HMAC-SHA256 of a fixed message keyed with the secret.
+    """
+    key = secret.encode("utf-8") if isinstance(secret, str) else secret
+    return hmac.new(key, b"anonlink-client clk cache", hashlib.sha256).digest()
+
+
+class ClkCache:
+    """On-disk cache of CLKs keyed by the content of the encoded rows.
+
+    Re-encoding a dataset in which most rows have not changed only needs
+    to hash the new and modified rows. Every cached CLK is stored under
+
+    - the fingerprint of the schema and of the secret, so CLKs are never
+      reused with different hashing settings, and
+    - a digest of the row content.
+
+    Neither the secret nor the PII is stored. The row digest is an HMAC
+    keyed with the secret, so even low entropy values cannot be recovered
+    from the cache by guessing them without knowing the secret.
+
+    The cache holds at most `max_entries` CLKs across all schemas and
+    secrets. The least recently used ones are evicted when the cache is
+    closed.
+
+    :param path: Path of the SQLite database holding the cache. It is
+        created if it doesn't exist.
+    :param schema: Schema specifying the hashing settings.
+    :param secret: The secret used to encode the data.
+    :param max_entries: The maximal number of CLKs kept in the cache.
+    :ivar hits: The number of rows whose CLK was found in the cache.
+    :ivar misses: The number of rows that were not in the cache.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        schema: Schema,
+        secret: AnyStr,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        if max_entries < 0:
+            raise ValueError(
+                "max_entries must not be negative but is {}.".format(max_entries)
+            )
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._bits = schema.l
+        self._schema_fingerprint = schema_fingerprint(schema)
+        self._context = hashlib.sha256(
+            self._schema_fingerprint + secret_fingerprint(secret)
+        ).digest()
+        self._key = secret.encode("utf-8") if isinstance(secret, str) else secret
+        self._now = time.time()
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(_SCHEMA_SQL)
+
+    def __enter__(self) -> "ClkCache":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def row_digest(self, row: Sequence[str]) -> bytes:
+        """Digest of the content of a row.
+
+        :param row: The entries of a row, as passed to the hashing.
+        :return: An HMAC-SHA256 of the row keyed with the secret.
+        """
+        content = json.dumps(list(row), ensure_ascii=False).encode("utf-8")
+        return hmac.new(
+            self._key, self._schema_fingerprint + content, hashlib.sha256
+        ).digest()
+
+    def get_many(self, digests: Sequence[bytes]) -> Dict[bytes, bitarray]:
+        """Look up the CLKs of rows.
+
+        :param digests: Row digests as returned by :meth:`row_digest`.
+        :return: A mapping from the digests found in the cache to their CLK.
+        """
+        found = {}
+        with self._connection:
+            for start in range(0, len(digests), _QUERY_BATCH):
+                batch = list(set(digests[start : start + _QUERY_BATCH]))
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT row, clk FROM clks WHERE context = ? AND row IN ({})".format(
+                        placeholders
+                    ),
+                    [self._context] + batch,
+                ).fetchall()
+                for row, clk_bytes in rows:
+                    clk = bitarray(endian="big")
+                    clk.frombytes(clk_bytes)
+                    found[row] = clk[: self._bits]
+                self._connection.executemany(
+                    "UPDATE clks SET last_used = ? WHERE context = ? AND row = ?",
+                    [(self._now, self._context, row) for row, _ in rows],
+                )
+        hits = sum(digest in found for digest in digests)
+        self.hits += hits
+        self.misses += len(digests) - hits
+        return found
+
+    def put_many(self, items: Iterable[Tuple[bytes, bitarray]]):
+        """Store the CLKs of rows.
+
+        :param items: Pairs of a row digest and the CLK of the row.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO clks VALUES (?, ?, ?, ?)",
+                (
+                    (self._context, digest, clk.tobytes(), self._now)
+                    for digest, clk in items
+                ),
+            )
+
+    def __len__(self) -> int:
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM clks").fetchone()
+        return count
+
+    def evict(self):
+        """Remove the least recently used CLKs beyond `max_entries`."""
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM clks WHERE (context, row) IN ("
+                    "SELECT context, row FROM clks ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+
+    def close(self):
+        """Evict surplus entries and close the database."""
+        self.evict()
+        self._connection.close()
@@ -0,0 +1,505 @@
+import array
+import concurrent.futures
+import heapq
+import math
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from anonlink.similarities import dice_coefficient
+from bitarray import bitarray
+
+from .serialization import ClkArray
+
+log = logging.getLogger("anonlink")
+
+# Work units per worker process. More, smaller units keep all processes
+# busy until the end at the cost of more scheduling overhead.
+UNITS_PER_WORKER = 4
+
+# Records of the first dataset per popcount band. The records of a band
+# are only compared with the records of the second dataset whose popcount
+# can give a Dice coefficient of at least the threshold.
+POPCOUNT_BAND_SIZE = 256
+POPCOUNT_INDEX_SUFFIX = ".popcounts.npz"
+
+# A task compares the records `rows0` of dataset `i0` with the records
+# `rows1` of dataset `i1`, all of them in the same block.
+_Task = Tuple[int, int, Sequence[int], Sequence[int]]
+
+CandidatePairs = Tuple[array.array, Tuple[array.array, ...], Tuple[array.array, ...]]
+
+
+class ComparisonStats:
+    """Counts the comparisons of the records sharing a block, and how many
+    of them were skipped by the popcount bound of the Dice coefficient.
+
+    :ivar comparisons: The number of record pairs sharing a block.
+    :ivar pruned: The number of these pairs that were not compared.
+    """
+
+    def __init__(self):
+        self.comparisons = 0
+        self.pruned = 0
+
+    def add(self, comparisons: int, pruned: int):
+        self.comparisons += comparisons
+        self.pruned += pruned
+
+    @property
+    def pruning_ratio(self) -> float:
+        """The fraction of the comparisons that were skipped."""
+        return self.pruned / self.comparisons if self.comparisons else 0.0
+
+
+class ScoredUnit(NamedTuple):
+    """The outcome of comparing the records of a work unit.
+
+    :ivar candidates: The arrays of similarities, dataset indices of the
+        first and second records, and record indices of the first and
+        second records.
+    :ivar comparisons: The number of record pairs of the unit.
+    :ivar pruned: The number of these pairs skipped by the popcount bound.
+    """
+
+    candidates: Tuple[np.ndarray, ...]
+    comparisons: int
+    pruned: int
+
+
+def dataset_popcounts(clks: Sequence[bitarray]) -> np.ndarray:
+    """The popcount of every CLK of a dataset."""
+    if isinstance(clks, ClkArray):
+        return clks.popcounts().astype(np.uint32)
+    return np.fromiter((clk.count() for clk in clks), dtype=np.uint32, count=len(clks))
+
+
+def load_popcount_index(clks: Sequence[bitarray], clk_path: str) -> np.ndarray:
+    """The popcounts of the CLKs of a file, persisted next to the file.
+
+    The index is stored in the file named like the CLK file with the
+    suffix `POPCOUNT_INDEX_SUFFIX`, together with the size and the
+    modification time of the CLK file. It is reused as long as these
+    match, otherwise it is computed and written again.
+
+    :param clks: The CLKs of the file.
+    :param clk_path: The path of the CLK file.
+    :return: The popcount of every CLK.
+    """
+    index_path = clk_path + POPCOUNT_INDEX_SUFFIX
+    stat = os.stat(clk_path)
+    stamp = np.array([stat.st_size, stat.st_mtime_ns, len(clks)], dtype=np.int64)
+    try:
+        with np.load(index_path, allow_pickle=False) as index:
+            if np.array_equal(index["stamp"], stamp):
+                return index["popcounts"]
+    except (OSError, KeyError, ValueError):
+        pass
+    popcounts = dataset_popcounts(clks)
+    try:
+        with open(index_path, "wb") as f:
+            np.savez(f, popcounts=popcounts, stamp=stamp)
+    except OSError as e:
+        log.warning("Could not write the popcount index {}: {}".format(index_path, e))
+    return popcounts
+
+
+def build_block_index(
+    dataset_count: int, rec_to_blocks: Dict[int, Dict[int, Sequence[Hashable]]]
+) -> Dict[Hashable, Tuple[List[int], ...]]:
+    """Invert the records to blocks maps of all datasets.
+
+    :param dataset_count: The number of datasets.
+    :param rec_to_blocks: For every dataset, the block ids of every record.
+    :return: For every block, the records of every dataset in the block.
+    """
+    blocks = defaultdict(
+        lambda: tuple([] for _ in range(dataset_count))
+    )  # type: Dict[Hashable, Tuple[List[int], ...]]
+    for i in range(dataset_count):
+        for rec_id, block_ids in rec_to_blocks[i].items():
+            for block_id in block_ids:
+                blocks[block_id][i].append(rec_id)
+    return blocks
+
+
+def partition_blocks(
+    blocks: Sequence[Tuple[Sequence[int], ...]], unit_count: int
+) -> List[List[_Task]]:
+    """Partition the comparisons of blocks into work units of similar cost.
+
+    The cost of comparing two datasets' records of a block is the product
+    of their counts. Block pairs costing more than a unit's share are
+    sliced by the records of the first dataset, so a single huge block, or
+    no blocking at all, is still spread over all units. The tasks are then
+    assigned to units greedily, the most expensive first.
+
+    :param blocks: The records of every dataset in every block.
+    :param unit_count: The number of work units.
+    :return: The tasks of every non-empty work unit.
+    """
+    pairs = []
+    for block in blocks:
+        for i0 in range(len(block)):
+            for i1 in range(i0 + 1, len(block)):
+                cost = len(block[i0]) * len(block[i1])
+                if cost:
+                    pairs.append((cost, i0, i1, block[i0], block[i1]))
+    total = sum(pair[0] for pair in pairs)
+    share = max(1, math.ceil(total / unit_count))
+
+    tasks = []
+    for cost, i0, i1, rows0, rows1 in pairs:
+        pieces = min(len(rows0), math.ceil(cost / share))
+        step = math.ceil(len(rows0) / pieces)
+        for lo in range(0, len(rows0), step):
+            rows = rows0[lo : lo + step]
+            tasks.append((len(rows) * len(rows1), i0, i1, rows, rows1))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+
+    units = [[] for _ in range(unit_count)]  # type: List[List[_Task]]
+    loads = [(0, u) for u in range(unit_count)]
+    for cost, i0, i1, rows0, rows1 in tasks:
+        load, u = heapq.heappop(loads)
+        units[u].append((i0, i1, rows0, rows1))
+        heapq.heappush(loads, (load + cost, u))
+    return [unit for unit in units if unit]
+
+
+def popcount_bands(
+    rows0: Sequence[int],
+    rows1: Sequence[int],
+    popcounts0: np.ndarray,
+    popcounts1: np.ndarray,
+    threshold: float,
+) -> Tuple[List[int], List[int], List[Tuple[int, int, int, int]]]:
+    """Pair bands of records with the records they can match.
+
+    The Dice coefficient of two CLKs with popcounts `a` and `b` is at most
+    `2 min(a, b) / (a + b)`, so it only reaches `threshold` if `b` is
+    between `a t / (2 - t)` and `a (2 - t) / t`. The records of both
+    datasets are sorted by popcount and the first ones are cut into bands
+    of `POPCOUNT_BAND_SIZE` records. Every band is paired with the range
+    of the second dataset's records that satisfy the bound for some record
+    of the band. Consecutive bands paired with the same range are joined.
+
+    :return: The records of both datasets sorted by popcount, and the
+        ranges `(start0, stop0, start1, stop1)` of records to compare.
+    """
+    rows0, rows1 = np.asarray(rows0), np.asarray(rows1)
+    rows0 = rows0[np.argsort(popcounts0[rows0], kind="stable")]
+    rows1 = rows1[np.argsort(popcounts1[rows1], kind="stable")]
+    counts0, counts1 = popcounts0[rows0], popcounts1[rows1]
+    ratio = threshold / (2 - threshold)
+    ranges = []  # type: List[Tuple[int, int, int, int]]
+    for start in range(0, len(rows0), POPCOUNT_BAND_SIZE):
+        stop = min(start + POPCOUNT_BAND_SIZE, len(rows0))
+        first = int(np.searchsorted(counts1, counts0[start] * ratio - 1e-9, "left"))
+        last = int(np.searchsorted(counts1, counts0[stop - 1] / ratio + 1e-9, "right"))
+        if last <= first:
+            continue
+        if ranges and ranges[-1][1:] == (start, first, last):
+            ranges[-1] = (ranges[-1][0], stop, first, last)
+        else:
+            ranges.append((start, stop, first, last))
+    return rows0.tolist(), rows1.tolist(), ranges
+
+
+def _score_task(
+    datasets: Sequence[Sequence[bitarray]],
+    threshold: float,
+    task: _Task,
+    popcounts: Optional[Sequence[np.ndarray]],
+    k: Optional[int],
+    columns: Sequence[array.array],
+) -> int:
+    """Append the pairs of a task to the arrays `columns`.
+
+    With `k` only the `k` best partners of every record of the first
+    dataset are kept. The partners of a band are then passed to
+    :func:`dice_coefficient` in the order of their indices, so that ties
+    are broken like in :mod:`anonlink`.
+
+    :return: The number of pairs compared.
+    """
+    i0, i1, rows0, rows1 = task
+    if popcounts is None or threshold <= 0:
+        ranges = [(0, len(rows0), 0, len(rows1))]
+    else:
+        rows0, rows1, ranges = popcount_bands(
+            rows0, rows1, popcounts[i0], popcounts[i1], threshold
+        )
+    recs0 = [datasets[i0][r] for r in rows0]
+    recs1 = [datasets[i1][r] for r in rows1]
+    sims, dset_is0, dset_is1, rec_is0, rec_is1 = columns
+    compared = 0
+    for start0, stop0, start1, stop1 in ranges:
+        compared += (stop0 - start0) * (stop1 - start1)
+        partners = range(start1, stop1)
+        if k is not None:
+            partners = sorted(partners, key=rows1.__getitem__)
+        range_sims, (js0, js1) = dice_coefficient(
+            (recs0[start0:stop0], [recs1[j] for j in partners]), threshold, k
+        )
+        sims.extend(range_sims)
+        dset_is0.extend([i0] * len(range_sims))
+        dset_is1.extend([i1] * len(range_sims))
+        rec_is0.extend([rows0[start0 + j] for j in js0])
+        rec_is1.extend([rows1[partners[j]] for j in js1])
+    return compared
+
+
+def score_unit(
+    datasets: Sequence[Sequence[bitarray]],
+    threshold: float,
+    unit: Sequence[_Task],
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    k: Optional[int] = None,
+) -> ScoredUnit:
+    """Find the pairs of a work unit with a similarity of at least `threshold`.
+
+    :param popcounts: The popcounts of every dataset. If given, records
+        whose popcounts rule out a match are not compared, see
+        :func:`popcount_bands`.
+    :param k: If given, only the pairs among the `k` best of either of
+        their records within the unit are kept, see
+        :func:`top_k_candidates`. Every task is scored from both of its
+        datasets, keeping the `k` best partners of every record as they
+        are found, so at most `k` pairs per record of each task are held.
+    """
+    sims = array.array("d")
+    dset_is0, dset_is1 = array.array("I"), array.array("I")
+    rec_is0, rec_is1 = array.array("I"), array.array("I")
+    comparisons = compared = 0
+    for i0, i1, rows0, rows1 in unit:
+        comparisons += len(rows0) * len(rows1)
+        compared += _score_task(
+            datasets,
+            threshold,
+            (i0, i1, rows0, rows1),
+            popcounts,
+            k,
+            (sims, dset_is0, dset_is1, rec_is0, rec_is1),
+        )
+        if k is not None:
+            _score_task(
+                datasets,
+                threshold,
+                (i1, i0, rows1, rows0),
+                popcounts,
+                k,
+                (sims, dset_is1, dset_is0, rec_is1, rec_is0),
+            )
+    candidates = (np.frombuffer(sims, dtype=np.float64),) + tuple(
+        np.frombuffer(a, dtype=np.uint32)
+        for a in (dset_is0, dset_is1, rec_is0, rec_is1)
+    )
+    if k is not None:
+        candidates = top_k_candidates(_sort_candidates(candidates), k, either=True)
+    return ScoredUnit(candidates, comparisons, comparisons - compared)
+
+
+def _sort_candidates(candidates: Sequence[np.ndarray]) -> Tuple[np.ndarray, ...]:
+    """Sort candidates like :mod:`anonlink` and drop repeated pairs."""
+    sims, dset_is0, dset_is1, rec_is0, rec_is1 = candidates
+    order = np.lexsort((rec_is1, rec_is0, dset_is1, dset_is0, -sims))
+    columns = [a[order] for a in candidates]
+    keep = np.ones(len(order), dtype=bool)
+    if len(order):
+        keep[1:] = np.any([c[1:] != c[:-1] for c in columns], axis=0)
+    return tuple(c[keep] for c in columns)
+
+
+def _ranks(keys: Sequence[np.ndarray]) -> np.ndarray:
+    """The position of every candidate among those with the same keys,
+    keeping the order of the candidates."""
+    order = np.lexsort(tuple(reversed(keys)))
+    sorted_keys = [key[order] for key in keys]
+    new_group = np.ones(len(order), dtype=bool)
+    if len(order):
+        new_group[1:] = np.any([k[1:] != k[:-1] for k in sorted_keys], axis=0)
+    positions = np.arange(len(order))
+    starts = np.maximum.accumulate(np.where(new_group, positions, 0))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = positions - starts
+    return ranks
+
+
+def top_k_candidates(
+    candidates: Sequence[np.ndarray], k: int, either: bool = False
+) -> Tuple[np.ndarray, ...]:
+    """Keep the `k` best candidates of every record.
+
+    Every record ranks its partners in each other dataset by similarity,
+    ties broken by the order of :mod:`anonlink`. A pair is kept if it is
+    among the `k` best of both of its records, so as with the `k` of
+    :mod:`anonlink` every record keeps at most `k` pairs with each other
+    dataset.
+
+    With `either` a pair is kept if it is among the `k` best of either
+    of its records instead. This only bounds the total, by `k` times the
+    number of records of both datasets for every pair of datasets, but
+    never drops a pair that the default keeps, nor one that decides its
+    ranks. Filtering parts of the
+    candidates with `either` and then their union without it gives the
+    same result as filtering all of them at once.
+
+    :param candidates: The arrays of similarities, dataset indices and
+        record indices, sorted as by :func:`merge_candidates` and without
+        repeated pairs.
+    :param k: The number of partners to keep per record.
+    :param either: Keep the pairs among the best of either record.
+    :return: The kept candidates, in the same order.
+    """
+    sims, dset_is0, dset_is1, rec_is0, rec_is1 = candidates
+    best0 = _ranks((dset_is0, rec_is0, dset_is1)) < k
+    best1 = _ranks((dset_is1, rec_is1, dset_is0)) < k
+    keep = best0 | best1 if either else best0 & best1
+    return tuple(c[keep] for c in candidates)
+
+
+def to_candidate_pairs(candidates: Sequence[np.ndarray]) -> CandidatePairs:
+    """Convert arrays of candidates to the format of :mod:`anonlink`."""
+
+    def to_array(typecode: str, values: np.ndarray) -> array.array:
+        result = array.array(typecode)
+        result.frombytes(np.ascontiguousarray(values).tobytes())
+        return result
+
+    sims, dset_is0, dset_is1, rec_is0, rec_is1 = candidates
+    return (
+        to_array("d", sims),
+        (to_array("I", dset_is0), to_array("I", dset_is1)),
+        (to_array("I", rec_is0), to_array("I", rec_is1)),
+    )
+
+
+def filter_candidates(candidates: CandidatePairs, threshold: float) -> CandidatePairs:
+    """The candidate pairs with a similarity of at least `threshold`.
+
+    :param candidates: Candidate pairs in the format of :mod:`anonlink`,
+        sorted by decreasing similarity.
+    :param threshold: The similarity threshold.
+    :return: The leading candidate pairs reaching the threshold.
+    """
+    sims, dset_is, rec_is = candidates
+    count = int(np.count_nonzero(np.frombuffer(sims, dtype=np.float64) >= threshold))
+    if count == len(sims):
+        return candidates
+    return (
+        sims[:count],
+        tuple(a[:count] for a in dset_is),
+        tuple(a[:count] for a in rec_is),
+    )
+
+
+def merge_candidates(
+    results: Sequence[Tuple[np.ndarray, ...]],
+    k: Optional[int] = None,
+    either: bool = False,
+) -> CandidatePairs:
+    """Merge the candidates of all work units into the format of :mod:`anonlink`.
+
+    The candidates are sorted by decreasing similarity, then by dataset
+    and record indices, and pairs found in several blocks are kept once.
+    With `k` only the best candidates of every record are kept, see
+    :func:`top_k_candidates` for `k` and `either`.
+    """
+    if results:
+        candidates = tuple(np.concatenate(arrays) for arrays in zip(*results))
+    else:
+        candidates = (np.empty(0),) + tuple(
+            np.empty(0, dtype=np.uint32) for _ in range(4)
+        )
+    candidates = _sort_candidates(candidates)
+    if k is not None:
+        candidates = top_k_candidates(candidates, k, either)
+    return to_candidate_pairs(candidates)
+
+
+_worker_datasets = None  # type: Optional[Sequence[Sequence[bitarray]]]
+_worker_popcounts = None  # type: Optional[Sequence[np.ndarray]]
+
+
+def _init_worker(
+    datasets: Sequence[Sequence[bitarray]], popcounts: Optional[Sequence[np.ndarray]]
+):
+    global _worker_datasets, _worker_popcounts
+    _worker_datasets = datasets
+    _worker_popcounts = popcounts
+
+
+def _score_unit_in_worker(
+    threshold: float, unit: Sequence[_Task], k: Optional[int] = None
+):
+    assert _worker_datasets is not None
+    return score_unit(_worker_datasets, threshold, unit, _worker_popcounts, k)
+
+
+def find_candidate_pairs_parallel(
+    datasets: Sequence[Sequence[bitarray]],
+    threshold: float,
+    rec_to_blocks: Optional[Dict[int, Dict[int, Sequence[Hashable]]]] = None,
+    workers: Optional[int] = None,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+) -> CandidatePairs:
+    """Find the candidate pairs of several datasets with a pool of processes.
+
+    Gives the same result as
+    :func:`anonlink.candidate_generation.find_candidate_pairs` with the
+    Dice coefficient. The block index is built once, and the comparisons
+    are partitioned into work units of similar cost, see
+    :func:`partition_blocks`, which are scored in parallel. Records whose
+    popcounts rule out a match are not compared, see
+    :func:`popcount_bands`.
+
+    :param datasets: A sequence of datasets. Each dataset is a sequence
+        of Bloom filters as bitarrays.
+    :param threshold: The similarity threshold.
+    :param rec_to_blocks: For every dataset, the block ids of every
+        record. Two records are compared iff they share a block. `None`
+        compares all records.
+    :param workers: Number of processes scoring work units. `None` uses
+        one per core, `1` scores them in this process.
+    :param popcounts: The popcounts of every dataset, see
+        :func:`load_popcount_index`. Computed if not given.
+    :param stats: Counts the comparisons and the pruned ones.
+    :param k: If given, every record keeps at most `k` candidates with
+        each other dataset, see :func:`top_k_candidates`. Every work unit
+        keeps only the best candidates of either of their records, so the
+        candidates held at once stay proportional to the number of
+        records.
+    :return: The candidate pairs, in the format of :mod:`anonlink`.
+    """
+    if popcounts is None:
+        popcounts = [dataset_popcounts(dataset) for dataset in datasets]
+    if rec_to_blocks is None:
+        blocks = [tuple(list(range(len(dataset))) for dataset in datasets)]
+    else:
+        blocks = list(build_block_index(len(datasets), rec_to_blocks).values())
+    worker_count = workers or os.cpu_count() or 1
+    units = partition_blocks(blocks, worker_count * UNITS_PER_WORKER)
+
+    if worker_count == 1:
+        results = [
+            score_unit(datasets, threshold, unit, popcounts, k) for unit in units
+        ]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=worker_count,
+            initializer=_init_worker,
+            initargs=(datasets, popcounts),
+        ) as executor:
+            futures = [
+                executor.submit(_score_unit_in_worker, threshold, unit, k)
+                for unit in units
+            ]
+            results = [future.result() for future in futures]
+    if stats is not None:
+        for result in results:
+            stats.add(result.comparisons, result.pruned)
+    return merge_candidates([result.candidates for result in results], k)
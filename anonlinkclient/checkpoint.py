@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from typing import AnyStr, IO, NamedTuple, Optional
+
+from clkhash.schema import Schema
+
+from .cache import schema_fingerprint, secret_fingerprint
+
+DEFAULT_CHECKPOINT_ROWS = 100000
+
+# CHECKPOINT FILE
+#   A small JSON document next to the output, named after it with a
+# `.checkpoint` suffix. It records how many rows of the input have been
+# encoded, where the next row starts in the input file and how many bytes
+# of the output hold their CLKs. The fingerprint ties the checkpoint to
+# the input file, schema, secret and output format it was written for.
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+class Checkpoint(NamedTuple):
+    """Progress of an interrupted encoding.
+
+    :ivar rows: The number of rows encoded and written.
+    :ivar input_offset: The byte offset of the next row in the input.
+    :ivar output_offset: The byte offset in the output after the last CLK.
+    :ivar fingerprint: Digest of the settings of the encoding.
+    """
+
+    rows: int
+    input_offset: int
+    output_offset: int
+    fingerprint: str
+
+
+def checkpoint_path(output_path: str) -> str:
+    """The path of the checkpoint file of an output file."""
+    return output_path + CHECKPOINT_SUFFIX
+
+
+def encoding_fingerprint(
+    input_path: str, schema: Schema, secret: AnyStr, output_format: str
+) -> str:
+    """Fingerprint of everything a checkpoint is only valid for.
+
+    The input file is identified by its size and modification time, so
+    resuming after the input has been modified is refused. The secret is
+    only included through its one-way fingerprint.
+    """
+    stat = os.stat(input_path)
+    digest = hashlib.sha256()
+    digest.update(schema_fingerprint(schema))
+    digest.update(secret_fingerprint(secret))
+    digest.update(
+        json.dumps([stat.st_size, stat.st_mtime_ns, output_format]).encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def load_checkpoint(path: str, fingerprint: str) -> Optional[Checkpoint]:
+    """Read a checkpoint file.
+
+    :param path: The path of the checkpoint file.
+    :param fingerprint: The fingerprint of the encoding to resume.
+    :raises ValueError: If the checkpoint was written for a different
+        input, schema, secret or output format.
+    :return: The checkpoint, or `None` if there is no checkpoint file.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = Checkpoint(**json.load(f))
+    except FileNotFoundError:
+        return None
+    if checkpoint.fingerprint != fingerprint:
+        raise ValueError(
+            "Checkpoint {} was written for a different input file, schema, "
+            "secret or output format".format(path)
+        )
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Checkpoint):
+    """Atomically replace a checkpoint file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint._asdict(), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    """Callback writing a checkpoint every `every` rows.
+
+    Pass it as the `on_chunk` argument of
+    :func:`anonlinkclient.encoding.stream_clks_from_csv`. The output is
+    flushed to disk before the checkpoint referring to it is written, so
+    the checkpoint never claims more than the output holds.
+
+    :param path: The path of the checkpoint file.
+    :param output_f: The file the CLKs are written to.
+    :param fingerprint: The fingerprint of the encoding.
+    :param every: The minimal number of rows between two checkpoints.
+    :param start: The checkpoint the encoding resumes from, if any.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        output_f: IO,
+        fingerprint: str,
+        every: int = DEFAULT_CHECKPOINT_ROWS,
+        start: Optional[Checkpoint] = None,
+    ):
+        self.path = path
+        self.output_f = output_f
+        self.fingerprint = fingerprint
+        self.every = every
+        self._start = start or Checkpoint(0, 0, 0, fingerprint)
+        self._last_rows = 0
+
+    def __call__(self, rows: int, input_offset: Optional[int]):
+        if input_offset is None or rows - self._last_rows < self.every:
+            return
+        self.output_f.flush()
+        os.fsync(self.output_f.fileno())
+        save_checkpoint(
+            self.path,
+            Checkpoint(
+                self._start.rows + rows,
+                input_offset,
+                self.output_f.tell(),
+                self.fingerprint,
+            ),
+        )
+        self._last_rows = rows
@@ -1,8 +1,10 @@
+import contextlib
 import difflib
 import json
 import os
 import shutil
 import sys
+import tempfile
 from datetime import datetime, timezone
 from multiprocessing import freeze_support
 from typing import Callable, List
@@ -11,17 +13,56 @@ import clkhash
 from bashplotlib.histogram import plot_hist
 from clkhash import benchmark as bench
 from clkhash import randomnames, validate_data
-from clkhash.describe import get_encoding_popcounts
 from clkhash.schema import SchemaError, convert_to_latest_version, validate_schema_dict
-from clkhash.serialization import deserialize_bitarray, serialize_bitarray
 import anonlinkclient
-from clkhash.clk import generate_clk_from_csv
+from .blocking import (
+    DEFAULT_BLOCKING_CHUNK_SIZE,
+    bound_block_comparisons,
+    compute_block_stats,
+    read_blocks,
+)
+from .cache import DEFAULT_MAX_ENTRIES, ClkCache
+from .checkpoint import (
+    DEFAULT_CHECKPOINT_ROWS,
+    Checkpointer,
+    checkpoint_path,
+    encoding_fingerprint,
+    load_checkpoint,
+)
+from .compression import decode_text_stream, open_input, open_text_input
+from .encoding import (
+    DEFAULT_CHUNK_SIZE,
+    CacheStats,
+    CsvLines,
+    stream_clks_from_csv,
+    stream_multi_clks_from_csv,
+)
+from .candidates import ComparisonStats, load_popcount_index
+from .outofcore import dump_sorted_candidates, load_sorted_candidates, map_clks
+from .serialization import (
+    BinaryClkWriter,
+    JsonClkWriter,
+    dump_clks,
+    dump_clks_binary,
+)
+from .tuning import (
+    DEFAULT_SAMPLE_SIZE,
+    DEFAULT_TARGET_RECALL,
+    evaluate_blocking_configs,
+    expand_grid,
+    recommend,
+    sample_rows,
+)
 from .utils import (
-    deserialize_bitarray,
-    generate_candidate_blocks_from_csv,
-    combine_clks_blocks,
-    deserialize_filters,
-    solve,
+    encode_and_block_csv,
+    join_clks_blocks,
+    load_blocking_config,
+    write_candidate_blocks_from_csv,
+    load_clks,
+    find_candidates,
+    find_candidates_out_of_core,
+    solve_candidates,
+    solver_blocks,
 )
 
 # Labels for some options. If changed here, the name of the corresponding attributes MUST be changed in the methods
@@ -38,6 +79,29 @@ def log(m, color="red"):
     click.echo(click.style(m, fg=color), err=True)
 
 
+@contextlib.contextmanager
+def open_output(name: str, mode: str = "w"):
+    """
+    Open an output file, or stdout for "-".
+
+    A file is written under a temporary name next to it and only renamed
+    once the block completes, so a command failing halfway leaves no
+    partial output behind.
+    """
+    if name == "-":
+        with click.open_file(name, mode) as f:
+            yield f
+        return
+    tmp_name = "{}.{}.tmp".format(name, os.getpid())
+    try:
+        with open(tmp_name, mode) as f:
+            yield f
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    os.replace(tmp_name, name)
+
+
 def set_verbosity(ctx, param, value):
     """
     verbose_option callback
@@ -66,6 +130,19 @@ verbose_option = click.option(
     callback=set_verbosity,
 )
 
+read_ahead_option = click.option(
+    "--read-ahead",
+    default=False,
+    is_flag=True,
+    help="Read and decompress the input in a background thread",
+)
+
+encoding_option = click.option(
+    "--encoding",
+    default=None,
+    help="Text encoding of the CSV input. Defaults to the locale's encoding",
+)
+
 
 def add_options(options):
     # type: (List[Callable]) -> Callable
@@ -118,10 +195,10 @@ def cli(verbose):
 
 
 @cli.command("hash", deprecated=True, short_help="command is deprecated")
-@click.argument("pii_csv", type=click.File("r"))
+@click.argument("pii_csv", type=click.File("r", lazy=True))
 @click.argument("secret", type=str)
 @click.argument("schema", type=click.File("r", lazy=True))
-@click.argument("clk_json", type=click.File("w"))
+@click.argument("clk_json", type=click.File("w", lazy=True))
 @click.option(
     "--no-header", default=False, is_flag=True, help="Don't skip the first row"
 )
@@ -146,10 +223,10 @@ def hash(pii_csv, secret, schema, clk_json, no_header, check_header, validate, v
 
 
 @cli.command("encode", short_help="generate hashes from local PII data")
-@click.argument("pii_csv", type=click.File("r"))
+@click.argument("pii_csv", type=click.File("r", lazy=True))
 @click.argument("secret", type=str)
 @click.argument("schema", type=click.File("r", lazy=True))
-@click.argument("clk_json", type=click.File("w"))
+@click.argument("clk_json", type=click.File("w", lazy=True))
 @click.option(
     "--no-header", default=False, is_flag=True, help="Don't skip the first row"
 )
@@ -165,9 +242,93 @@ def hash(pii_csv, secret, schema, clk_json, no_header, check_header, validate, v
     type=bool,
     help="If true, validate the entries against the schema",
 )
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of processes used for hashing. Defaults to the number of cores",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHUNK_SIZE,
+    show_default=True,
+    help="Number of CSV rows read and hashed at a time",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["json", "binary"]),
+    default="json",
+    show_default=True,
+    help="Write the CLKs as JSON or in the compact binary CLK format",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Number of field values whose Bloom filters are cached per worker. "
+    "0 disables the cache",
+)
+@click.option(
+    "--clk-cache",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Database of previously encoded rows. Only rows that are not in it "
+    "are hashed",
+)
+@click.option(
+    "--clk-cache-size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="Maximal number of CLKs kept in the --clk-cache database",
+)
+@click.option(
+    "--checkpoint-every",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Record a checkpoint after this many rows, to continue with "
+    "--resume if interrupted. 0 disables checkpoints",
+)
+@click.option(
+    "--resume",
+    default=False,
+    is_flag=True,
+    help="Continue an interrupted encoding from its last checkpoint",
+)
+@click.option(
+    "--also-encode",
+    type=(str, click.File("r", lazy=True), click.Path(dir_okay=False, writable=True)),
+    multiple=True,
+    metavar="SECRET SCHEMA CLK_JSON",
+    help="Also encode the data with another secret and schema into another "
+    "output, reading the CSV file only once. Can be repeated",
+)
+@read_ahead_option
+@encoding_option
 @verbose_option
 def encode(
-    pii_csv, secret, schema, clk_json, no_header, check_header, validate, verbose
+    pii_csv,
+    secret,
+    schema,
+    clk_json,
+    no_header,
+    check_header,
+    validate,
+    workers,
+    chunk_size,
+    output_format,
+    cache_size,
+    clk_cache,
+    clk_cache_size,
+    checkpoint_every,
+    resume,
+    also_encode,
+    read_ahead,
+    encoding,
+    verbose,
 ):
     """Process data to create CLKs
 
@@ -180,6 +341,44 @@ def encode(
     $anonlink encode pii.csv horse_stable pii-schema.json clks.json
 
     Use "-" for CLK_JSON to write JSON to stdout.
+
+    The CSV file is read in chunks of rows which are hashed by a pool of
+    worker processes. Use --workers 1 to hash in the current process.
+    CLKs are written as soon as they are produced, so memory use does not
+    grow with the size of the input.
+
+    With --output-format binary the CLKs are written as packed bits after a
+    small header instead of base64 strings in JSON. The describe, block and
+    find-similarity commands accept both formats.
+
+    With --cache-size N the Bloom filter of every field value is kept in a
+    cache of N entries per worker, so repeated values such as common names
+    are only hashed once. The CLKs are the same with or without the cache.
+
+    With --clk-cache FILE the CLKs are also stored in an on-disk cache keyed
+    by the schema, the secret and the content of each row. Encoding the same
+    data again only hashes the rows that changed. The cache contains
+    neither the secret nor the PII.
+
+    PII_CSV may be compressed with gzip, bzip2 or xz; it is decompressed on
+    the fly.
+
+    With --also-encode the data is encoded with several secrets and schemas
+    in a single pass over the CSV file, for example for several linkage
+    partners:
+
+    $anonlink encode pii.csv horse schema.json clks-a.json --also-encode zebra schema-b.json clks-b.json
+
+    Columns are tokenized once for all the schemas whose features are
+    formatted and compared the same way. Checkpoints and caches are not
+    supported in this mode.
+
+    With --checkpoint-every N, while encoding a CSV file into a CLK file, a
+    checkpoint recording the progress is written next to the output every
+    N rows. If the encoding is interrupted, run the same command again with
+    --resume to continue from the last checkpoint. The checkpoint is
+    removed once the encoding completes. --resume without
+    --checkpoint-every checkpoints every 100000 rows.
     """
     try:
         schema_object = clkhash.schema.from_json_file(schema_file=schema)
@@ -192,37 +391,244 @@ def encode(
     if no_header:
         header = False
 
+    if also_encode:
+        if resume or clk_cache is not None or cache_size:
+            log(
+                "--also-encode can't be combined with --resume, --clk-cache or --cache-size"
+            )
+            raise SystemExit(-1)
+        encodings = [(secret, schema_object, clk_json.name)]
+        for other_secret, other_schema, other_output in also_encode:
+            try:
+                other_schema_object = clkhash.schema.from_json_file(
+                    schema_file=other_schema
+                )
+            except SchemaError as e:
+                log(str(e))
+                raise SystemExit(-1)
+            encodings.append((other_secret, other_schema_object, other_output))
+        _encode_several(
+            pii_csv,
+            encodings,
+            validate=validate,
+            header=header,
+            workers=workers,
+            chunk_size=chunk_size,
+            output_format=output_format,
+            read_ahead=read_ahead,
+            encoding=encoding,
+            verbose=verbose,
+        )
+        return
+
+    if resume and not checkpoint_every:
+        checkpoint_every = DEFAULT_CHECKPOINT_ROWS
+    input_is_file = os.path.isfile(pii_csv.name)
+    checkpointing = checkpoint_every > 0 and input_is_file and clk_json.name != "-"
+    resume_from = None
+    if checkpointing:
+        fingerprint = encoding_fingerprint(
+            pii_csv.name, schema_object, secret, output_format
+        )
+        checkpoint_file = checkpoint_path(clk_json.name)
+        if resume:
+            try:
+                resume_from = load_checkpoint(checkpoint_file, fingerprint)
+            except ValueError as e:
+                log(str(e))
+                raise SystemExit(-1)
+            if resume_from is None:
+                log("No checkpoint found, encoding from the start")
+            else:
+                log("Resuming after row {}".format(resume_from.rows))
+                header = False
+    elif resume:
+        log("Resuming requires checkpoints of a CSV file encoded into a file")
+        raise SystemExit(-1)
+
+    cache_stats = CacheStats([f.identifier for f in schema_object.fields])
+    row_cache = None
+    if clk_cache is not None:
+        row_cache = ClkCache(clk_cache, schema_object, secret, clk_cache_size)
     try:
-        clk_data = [
-            serialize_bitarray(bf)
-            for bf in generate_clk_from_csv(
-                pii_csv,
+        with contextlib.ExitStack() as stack:
+            mode = "b" if output_format == "binary" else ""
+            on_chunk = None
+            if input_is_file:
+                offset = resume_from.input_offset if resume_from is not None else 0
+                pii_lines = CsvLines(
+                    stack.enter_context(
+                        open_input(pii_csv.name, offset, threaded=read_ahead)
+                    ),
+                    encoding,
+                )
+            else:
+                pii_lines = decode_text_stream(pii_csv, encoding)
+            if resume_from is not None:
+                clk_f = stack.enter_context(open(clk_json.name, "r+" + mode))
+                clk_f.truncate(resume_from.output_offset)
+                clk_f.seek(resume_from.output_offset)
+            elif checkpointing:
+                clk_f = stack.enter_context(click.open_file(clk_json.name, "w" + mode))
+            else:
+                clk_f = stack.enter_context(open_output(clk_json.name, "w" + mode))
+            if checkpointing:
+                on_chunk = Checkpointer(
+                    checkpoint_file, clk_f, fingerprint, checkpoint_every, resume_from
+                )
+            resume_count = resume_from.rows if resume_from is not None else 0
+
+            clks = stream_clks_from_csv(
+                pii_lines,
                 secret,
                 schema_object,
                 validate=validate,
                 header=header,
                 progress_bar=verbose,
+                workers=workers,
+                chunk_size=chunk_size,
+                cache_size=cache_size,
+                cache_stats=cache_stats,
+                clk_cache=row_cache,
+                on_chunk=on_chunk,
             )
-        ]
+            if output_format == "binary":
+                dump_clks_binary(clks, clk_f, resume_count)
+            else:
+                dump_clks(clks, clk_f, resume_count)
+        if checkpointing and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
     except (validate_data.EntryError, validate_data.FormatError) as e:
         (msg,) = e.args
         log(msg)
         log("Encoding failed.")
     else:
-        json.dump({"clks": clk_data}, clk_json)
         if hasattr(clk_json, "name"):
             log("CLK data written to {}".format(clk_json.name))
+        if verbose and cache_size:
+            log(cache_stats.summary())
+        if verbose and row_cache is not None:
+            log(
+                "Reused {} of {} CLKs from {}".format(
+                    row_cache.hits, row_cache.hits + row_cache.misses, clk_cache
+                )
+            )
+    finally:
+        if row_cache is not None:
+            row_cache.close()
+
+
+def _encode_several(
+    pii_csv,
+    encodings,
+    validate,
+    header,
+    workers,
+    chunk_size,
+    output_format,
+    read_ahead,
+    encoding,
+    verbose,
+):
+    """Encode a CSV file with several (secret, schema, output path) triples."""
+    try:
+        with contextlib.ExitStack() as stack:
+            if os.path.isfile(pii_csv.name):
+                pii_lines = CsvLines(
+                    stack.enter_context(open_input(pii_csv.name, threaded=read_ahead)),
+                    encoding,
+                )
+            else:
+                pii_lines = decode_text_stream(pii_csv, encoding)
+            writers = []
+            for _, _, output in encodings:
+                if output_format == "binary":
+                    clk_f = stack.enter_context(open_output(output, "wb"))
+                    writers.append(BinaryClkWriter(clk_f))
+                else:
+                    clk_f = stack.enter_context(open_output(output, "w"))
+                    writers.append(JsonClkWriter(clk_f))
+
+            rows = stream_multi_clks_from_csv(
+                pii_lines,
+                [(secret, schema) for secret, schema, _ in encodings],
+                validate=validate,
+                header=header,
+                progress_bar=verbose,
+                workers=workers,
+                chunk_size=chunk_size,
+            )
+            for clks in rows:
+                for writer, clk in zip(writers, clks):
+                    writer.write(clk)
+            for writer in writers:
+                writer.close()
+    except (validate_data.EntryError, validate_data.FormatError) as e:
+        (msg,) = e.args
+        log(msg)
+        log("Encoding failed.")
+    else:
+        for _, _, output in encodings:
+            log("CLK data written to {}".format(output))
 
 
 @cli.command("block", short_help="generate candidate blocks from local PII data")
-@click.argument("pii_csv", type=click.File("r"))
+@click.argument("pii_csv", type=click.File("r", lazy=True))
 @click.argument("schema", type=click.File("r", lazy=True))
-@click.argument("block_json", type=click.File("w"))
+@click.argument("block_json", type=click.File("w", lazy=True))
 @click.option(
     "--no-header", default=False, is_flag=True, help="Don't skip the first row"
 )
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BLOCKING_CHUNK_SIZE,
+    show_default=True,
+    help="Number of CSV rows read and blocked at a time",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of processes computing block keys",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["json", "binary"]),
+    default="json",
+    show_default=True,
+    help="Write the blocks as JSON or in the compact binary block format",
+)
+@click.option(
+    "--max-block-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Subsample blocks with more records to this many records",
+)
+@click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the blocking state to this file instead of the block file",
+)
+@read_ahead_option
+@encoding_option
 @verbose_option
-def block(pii_csv, schema, block_json, no_header, verbose):
+def block(
+    pii_csv,
+    schema,
+    block_json,
+    no_header,
+    chunk_size,
+    workers,
+    output_format,
+    max_block_size,
+    state_file,
+    read_ahead,
+    encoding,
+    verbose,
+):
     """Process data to create blocking information
 
     Given a file containing CSV data as PII_CSV, and a JSON
@@ -237,16 +643,396 @@ def block(pii_csv, schema, block_json, no_header, verbose):
     $anonlink block pii.csv blocking-schema.json blocks.json
 
     Use "-" for BLOCKS_JSON to write JSON to stdout.
+
+    PII_CSV may be compressed with gzip, bzip2 or xz; it is decompressed on
+    the fly. The CSV file is read and blocked in chunks, so only the block
+    index is held in memory, not the PII. The block keys of the chunks are
+    computed by a pool of worker processes.
+
+    With --output-format binary the blocks are written as a numpy .npz
+    archive of integer block ids per record, which is much smaller and
+    faster to load than the JSON output.
+
+    --max-block-size bounds the cost of very large blocks, e.g. of a common
+    surname, by keeping a random sample of their records. Matches whose
+    records are only in dropped parts of large blocks are not found.
+
+    --state-file writes the blocking state, which only some consumers
+    need, to a separate compressed file. The block file refers to it by
+    its name and SHA-256 digest.
     """
     header = True
     if no_header:
         header = False
 
     # generate candidate blocks and save to json file
-    result = generate_candidate_blocks_from_csv(
-        pii_csv, schema, header, verbose=verbose
+    with contextlib.ExitStack() as stack:
+        if os.path.isfile(pii_csv.name):
+            pii_csv = stack.enter_context(
+                open_text_input(pii_csv.name, threaded=read_ahead, encoding=encoding)
+            )
+        else:
+            pii_csv = decode_text_stream(pii_csv, encoding)
+        mode = "wb" if output_format == "binary" else "w"
+        block_f = stack.enter_context(click.open_file(block_json.name, mode))
+        state_f = None
+        if state_file is not None:
+            state_f = stack.enter_context(open(state_file, "wb"))
+        write_candidate_blocks_from_csv(
+            pii_csv,
+            schema,
+            block_f,
+            header,
+            verbose=verbose,
+            chunk_size=chunk_size,
+            workers=workers,
+            output_format=output_format,
+            max_block_size=max_block_size,
+            state_f=state_f,
+        )
+
+
+@cli.command(
+    "encode-and-block", short_help="generate hashes and blocks from local PII data"
+)
+@click.argument("pii_csv", type=click.File("r", lazy=True))
+@click.argument("secret", type=str)
+@click.argument("schema", type=click.File("r", lazy=True))
+@click.argument("blocking_schema", type=click.File("r", lazy=True))
+@click.argument("clk_json", type=click.File("w", lazy=True))
+@click.argument("block_json", type=click.File("w", lazy=True))
+@click.option(
+    "--no-header", default=False, is_flag=True, help="Don't skip the first row"
+)
+@click.option(
+    "--check-header",
+    default=True,
+    type=bool,
+    help="If true, check the header against the schema",
+)
+@click.option(
+    "--validate",
+    default=True,
+    type=bool,
+    help="If true, validate the entries against the schema",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of processes used for hashing. Defaults to the number of cores",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHUNK_SIZE,
+    show_default=True,
+    help="Number of CSV rows read and hashed at a time",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["json", "binary"]),
+    default="json",
+    show_default=True,
+    help="Write the CLKs as JSON or in the compact binary CLK format",
+)
+@read_ahead_option
+@encoding_option
+@verbose_option
+def encode_and_block(
+    pii_csv,
+    secret,
+    schema,
+    blocking_schema,
+    clk_json,
+    block_json,
+    no_header,
+    check_header,
+    validate,
+    workers,
+    chunk_size,
+    output_format,
+    read_ahead,
+    encoding,
+    verbose,
+):
+    """Process data to create CLKs and blocking information
+
+    Does the work of encode and block in a single pass over the CSV file
+    PII_CSV. The data is encoded with SECRET and the linkage SCHEMA, and
+    blocked according to the blocking configuration BLOCKING_SCHEMA. The
+    CLKs are written to CLK_JSON and the blocks to BLOCK_JSON.
+
+    For example:
+
+    $anonlink encode-and-block pii.csv horse_stable pii-schema.json blocking-schema.json clks.json blocks.json
+
+    Lambda-fold blocking with input-clks works directly on the CLKs in
+    memory instead of reading them back from CLK_JSON.
+    """
+    try:
+        schema_object = clkhash.schema.from_json_file(schema_file=schema)
+    except SchemaError as e:
+        log(str(e))
+        raise SystemExit(-1)
+    blocking_config = load_blocking_config(blocking_schema)
+    header = True
+    if not check_header:
+        header = "ignore"
+    if no_header:
+        header = False
+
+    try:
+        with contextlib.ExitStack() as stack:
+            if os.path.isfile(pii_csv.name):
+                pii_lines = CsvLines(
+                    stack.enter_context(open_input(pii_csv.name, threaded=read_ahead)),
+                    encoding,
+                )
+            else:
+                pii_lines = decode_text_stream(pii_csv, encoding)
+            if output_format == "binary":
+                clk_f = stack.enter_context(open_output(clk_json.name, "wb"))
+                clk_writer = BinaryClkWriter(clk_f)
+            else:
+                clk_f = stack.enter_context(open_output(clk_json.name, "w"))
+                clk_writer = JsonClkWriter(clk_f)
+            result = encode_and_block_csv(
+                pii_lines,
+                secret,
+                schema_object,
+                blocking_config,
+                clk_writer,
+                header=header,
+                validate=validate,
+                workers=workers,
+                chunk_size=chunk_size,
+                progress_bar=verbose,
+                verbose=verbose,
+            )
+            clk_writer.close()
+    except (validate_data.EntryError, validate_data.FormatError) as e:
+        (msg,) = e.args
+        log(msg)
+        log("Encoding failed.")
+    else:
+        json.dump(result, block_json, indent=4)
+        log("CLK data written to {}".format(clk_json.name))
+        log("Blocking data written to {}".format(block_json.name))
+
+
+@cli.command("block-stats", short_help="estimate the cost of comparing blocks")
+@click.argument("block_files", type=click.File("r", lazy=True), nargs=-1, required=True)
+@click.option(
+    "--largest",
+    type=click.IntRange(min=0),
+    default=10,
+    show_default=True,
+    help="Number of most expensive blocks to list",
+)
+def block_stats(block_files, largest):
+    """Estimate how many comparisons find-similarity will do
+
+    Given the block files BLOCK_FILES of all parties, in JSON or binary
+    format, print the number of comparisons between records of different
+    parties that finding similarities with these blocks causes, the
+    reduction ratio compared to not blocking, the blocks causing the most
+    comparisons and a histogram of the block sizes.
+
+    For example:
+
+    $anonlink block-stats blocks_a.json blocks_b.json
+    """
+    parties = []
+    for block_f in block_files:
+        with block_f:
+            csr, _ = read_blocks(block_f)
+        parties.append(csr)
+    stats = compute_block_stats(parties, largest=largest)
+
+    click.echo(
+        "Records:                {}".format(", ".join(map(str, stats.record_counts)))
+    )
+    click.echo(
+        "Records in no block:    {}".format(", ".join(map(str, stats.unblocked_counts)))
+    )
+    click.echo("Blocks:                 {}".format(stats.block_count))
+    click.echo("Comparisons:            {}".format(stats.comparisons))
+    click.echo("Comparisons unblocked:  {}".format(stats.naive_comparisons))
+    click.echo("Reduction ratio:        {:.6f}".format(stats.reduction_ratio))
+    if stats.largest_blocks:
+        click.echo("Largest blocks:")
+        click.echo("    {:>14}  {:<20}  {}".format("comparisons", "sizes", "block"))
+        for key, sizes, comparisons in stats.largest_blocks:
+            click.echo(
+                "    {:>14}  {:<20}  {}".format(
+                    comparisons, ", ".join(map(str, sizes)), key
+                )
+            )
+    click.echo("Block sizes:")
+    for smallest, biggest, count in stats.size_histogram:
+        click.echo("    {:>10} - {:<10}  {}".format(smallest, biggest, count))
+
+
+@cli.command("tune-blocking", short_help="choose blocking parameters on a sample")
+@click.argument("blocking_schema", type=click.File("r", lazy=True))
+@click.argument(
+    "pii_csvs", type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True
+)
+@click.argument("output", type=click.File("w", lazy=True))
+@click.option(
+    "--grid",
+    type=(str, str),
+    multiple=True,
+    help="A parameter of the blocking config and a JSON list of its values, "
+    "e.g. --grid K '[20, 30]'. Nested parameters are separated by dots",
+)
+@click.option(
+    "--sample-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_SAMPLE_SIZE,
+    show_default=True,
+    help="Number of rows sampled from every CSV file",
+)
+@click.option(
+    "--entity-id-column",
+    default=None,
+    help="Name or index of a column identifying the entity of every row, "
+    "used as ground truth to measure recall",
+)
+@click.option(
+    "--target-recall",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_TARGET_RECALL,
+    show_default=True,
+    help="Recall the recommended configuration must reach",
+)
+@click.option(
+    "--no-header", default=False, is_flag=True, help="Don't skip the first row"
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of processes evaluating configurations. Defaults to the number of cores",
+)
+@click.option("--seed", type=int, default=0, help="Seed for sampling the rows")
+@encoding_option
+def tune_blocking(
+    blocking_schema,
+    pii_csvs,
+    output,
+    grid,
+    sample_size,
+    entity_id_column,
+    target_recall,
+    no_header,
+    workers,
+    seed,
+    encoding,
+):
+    """Choose blocking parameters on a sample of the data
+
+    Samples the CSV files PII_CSVS, one per party, blocks the samples with
+    every combination of the parameter values given with --grid, starting
+    from the configuration in BLOCKING_SCHEMA, and prints the number of
+    comparisons and the block sizes each causes. If --entity-id-column
+    identifies the true matches, the recall of every configuration is
+    measured too. The configuration with the fewest comparisons reaching
+    --target-recall is written to OUTPUT.
+
+    For example:
+
+    $anonlink tune-blocking blocking-schema.json a.csv b.csv tuned-schema.json --grid Lambda '[5, 10]' --grid K '[20, 30, 40]' --entity-id-column recid
+    """
+    blocking_config = load_blocking_config(blocking_schema)
+    try:
+        parameters = [(name, json.loads(values)) for name, values in grid]
+    except ValueError as e:
+        raise click.BadParameter("values must be JSON lists: {}".format(e))
+    if not all(isinstance(values, list) for _, values in parameters):
+        raise click.BadParameter("values must be JSON lists")
+    if entity_id_column is not None and entity_id_column.isdigit():
+        entity_id_column = int(entity_id_column)
+
+    samples = []
+    for path in pii_csvs:
+        with open_text_input(path, encoding=encoding) as pii_f:
+            samples.append(
+                sample_rows(
+                    pii_f,
+                    sample_size,
+                    header=not no_header,
+                    entity_id_column=entity_id_column,
+                    seed=seed,
+                )
+            )
+    results = evaluate_blocking_configs(
+        expand_grid(blocking_config, parameters), samples, workers=workers
+    )
+
+    names = [name for name, _ in parameters]
+    click.echo(
+        "  ".join(
+            ["{:>12}".format(name) for name in names]
+            + ["{:>12}".format(c) for c in ("comparisons", "reduction", "max block")]
+            + ["{:>10}".format(c) for c in ("unblocked", "recall")]
+        )
+    )
+    for result in results:
+        values = []
+        for name in names:
+            value = result.config["config"]
+            for key in name.split("."):
+                value = value[key]
+            values.append("{:>12}".format(json.dumps(value)))
+        if result.stats is None:
+            click.echo("  ".join(values + ["failed: {}".format(result.error)]))
+            continue
+        stats = result.stats
+        largest = stats.largest_blocks[0][2] if stats.largest_blocks else 0
+        recall = "-" if result.recall is None else "{:.4f}".format(result.recall)
+        click.echo(
+            "  ".join(
+                values
+                + [
+                    "{:>12}".format(stats.comparisons),
+                    "{:>12.6f}".format(stats.reduction_ratio),
+                    "{:>12}".format(largest),
+                    "{:>10}".format(sum(stats.unblocked_counts)),
+                    "{:>10}".format(recall),
+                ]
+            )
+        )
+
+    best, meets_target = recommend(results, target_recall)
+    if best is None:
+        log("None of the configurations could be used.")
+        raise SystemExit(1)
+    if not meets_target and best.recall is None:
+        log(
+            "No configuration puts every record in a block, recommending the one "
+            "with the fewest comparisons.",
+            color="yellow",
+        )
+    elif not meets_target:
+        log(
+            "No configuration reaches a recall of {}, recommending the one with "
+            "the highest recall.".format(target_recall)
+        )
+    elif best.recall is None:
+        log(
+            "Without --entity-id-column the recall is unknown, recommending the "
+            "configuration with the fewest comparisons that blocks every record.",
+            color="yellow",
+        )
+    json.dump(best.config, output, indent=4)
+    log(
+        "Recommended configuration with {} comparisons written to {}".format(
+            best.stats.comparisons, output.name
+        ),
+        color="green",
     )
-    json.dump(result, block_json, indent=4)
 
 
 @cli.command("benchmark", short_help="carry out a local benchmark")
@@ -257,9 +1043,10 @@ def benchmark():
 @cli.command("describe", short_help="show distribution of clk popcounts")
 @click.argument("clk_json", type=click.File("r"))
 def describe(clk_json):
-    """show distribution of clk's popcounts using a ascii plot."""
-    clks = json.load(clk_json)["clks"]
-    counts = get_encoding_popcounts([deserialize_bitarray(clk) for clk in clks])
+    """show distribution of clk's popcounts using a ascii plot.
+
+    CLK_JSON can be a JSON or a binary CLK file."""
+    counts = load_clks(clk_json).popcounts().tolist()
     plot_hist(counts, bincount=60, title="popcounts", xlab=True, showSummary=True)
 
 
@@ -517,7 +1304,79 @@ def compare_schema(schema1, schema2, output_format, num_context_lines):
     required=False,
 )
 @click.option("--clk", type=click.File("r"), multiple=True, required=False)
-def find_similarity(threshold, similarity_matches, files, clk):
+@click.option(
+    "--max-block-comparisons",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Split or subsample blocks causing more comparisons than this",
+)
+@click.option(
+    "--large-blocks",
+    type=click.Choice(["split", "sample"]),
+    default="split",
+    show_default=True,
+    help="Split large blocks with CLK bits, or subsample their records",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of processes comparing CLKs",
+)
+@click.option(
+    "--out-of-core",
+    default=False,
+    is_flag=True,
+    help="Memory-map the CLKs and spill candidate pairs to temporary files",
+)
+@click.option(
+    "--temp-dir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    default=None,
+    help="Directory for the temporary files of --out-of-core",
+)
+@click.option(
+    "--popcount-index",
+    default=False,
+    is_flag=True,
+    help="Reuse or write an index of the CLKs' popcounts next to each CLK file",
+)
+@click.option(
+    "--top-k",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Keep only the pairs among the K most similar partners of both of their records",
+)
+@click.option(
+    "--thresholds",
+    default=None,
+    help="More thresholds to solve at, separated by commas, e.g. 0.75,0.85. "
+    "The records are only compared once",
+)
+@click.option(
+    "--save-candidates",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the candidate pairs to this file, to solve them again with the solve command",
+)
+@verbose_option
+def find_similarity(
+    threshold,
+    similarity_matches,
+    files,
+    clk,
+    max_block_comparisons,
+    large_blocks,
+    workers,
+    out_of_core,
+    temp_dir,
+    popcount_index,
+    top_k,
+    thresholds,
+    save_candidates,
+    verbose,
+):
     """
     Find similarities between multi party dataset with blocking and non-blocking methods
 
@@ -530,31 +1389,226 @@ def find_similarity(threshold, similarity_matches, files, clk):
 
     Example of similarity matching without blocks:
     $anonlink find-similarity 0.8 result.txt --clk clk_a.json  --clk  clk_b.json
+
+    CLK files can be JSON or binary CLK files, block files can be JSON or
+    binary block files.
+
+    With --max-block-comparisons, blocks causing more comparisons are split
+    into smaller blocks by the values of a few CLK bits, or subsampled with
+    --large-blocks sample, so the running time is bounded even for very
+    skewed blocks. Some matches in these blocks can be missed, an estimate
+    of the recall in these blocks is printed.
+
+    The comparisons are divided into work units of similar cost, which are
+    scored by --workers processes. Binary CLK files are mapped again in
+    every process rather than copied to it.
+
+    --out-of-core links datasets larger than the memory. The CLKs are
+    memory-mapped, JSON CLK files after converting them to binary ones in
+    --temp-dir, and the candidate pairs are spilled to sorted files there
+    and merged before solving.
+
+    Pairs of CLKs whose popcounts rule out a similarity of at least
+    THRESHOLD are not compared. The fraction of comparisons skipped is
+    printed with --verbose. With --popcount-index the popcounts are stored next to every
+    CLK file, e.g. clk_a.json.popcounts.npz, and reused by later runs.
+
+    With --top-k K a pair is only kept if it is among the K most similar
+    partners of both of its records, so every record keeps at most K
+    candidate pairs with each other party and a low THRESHOLD does not
+    flood the solver with candidate pairs:
+
+    $anonlink find-similarity 0.5 result.txt --top-k 3 --clk clk_a.json --clk clk_b.json
+
+    With --thresholds the records are compared once at the lowest threshold
+    and the candidate pairs are solved at THRESHOLD and at every threshold
+    listed. The matches at THRESHOLD are written to SIMILARITY_MATCHES, the
+    others next to it with the threshold in the name, e.g. result_0.85.txt:
+
+    $anonlink find-similarity 0.8 result.txt --thresholds 0.7,0.75,0.85,0.9 --clk clk_a.json --clk clk_b.json
+
+    With --save-candidates the candidate pairs, found at the lowest
+    threshold, are also written to a binary file. The solve command solves
+    them again, e.g. at another threshold, without comparing the records.
     """
-    clk_groups = []
-    rec_to_blocks = {}
-    if len(files):
-        clk_blocks = []
-        for i, (clk_f, block_f) in enumerate(files):
-            clk_blocks.append(
-                json.load(combine_clks_blocks(clk_f, block_f))["clknblocks"]
+    sweep = {}
+    if thresholds is not None:
+        try:
+            values = [float(value) for value in thresholds.split(",") if value.strip()]
+        except ValueError:
+            raise click.BadParameter(
+                "must be numbers separated by commas", param_hint="--thresholds"
+            )
+        if similarity_matches.name in ("-", "<stdout>"):
+            raise click.BadParameter(
+                "can't name the output of every threshold after stdout",
+                param_hint="--thresholds",
             )
+        sweep = {
+            value: threshold_output_path(similarity_matches.name, value)
+            for value in values
+            if value != threshold
+        }
 
-        for i, clk_blk in enumerate(clk_blocks):
-            clk_groups.append(deserialize_filters([r[0] for r in clk_blk]))
-            rec_to_blocks[i] = {rind: clk_blk[rind][1:] for rind in range(len(clk_blk))}
-    else:
-        clk_blocks = []
-        for clk_f in clk:
-            clk_data = json.load(clk_f)["clks"]
-            clk_groups.append(deserialize_filters([r for r in clk_data]))
+    with contextlib.ExitStack() as stack:
+        tmp_dir = None
+        if out_of_core:
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=temp_dir))
+        stats = ComparisonStats()
+        candidate_pairs = _find_similarity(
+            min([threshold, *sweep]),
+            files,
+            clk,
+            max_block_comparisons,
+            large_blocks,
+            workers,
+            tmp_dir,
+            popcount_index,
+            stats,
+            top_k,
+        )
+    if verbose:
+        print(
+            "Skipped {:.1%} of {} comparisons by popcount".format(
+                stats.pruning_ratio, stats.comparisons
+            )
+        )
+    if save_candidates is not None:
+        with open(save_candidates, "wb") as f:
+            dump_sorted_candidates(candidate_pairs, f)
+    found_groups = solve_candidates(candidate_pairs, threshold)
+    print("Found {} matches".format(len(found_groups)))
+    json.dump(found_groups, similarity_matches, indent=4)
+    if sweep:
+        print("{:>10}  {:>10}  {}".format("threshold", "matches", "file"))
+        for value in sorted([threshold, *sweep]):
+            if value == threshold:
+                path, groups = similarity_matches.name, found_groups
+            else:
+                path, groups = sweep[value], solve_candidates(candidate_pairs, value)
+                with open(path, "w") as f:
+                    json.dump(groups, f, indent=4)
+            print("{:>10}  {:>10}  {}".format(value, len(groups), path))
+
+
+def threshold_output_path(path: str, threshold: float) -> str:
+    """The name of the output at `threshold` of a threshold sweep.
+
+    The threshold is inserted before the extension of `path`, e.g.
+    `result.json` becomes `result_0.85.json`.
+    """
+    root, ext = os.path.splitext(path)
+    return "{}_{:g}{}".format(root, threshold, ext)
+
+
+@cli.command("solve", short_help="solve candidate pairs saved by find-similarity")
+@click.argument("candidates", type=click.Path(exists=True, dir_okay=False))
+@click.argument("similarity_matches", type=click.File("w"))
+@click.option(
+    "--threshold",
+    type=float,
+    default=None,
+    help="Only solve the candidate pairs with at least this similarity. "
+    "Defaults to all of them",
+)
+@click.option(
+    "--merge-threshold",
+    type=click.FloatRange(min=0, max=1, min_open=True),
+    default=1.0,
+    show_default=True,
+    help="Proportion of candidate pairs between two groups of records "
+    "required to merge them",
+)
+def solve(candidates, similarity_matches, threshold, merge_threshold):
+    """Solve candidate pairs saved by find-similarity
+
+    Given the file CANDIDATES written by find-similarity --save-candidates,
+    find the matching groups of records without comparing the records
+    again, and write them to SIMILARITY_MATCHES in the format of
+    find-similarity.
+
+    Thresholds below the one the candidate pairs were found at have no
+    effect. A --merge-threshold below 1 also merges groups of records
+    that are not all candidate pairs, if enough of their pairs are.
+
+    For example:
+
+    $anonlink find-similarity 0.7 result.txt --save-candidates candidates.bin --clk clk_a.json --clk clk_b.json
 
-    blocking = True if len(files) else False
-    found_groups = solve(clk_groups, rec_to_blocks, threshold, blocking)
+    $anonlink solve candidates.bin result-0.8.txt --threshold 0.8
+    """
+    try:
+        candidate_pairs = load_sorted_candidates(candidates)
+    except ValueError as e:
+        log(str(e))
+        raise SystemExit(-1)
+    found_groups = solve_candidates(candidate_pairs, threshold, merge_threshold)
     print("Found {} matches".format(len(found_groups)))
     json.dump(found_groups, similarity_matches, indent=4)
 
 
+def _find_similarity(
+    threshold,
+    files,
+    clk,
+    max_block_comparisons,
+    large_blocks,
+    workers,
+    tmp_dir,
+    popcount_index,
+    stats,
+    top_k,
+):
+    parties = None
+    if len(files):
+        clk_groups, parties = join_clks_blocks(files, tmp_dir)
+        if max_block_comparisons is not None:
+            parties, report = bound_block_comparisons(
+                parties,
+                clk_groups,
+                max_block_comparisons,
+                method=large_blocks,
+                threshold=threshold,
+            )
+            print(
+                "{} {} blocks with more than {} comparisons: {} comparisons "
+                "instead of {}, estimated recall in these blocks "
+                "{:.1%}".format(
+                    "Split" if large_blocks == "split" else "Subsampled",
+                    report.block_count,
+                    max_block_comparisons,
+                    report.cost_after,
+                    report.cost_before,
+                    report.expected_recall,
+                )
+            )
+    elif tmp_dir is not None:
+        clk_groups = [map_clks(clk_f, tmp_dir) for clk_f in clk]
+    else:
+        clk_groups = [load_clks(clk_f) for clk_f in clk]
+
+    popcounts = None
+    if popcount_index:
+        clk_files = [clk_f for clk_f, _ in files] if len(files) else clk
+        popcounts = [
+            load_popcount_index(clks, clk_f.name)
+            for clks, clk_f in zip(clk_groups, clk_files)
+        ]
+
+    if tmp_dir is not None:
+        return find_candidates_out_of_core(
+            clk_groups, parties, threshold, workers, tmp_dir, popcounts, stats, top_k
+        )
+    if parties is None:
+        return find_candidates(
+            clk_groups, {}, threshold, False, workers, popcounts, stats, top_k
+        )
+    rec_to_blocks = solver_blocks(parties)
+    return find_candidates(
+        clk_groups, rec_to_blocks, threshold, True, workers, popcounts, stats, top_k
+    )
+
+
 if __name__ == "__main__":
     freeze_support()
     cli()
@@ -0,0 +1,200 @@
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import threading
+from typing import BinaryIO, Optional, TextIO
+
+DEFAULT_BLOCK_SIZE = 2**20
+DEFAULT_QUEUE_DEPTH = 8
+
+# Magic bytes and extensions of the supported compression formats.
+COMPRESSION_FORMATS = {
+    "gzip": (b"\x1f\x8b", (".gz", ".gzip"), gzip.open),
+    "bz2": (b"BZh", (".bz2",), bz2.open),
+    "xz": (b"\xfd7zXZ\x00", (".xz", ".lzma"), lzma.open),
+}
+_MAX_MAGIC = max(len(magic) for magic, _, _ in COMPRESSION_FORMATS.values())
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """Detect the compression of a file from its extension or magic bytes.
+
+    :param path: The path of the file.
+    :return: One of the keys of `COMPRESSION_FORMATS`, or `None` if the
+        file is not compressed.
+    """
+    lower = str(path).lower()
+    for name, (_, extensions, _) in COMPRESSION_FORMATS.items():
+        if lower.endswith(extensions):
+            return name
+    with open(path, "rb") as f:
+        head = f.read(_MAX_MAGIC)
+    for name, (magic, _, _) in COMPRESSION_FORMATS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def uncompressed_name(path: str) -> str:
+    """The name of a file without the extension of its compression format."""
+    lower = str(path).lower()
+    for _, extensions, _ in COMPRESSION_FORMATS.values():
+        for extension in extensions:
+            if lower.endswith(extension):
+                return str(path)[: -len(extension)]
+    return str(path)
+
+
+class _ThreadedRawReader(io.RawIOBase):
+    """Raw stream whose data is read ahead by a background thread.
+
+    The thread reads blocks from the wrapped file into a bounded queue,
+    so decompression overlaps with the processing of the data in the
+    calling thread.
+    """
+
+    def __init__(self, f: BinaryIO, block_size: int, queue_depth: int):
+        super().__init__()
+        self.name = getattr(f, "name", None)
+        self._f = f
+        self._blocks = queue.Queue(maxsize=queue_depth)  # type: queue.Queue
+        self._buffer = memoryview(b"")
+        self._position = f.tell() if f.seekable() else 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._read_ahead, args=(block_size,), daemon=True
+        )
+        self._thread.start()
+
+    def _read_ahead(self, block_size: int):
+        try:
+            while not self._stopping.is_set():
+                block = self._f.read(block_size)
+                self._put(block)
+                if not block:
+                    return
+        except BaseException as e:  # re-raised by readinto
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stopping.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, b) -> int:
+        if not self._buffer:
+            block = self._blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            if not block:
+                self._blocks.put(block)  # stay at the end of the file
+                return 0
+            self._buffer = memoryview(block)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopping.set()
+            self._thread.join()
+            self._f.close()
+        super().close()
+
+
+def open_input(
+    path: str,
+    offset: int = 0,
+    threaded: bool = False,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    queue_depth: int = DEFAULT_QUEUE_DEPTH,
+) -> BinaryIO:
+    """Open a file for reading, decompressing it on the fly if needed.
+
+    Files compressed with gzip, bzip2 or xz are recognised by their
+    extension or their magic bytes and decompressed as they are read, so
+    they never need to be decompressed to disk.
+
+    :param path: The path of the file.
+    :param offset: Position in the decompressed data to start reading at.
+    :param threaded: Read and decompress the file in a background thread,
+        so decompression overlaps with the processing of the data.
+    :param block_size: The size of the blocks read by the background
+        thread.
+    :param queue_depth: The number of blocks the background thread reads
+        ahead.
+    :return: A binary file-like object of the decompressed data.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        f = open(path, "rb")  # type: BinaryIO
+    else:
+        _, _, opener = COMPRESSION_FORMATS[compression]
+        f = opener(path, "rb")
+    if offset:
+        f.seek(offset)
+    if threaded:
+        raw = _ThreadedRawReader(f, block_size, queue_depth)
+        return io.BufferedReader(raw)  # type: ignore
+    return f
+
+
+class _NamedTextIOWrapper(io.TextIOWrapper):
+    """Text wrapper reporting the path of the file it was opened from."""
+
+    def __init__(self, buffer: BinaryIO, name: str, **kwargs):
+        super().__init__(buffer, **kwargs)
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+def decode_text_stream(text_f: TextIO, encoding: Optional[str] = None) -> TextIO:
+    """Decode a text stream that isn't a file, such as stdin, with `encoding`.
+
+    Files are opened by path with :func:`open_text_input` and the same
+    encoding, so the same CSV data is decoded the same way either way.
+
+    :param text_f: A text stream with an underlying binary `buffer`.
+    :param encoding: The text encoding. `None` keeps the stream as is.
+    :return: A text file-like object with the name of `text_f`.
+    """
+    if encoding is None or not hasattr(text_f, "buffer"):
+        return text_f
+    return _NamedTextIOWrapper(
+        text_f.buffer, text_f.name, encoding=encoding, newline=""
+    )
+
+
+def open_text_input(
+    path: str, threaded: bool = False, encoding: Optional[str] = None
+) -> TextIO:
+    """Open a possibly compressed text file, see :func:`open_input`.
+
+    The returned file keeps the `name` of the compressed file, so code
+    looking at the file name still sees the original path.
+
+    :param path: The path of the file.
+    :param threaded: Decompress the file in a background thread.
+    :param encoding: The text encoding. Defaults to the locale's encoding,
+        as for :func:`open`.
+    :return: A text file-like object of the decompressed data.
+    """
+    return _NamedTextIOWrapper(
+        open_input(path, threaded=threaded), path, encoding=encoding, newline=""
+    )
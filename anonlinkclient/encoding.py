@@ -0,0 +1,654 @@
+import collections
+import concurrent.futures
+import csv
+import itertools
+import json
+import locale
+import logging
+import os
+import re
+import time
+from typing import (
+    Any,
+    AnyStr,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from bitarray import bitarray
+from clkhash.bloomfilter import fold_xor, hashing_function_from_properties
+from clkhash.clk import hash_chunk
+from clkhash.key_derivation import generate_key_lists
+from clkhash.schema import Schema
+from clkhash.stats import OnlineMeanVariance
+from clkhash.validate_data import (
+    EntryError,
+    FormatError,
+    validate_entries,
+    validate_header,
+    validate_row_lengths,
+)
+from tqdm import tqdm
+
+from .cache import ClkCache, describe_settings
+
+log = logging.getLogger("anonlink")
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_CACHE_SIZE = 2**16
+
+
+def _row_offset_error(e, offset):
+    """Shift the row index reported by a clkhash validation error by `offset`.
+
+    clkhash validates a sequence of rows and reports row indices relative to
+    that sequence. When validating chunk by chunk we want the index within the
+    whole file instead.
+    """
+    if not offset:
+        return e
+    (msg,) = e.args
+    msg = re.sub(
+        r"([Rr]ow) (\d+)",
+        lambda m: "{} {}".format(m.group(1), int(m.group(2)) + offset),
+        msg,
+        count=1,
+    )
+    new_e = type(e)(msg)
+    new_e.__dict__.update(e.__dict__)
+    if getattr(e, "row_index", None) is not None:
+        new_e.row_index = e.row_index + offset
+    return new_e
+
+
+class CsvLines:
+    """The decoded lines of a binary CSV file, tracking the byte offset.
+
+    :class:`csv.reader` only pulls the lines of the rows it returns, so
+    after a row has been read `offset` is the position of the next row in
+    the file. Seeking the file to a recorded offset resumes reading there.
+
+    :param binary_f: A file opened in binary mode.
+    :param encoding: The text encoding of the file. Defaults to the
+        locale's encoding, as for :func:`open`.
+    :ivar offset: The number of bytes of the file consumed so far.
+    """
+
+    def __init__(self, binary_f: BinaryIO, encoding: Optional[str] = None):
+        self._f = binary_f
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.offset = binary_f.tell()
+
+    def __iter__(self) -> Iterator[str]:
+        for line in self._f:
+            self.offset += len(line)
+            yield line.decode(self.encoding)
+
+
+def read_csv_chunks(
+    input_f: Union[TextIO, Iterable[str]],
+    schema: Union[Schema, Sequence[Schema]],
+    validate: bool = True,
+    header: Union[bool, str] = True,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[List[Tuple[str, ...]]]:
+    """Read and validate a CSV file of PII in chunks of rows.
+
+    Whitespace around each entry is stripped, as done by clkhash.
+
+    :param input_f: A file-like object of csv data to encode.
+    :param schema: Schema specifying the record formats, or a sequence of
+        schemas which the rows must all conform to.
+    :param validate: Set to `False` to disable validation of the entries.
+        The number of entries per row is always checked.
+    :param header: Set to `False` if the CSV file does not have
+        a header. Set to `'ignore'` if the CSV file does have a
+        header but it should not be checked against the schema.
+    :param chunk_size: Number of rows per chunk.
+    :return: A generator of lists of rows.
+    """
+    if header not in {False, True, "ignore"}:
+        raise ValueError(
+            "header must be False, True or 'ignore' but is {!s}.".format(header)
+        )
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive but is {}.".format(chunk_size))
+
+    schemas = [schema] if isinstance(schema, Schema) else list(schema)
+    reader = csv.reader(input_f)
+    if header:
+        column_names = next(reader)
+        if header != "ignore":
+            for s in schemas:
+                validate_header(s.fields, column_names)
+
+    offset = 0
+    while True:
+        chunk = [
+            tuple(element.strip() for element in line)
+            for line in itertools.islice(reader, chunk_size)
+        ]
+        if not chunk:
+            return
+        try:
+            for s in schemas:
+                validate_row_lengths(s.fields, chunk)
+                if validate:
+                    validate_entries(s.fields, chunk)
+        except (EntryError, FormatError) as e:
+            raise _row_offset_error(e, offset) from e
+        offset += len(chunk)
+        yield chunk
+
+
+class CacheStats:
+    """Hit and miss counts of the value cache, per feature.
+
+    :ivar identifiers: The feature identifiers, in schema order.
+    :ivar hits: The number of cache hits per feature.
+    :ivar misses: The number of cache misses per feature.
+    """
+
+    def __init__(self, identifiers: Sequence[str]):
+        self.identifiers = list(identifiers)
+        self.hits = [0] * len(self.identifiers)
+        self.misses = [0] * len(self.identifiers)
+
+    def update(self, hits: Sequence[int], misses: Sequence[int]):
+        for i, (h, m) in enumerate(zip(hits, misses)):
+            self.hits[i] += h
+            self.misses[i] += m
+
+    @staticmethod
+    def _rate(hits, misses):
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of hashed values that were found in the cache."""
+        return self._rate(sum(self.hits), sum(self.misses))
+
+    def summary(self) -> str:
+        lines = ["Value cache hit rate: {:.1%}".format(self.hit_rate)]
+        for identifier, h, m in zip(self.identifiers, self.hits, self.misses):
+            if h + m:
+                lines.append(
+                    "  {}: {:.1%} of {} values".format(
+                        identifier, self._rate(h, m), h + m
+                    )
+                )
+        return "\n".join(lines)
+
+
+class Hasher:
+    """Hash records with clkhash.
+
+    Hashers are handed to the worker processes once, so the keys and the
+    schema are not sent along with every chunk.
+
+    :param key_lists: The keys derived from the secret, one list per feature.
+    :param schema: Schema specifying the record formats and hashing settings.
+    """
+
+    def __init__(self, key_lists: Sequence[Sequence[bytes]], schema: Schema):
+        self.key_lists = key_lists
+        self.schema = schema
+
+    def hash_chunk(
+        self, chunk_pii_data: Sequence[Sequence[str]]
+    ) -> Tuple[List[bitarray], Sequence[int], Optional[List[int]], Optional[List[int]]]:
+        """Generate Bloom filters from a chunk of PII.
+
+        :param chunk_pii_data: A sequence of records.
+        :return: The Bloom filters as bitarrays, their popcounts and the
+            number of cache hits and misses per feature, if any.
+        """
+        clks, popcounts = hash_chunk(chunk_pii_data, self.key_lists, self.schema)
+        return clks, popcounts, None, None
+
+
+class CachingHasher(Hasher):
+    """Hash records like clkhash, memoizing the Bloom filter of each value.
+
+    Person data contains many repeated values, e.g. common first names or
+    postcodes. The Bloom filter bits of a field only depend on the feature
+    and its value, so they are kept in an LRU cache keyed by the feature
+    index and the value. A cache hit skips formatting, tokenization and
+    hashing of the value. The CLKs are identical to the ones of
+    :func:`clkhash.clk.hash_chunk`.
+
+    Every process gets its own cache; the cached Bloom filters never leave
+    the process.
+
+    :param key_lists: The keys derived from the secret, one list per feature.
+    :param schema: Schema specifying the record formats and hashing settings.
+    :param cache_size: The maximal number of cached values.
+    """
+
+    def __init__(
+        self,
+        key_lists: Sequence[Sequence[bytes]],
+        schema: Schema,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        super().__init__(key_lists, schema)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = collections.OrderedDict()
+        return state
+
+    def _encode_value(self, field_index: int, entry: str) -> Optional[bitarray]:
+        field = self.schema.fields[field_index]
+        fhp = field.hashing_properties
+        ngrams = list(fhp.comparator.tokenize(field.format_value(entry)))
+        if not ngrams:
+            return None
+        hash_function = hashing_function_from_properties(fhp)
+        return hash_function(
+            ngrams,
+            self.key_lists[field_index],
+            fhp.strategy.bits_per_token(len(ngrams)),
+            self.schema.l * 2**self.schema.xor_folds,
+            fhp.encoding,
+        )
+
+    def hash_chunk(self, chunk_pii_data):
+        hash_l = self.schema.l * 2**self.schema.xor_folds
+        hashed_fields = [
+            i
+            for i, field in enumerate(self.schema.fields)
+            if field.hashing_properties is not None
+        ]
+        cache = self._cache
+        hits = [0] * len(self.schema.fields)
+        misses = [0] * len(self.schema.fields)
+        clks, popcounts = [], []
+        for record in chunk_pii_data:
+            bloomfilter = bitarray(hash_l)
+            bloomfilter.setall(False)
+            for i in hashed_fields:
+                key = (i, record[i])
+                try:
+                    field_bf = cache[key]
+                except KeyError:
+                    misses[i] += 1
+                    field_bf = cache[key] = self._encode_value(i, record[i])
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+                else:
+                    hits[i] += 1
+                    cache.move_to_end(key)
+                if field_bf is not None:
+                    bloomfilter |= field_bf
+            bloomfilter = fold_xor(bloomfilter, self.schema.xor_folds)
+            clks.append(bloomfilter)
+            popcounts.append(bloomfilter.count())
+        return clks, popcounts, hits, misses
+
+
+def _tokenization_key(index: int, field) -> str:
+    """Fields with the same key produce the same tokens for a column."""
+    fhp = field.hashing_properties
+    attributes = {
+        name: value
+        for name, value in vars(field).items()
+        if name not in ("identifier", "description", "hashing_properties")
+    }
+    settings = [index, type(field).__qualname__, attributes]
+    settings += [fhp.missing_value, fhp.comparator]
+    return json.dumps(describe_settings(settings), sort_keys=True)
+
+
+class MultiHasher:
+    """Hash records with several encodings at once.
+
+    Each encoding is a pair of key lists and a schema. The schemas must
+    all describe the same columns. A column is formatted and tokenized
+    only once for all the encodings whose field formats and comparators
+    agree, and the tokens are then hashed with the keys and settings of
+    every encoding. The CLKs are identical to the ones of
+    :func:`clkhash.clk.hash_chunk` for each encoding on its own.
+
+    :param encodings: Pairs of the keys derived from a secret, one list
+        per feature, and the schema to encode with.
+    """
+
+    def __init__(self, encodings: Sequence[Tuple[Sequence[Sequence[bytes]], Schema]]):
+        self.encodings = list(encodings)
+        slots = {}  # type: Dict[str, int]
+        self._tokenized = []  # type: List[Tuple[int, Any]]
+        self._fields = []  # type: List[List[Tuple[int, int]]]
+        for _, schema in self.encodings:
+            fields = []
+            for i, field in enumerate(schema.fields):
+                if field.hashing_properties is None:
+                    continue
+                key = _tokenization_key(i, field)
+                if key not in slots:
+                    slots[key] = len(self._tokenized)
+                    self._tokenized.append((i, field))
+                fields.append((i, slots[key]))
+            self._fields.append(fields)
+
+    @property
+    def shared_tokenizations(self) -> int:
+        """The number of column tokenizations saved per record."""
+        return sum(len(fields) for fields in self._fields) - len(self._tokenized)
+
+    def hash_chunk(
+        self, chunk_pii_data: Sequence[Sequence[str]]
+    ) -> List[Tuple[List[bitarray], List[int]]]:
+        """Generate the Bloom filters of every encoding from a chunk of PII.
+
+        :param chunk_pii_data: A sequence of records.
+        :return: For every encoding, the Bloom filters as bitarrays and
+            their popcounts.
+        """
+        results = [([], []) for _ in self.encodings]  # type: List[Tuple[list, list]]
+        for record in chunk_pii_data:
+            tokens = [
+                list(
+                    field.hashing_properties.comparator.tokenize(
+                        field.format_value(record[i])
+                    )
+                )
+                for i, field in self._tokenized
+            ]
+            for (key_lists, schema), fields, (clks, popcounts) in zip(
+                self.encodings, self._fields, results
+            ):
+                hash_l = schema.l * 2**schema.xor_folds
+                bloomfilter = bitarray(hash_l)
+                bloomfilter.setall(False)
+                for i, slot in fields:
+                    ngrams = tokens[slot]
+                    if ngrams:
+                        fhp = schema.fields[i].hashing_properties
+                        hash_function = hashing_function_from_properties(fhp)
+                        bloomfilter |= hash_function(
+                            ngrams,
+                            key_lists[i],
+                            fhp.strategy.bits_per_token(len(ngrams)),
+                            hash_l,
+                            fhp.encoding,
+                        )
+                bloomfilter = fold_xor(bloomfilter, schema.xor_folds)
+                clks.append(bloomfilter)
+                popcounts.append(bloomfilter.count())
+        return results
+
+
+def _derive_keys(secret: AnyStr, schema: Schema) -> List[Tuple[bytes, ...]]:
+    return generate_key_lists(
+        secret,
+        len(schema.fields),
+        key_size=schema.kdf_key_size,
+        salt=schema.kdf_salt,
+        info=schema.kdf_info,
+        kdf=schema.kdf_type,
+        hash_algo=schema.kdf_hash,
+    )
+
+
+def stream_clks_from_csv(
+    input_f: Union[TextIO, Iterable[str]],
+    secret: AnyStr,
+    schema: Schema,
+    validate: bool = True,
+    header: Union[bool, str] = True,
+    progress_bar: bool = False,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    cache_size: int = 0,
+    cache_stats: Optional[CacheStats] = None,
+    clk_cache: Optional[ClkCache] = None,
+    on_chunk: Optional[Callable[[int, Optional[int]], None]] = None,
+) -> Iterator[bitarray]:
+    """Generate CLKs from a CSV file without loading it into memory.
+
+    The CSV file is read in chunks of `chunk_size` rows. Each chunk is
+    validated and then hashed, possibly in a pool of worker processes.
+    CLKs are yielded in the order of the input rows and are identical
+    to the ones produced by :func:`clkhash.clk.generate_clk_from_csv`.
+
+    At most two chunks per worker are in flight at any time, so memory
+    use is bounded by the chunk size rather than by the size of the file.
+
+    :param input_f: A file-like object of csv data to encode.
+    :param secret: The secret used to derive the hashing keys.
+    :param schema: Schema specifying the record formats and
+        hashing settings.
+    :param validate: Set to `False` to disable validation of
+        data against the schema.
+    :param header: Set to `False` if the CSV file does not have
+        a header. Set to `'ignore'` if the CSV file does have a
+        header but it should not be checked against the schema.
+    :param progress_bar: Set to `True` to show a progress bar.
+    :param workers: Number of worker processes. `None` uses all available
+        cores; 1 hashes in the current process.
+    :param chunk_size: Number of rows hashed per task.
+    :param cache_size: If positive, memoize the Bloom filters of up to this
+        many field values per process, see :class:`CachingHasher`.
+    :param cache_stats: Optional :class:`CacheStats` which is updated with
+        the cache hits and misses.
+    :param clk_cache: Optional :class:`ClkCache` of previously encoded
+        rows. Only rows that are not found in it are hashed, and their
+        CLKs are added to it.
+    :param on_chunk: Optional callback run once all the CLKs of a chunk
+        have been consumed. It is called with the number of rows encoded
+        so far and, if `input_f` is a :class:`CsvLines`, the offset in the
+        file after the last of these rows, or `None` otherwise.
+    :return: A generator of Bloom filters as bitarrays.
+    """
+    chunks = read_csv_chunks(input_f, schema, validate, header, chunk_size)
+    boundaries = collections.deque()  # type: collections.deque
+    if on_chunk is not None:
+        chunks = _track_boundaries(chunks, input_f, boundaries)
+    clks = stream_clks_from_chunks(
+        chunks,
+        secret,
+        schema,
+        progress_bar=progress_bar,
+        workers=workers,
+        cache_size=cache_size,
+        cache_stats=cache_stats,
+        clk_cache=clk_cache,
+    )
+    for count, clk in enumerate(clks, 1):
+        yield clk
+        # The consumer has taken the last CLK of a chunk once it asks for
+        # the next one.
+        if on_chunk is not None and count == boundaries[0][0]:
+            on_chunk(*boundaries.popleft())
+
+
+def stream_clks_from_chunks(
+    chunks: Iterable[Sequence[Sequence[str]]],
+    secret: AnyStr,
+    schema: Schema,
+    progress_bar: bool = False,
+    workers: Optional[int] = None,
+    cache_size: int = 0,
+    cache_stats: Optional[CacheStats] = None,
+    clk_cache: Optional[ClkCache] = None,
+) -> Iterator[bitarray]:
+    """Generate CLKs from chunks of already parsed and validated rows.
+
+    See :func:`stream_clks_from_csv` for the parameters. This allows
+    the rows to be used for something else as well, e.g. blocking, while
+    they are hashed.
+
+    :param chunks: An iterable of sequences of rows, e.g. as produced by
+        :func:`read_csv_chunks`.
+    :return: A generator of Bloom filters as bitarrays.
+    """
+    key_lists = _derive_keys(secret, schema)
+    if cache_size > 0:
+        hasher = CachingHasher(key_lists, schema, cache_size)  # type: Hasher
+    else:
+        hasher = Hasher(key_lists, schema)
+    chunks = iter(chunks)
+    if clk_cache is None:
+        results = _hash_chunks(chunks, hasher, workers)
+    else:
+        results = _hash_chunks_with_cache(chunks, hasher, workers, clk_cache)
+
+    start_time = time.time()
+    stats = OnlineMeanVariance()
+    with tqdm(
+        desc="generating CLKs",
+        unit="clk",
+        unit_scale=True,
+        disable=not progress_bar,
+    ) as pbar:
+        for clks, clk_stats, hits, misses in results:
+            if cache_stats is not None and hits is not None:
+                cache_stats.update(hits, misses)
+            if progress_bar:
+                stats.update(clk_stats)
+                pbar.set_postfix(mean=stats.mean(), std=stats.std(), refresh=False)
+                pbar.update(len(clks))
+            yield from clks
+    log.info(f"Hashing took {time.time() - start_time:.2f} seconds")
+
+
+def stream_multi_clks_from_csv(
+    input_f: Union[TextIO, Iterable[str]],
+    encodings: Sequence[Tuple[AnyStr, Schema]],
+    validate: bool = True,
+    header: Union[bool, str] = True,
+    progress_bar: bool = False,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Tuple[bitarray, ...]]:
+    """Generate the CLKs of several encodings of a CSV file in one pass.
+
+    The CSV file is read, parsed and validated against every schema once,
+    and each chunk of rows is hashed with all the encodings, see
+    :class:`MultiHasher`. Otherwise this works like
+    :func:`stream_clks_from_csv`.
+
+    :param input_f: A file-like object of csv data to encode.
+    :param encodings: Pairs of a secret and a schema. The schemas must all
+        describe the columns of the CSV file.
+    :param validate: Set to `False` to disable validation of
+        data against the schemas.
+    :param header: Set to `False` if the CSV file does not have
+        a header. Set to `'ignore'` if the CSV file does have a
+        header but it should not be checked against the schemas.
+    :param progress_bar: Set to `True` to show a progress bar.
+    :param workers: Number of worker processes. `None` uses all available
+        cores; 1 hashes in the current process.
+    :param chunk_size: Number of rows hashed per task.
+    :return: A generator of tuples holding the CLK of a row for every
+        encoding, in the order of `encodings`.
+    """
+    if not encodings:
+        raise ValueError("At least one encoding is required.")
+    schemas = [schema for _, schema in encodings]
+    hasher = MultiHasher(
+        [(_derive_keys(secret, schema), schema) for secret, schema in encodings]
+    )
+    chunks = read_csv_chunks(input_f, schemas, validate, header, chunk_size)
+
+    start_time = time.time()
+    with tqdm(
+        desc="generating CLKs",
+        unit="row",
+        unit_scale=True,
+        disable=not progress_bar,
+    ) as pbar:
+        for results in _hash_chunks(chunks, hasher, workers):
+            clk_lists = [clks for clks, _ in results]
+            pbar.update(len(clk_lists[0]))
+            yield from zip(*clk_lists)
+    log.info(f"Hashing took {time.time() - start_time:.2f} seconds")
+
+
+def _track_boundaries(
+    chunks: Iterator[List[Tuple[str, ...]]],
+    input_f: Union[TextIO, Iterable[str]],
+    boundaries: collections.deque,
+) -> Iterator[List[Tuple[str, ...]]]:
+    """Record the row count and input offset at the end of every chunk."""
+    rows = 0
+    for chunk in chunks:
+        rows += len(chunk)
+        boundaries.append((rows, getattr(input_f, "offset", None)))
+        yield chunk
+
+
+_worker_hasher = None  # type: Optional[Hasher]
+
+
+def _init_worker(hasher: Hasher):
+    global _worker_hasher
+    _worker_hasher = hasher
+
+
+def _hash_chunk_in_worker(chunk: Sequence[Sequence[str]]):
+    assert _worker_hasher is not None
+    return _worker_hasher.hash_chunk(chunk)
+
+
+def _hash_chunks(
+    chunks: Iterable[Sequence[Sequence[str]]],
+    hasher: Hasher,
+    workers: Optional[int],
+) -> Iterator[tuple]:
+    """Hash chunks of rows, yielding the results in input order."""
+    if workers == 1:
+        for chunk in chunks:
+            yield hasher.hash_chunk(chunk)
+        return
+
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(hasher,)
+    ) as executor:
+        pending = collections.deque()  # type: collections.deque
+        for chunk in chunks:
+            pending.append(executor.submit(_hash_chunk_in_worker, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _hash_chunks_with_cache(
+    chunks: Iterable[Sequence[Sequence[str]]],
+    hasher: Hasher,
+    workers: Optional[int],
+    clk_cache: ClkCache,
+) -> Iterator[tuple]:
+    """Like :func:`_hash_chunks`, but only hash rows missing from the cache."""
+    lookups = collections.deque()  # type: collections.deque
+
+    def uncached_rows():
+        for chunk in chunks:
+            digests = [clk_cache.row_digest(row) for row in chunk]
+            cached = clk_cache.get_many(digests)
+            lookups.append((digests, cached))
+            yield [row for row, digest in zip(chunk, digests) if digest not in cached]
+
+    # _hash_chunks yields in input order, so every result belongs to the
+    # oldest pending lookup.
+    for new_clks, _, hits, misses in _hash_chunks(uncached_rows(), hasher, workers):
+        digests, cached = lookups.popleft()
+        new_digests = [digest for digest in digests if digest not in cached]
+        clk_cache.put_many(zip(new_digests, new_clks))
+        new = iter(new_clks)
+        clks = [cached[d] if d in cached else next(new) for d in digests]
+        yield clks, [clk.count() for clk in clks], hits, misses
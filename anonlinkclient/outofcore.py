@@ -0,0 +1,339 @@
+import collections
+import concurrent.futures
+import itertools
+import os
+import tempfile
+from typing import IO, BinaryIO, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from anonlink.serialization import merge_streams
+from bitarray import bitarray
+
+from .blocking import CsrBlocks, _intern_block_keys
+from .candidates import (
+    CandidatePairs,
+    ComparisonStats,
+    ScoredUnit,
+    _Task,
+    dataset_popcounts,
+    merge_candidates,
+    score_unit,
+    to_candidate_pairs,
+    top_k_candidates,
+)
+from .serialization import (
+    MappedClks,
+    deserialize_filters_bulk,
+    dump_clks_binary,
+    is_binary_clk_file,
+    iter_json_clks,
+)
+
+# Records of each dataset per tile when comparing without blocks.
+DEFAULT_TILE_SIZE = 10000
+# Comparisons per work unit when comparing blocks. The candidate pairs of
+# every unit are spilled to their own file.
+DEFAULT_UNIT_COMPARISONS = 10**8
+# Candidate pairs held in memory before they are spilled to a file.
+DEFAULT_SPILL_PAIRS = 10**7
+# Files merged at once, bounding the number of open files.
+MERGE_FAN_IN = 64
+
+# Entries of candidate pair files written by anonlink from the arrays of
+# merge_candidates: a double and four 4 byte unsigned integers.
+_ENTRY_DTYPE = np.dtype(
+    [
+        ("sim", "<f8"),
+        ("dset0", "<u4"),
+        ("dset1", "<u4"),
+        ("rec0", "<u4"),
+        ("rec1", "<u4"),
+    ]
+)
+_ENTRY_HEADER = bytes([1, 8, 4, 4])
+
+
+def map_clks(clk_f: IO, tmp_dir: str, chunk_size: int = 100000) -> MappedClks:
+    """Memory-map the CLKs of a CLK file.
+
+    Binary CLK files are mapped directly. The CLKs of a JSON file are
+    decoded in chunks into a binary CLK file in `tmp_dir` first, which is
+    then mapped, so they are never all held in memory.
+
+    :param clk_f: A file-like object of a JSON or binary CLK file.
+    :param tmp_dir: Directory for the binary copy of a JSON CLK file. It
+        must exist as long as the CLKs are used.
+    :param chunk_size: The number of CLKs decoded at once.
+    :return: The memory-mapped CLKs.
+    """
+    if is_binary_clk_file(clk_f):
+        return MappedClks(clk_f.name)
+
+    def decoded_clks() -> Iterator[bitarray]:
+        json_clks = iter_json_clks(clk_f)
+        while True:
+            chunk = list(itertools.islice(json_clks, chunk_size))
+            if not chunk:
+                return
+            yield from deserialize_filters_bulk(chunk)
+
+    fd, path = tempfile.mkstemp(suffix=".bin", dir=tmp_dir)
+    with os.fdopen(fd, "wb") as f:
+        dump_clks_binary(decoded_clks(), f)
+    return MappedClks(path)
+
+
+def tile_units(
+    datasets: Sequence[Sequence[bitarray]], tile_size: int = DEFAULT_TILE_SIZE
+) -> Iterator[List[_Task]]:
+    """Work units comparing all records of every pair of datasets.
+
+    Every unit compares up to `tile_size` consecutive records of one
+    dataset with as many of another, so it only touches a small part of
+    the memory-mapped CLKs.
+    """
+    for i0, i1 in itertools.combinations(range(len(datasets)), 2):
+        for lo0 in range(0, len(datasets[i0]), tile_size):
+            rows0 = list(range(lo0, min(lo0 + tile_size, len(datasets[i0]))))
+            for lo1 in range(0, len(datasets[i1]), tile_size):
+                rows1 = list(range(lo1, min(lo1 + tile_size, len(datasets[i1]))))
+                yield [(i0, i1, rows0, rows1)]
+
+
+def block_units(
+    parties: Sequence[CsrBlocks], unit_comparisons: int = DEFAULT_UNIT_COMPARISONS
+) -> Iterator[List[_Task]]:
+    """Work units comparing the records of every block.
+
+    Consecutive blocks are grouped into units of about `unit_comparisons`
+    comparisons. Larger blocks are sliced by the records of the first
+    dataset. The block index is built from the CSR arrays, without a
+    dictionary per record.
+    """
+    keys, party_ids = _intern_block_keys(parties)
+    members = []
+    for csr, ids in zip(parties, party_ids):
+        block_ids = ids[csr.block_ids]
+        rec_ids = np.repeat(np.arange(csr.record_count), np.diff(csr.offsets))
+        order = np.argsort(block_ids, kind="stable")
+        starts = np.searchsorted(block_ids[order], np.arange(len(keys) + 1))
+        members.append((rec_ids[order], starts))
+
+    unit = []  # type: List[_Task]
+    unit_cost = 0
+    for b in range(len(keys)):
+        block = [recs[starts[b] : starts[b + 1]] for recs, starts in members]
+        for i0, i1 in itertools.combinations(range(len(block)), 2):
+            cost = len(block[i0]) * len(block[i1])
+            if not cost:
+                continue
+            rows1 = block[i1].tolist()
+            step = max(1, unit_comparisons // len(rows1))
+            for lo in range(0, len(block[i0]), step):
+                rows0 = block[i0][lo : lo + step].tolist()
+                unit.append((i0, i1, rows0, rows1))
+                unit_cost += len(rows0) * len(rows1)
+                if unit_cost >= unit_comparisons:
+                    yield unit
+                    unit, unit_cost = [], 0
+    if unit:
+        yield unit
+
+
+_worker_datasets = None  # type: Optional[Sequence[Sequence[bitarray]]]
+_worker_popcounts = None  # type: Optional[Sequence[np.ndarray]]
+
+
+def _init_worker(
+    datasets: Sequence[Sequence[bitarray]], popcounts: Sequence[np.ndarray]
+):
+    global _worker_datasets, _worker_popcounts
+    _worker_datasets = datasets
+    _worker_popcounts = popcounts
+
+
+def _score_unit_in_worker(
+    threshold: float, unit: Sequence[_Task], k: Optional[int] = None
+):
+    assert _worker_datasets is not None
+    return score_unit(_worker_datasets, threshold, unit, _worker_popcounts, k)
+
+
+def _scored_units(
+    datasets: Sequence[Sequence[bitarray]],
+    threshold: float,
+    units: Iterator[List[_Task]],
+    workers: Optional[int],
+    popcounts: Sequence[np.ndarray],
+    k: Optional[int] = None,
+) -> Iterator[ScoredUnit]:
+    """Score work units, holding only a few units' results at a time."""
+    if workers == 1:
+        for unit in units:
+            yield score_unit(datasets, threshold, unit, popcounts, k)
+        return
+
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(datasets, popcounts)
+    ) as executor:
+        pending = collections.deque()  # type: collections.deque
+        for unit in units:
+            pending.append(executor.submit(_score_unit_in_worker, threshold, unit, k))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _spill(
+    results: List[Tuple[np.ndarray, ...]], spill_dir: str, k: Optional[int] = None
+) -> str:
+    """Write the sorted candidate pairs of work units to a new file.
+
+    See :func:`dump_sorted_candidates` for the format. With `k` only the
+    best candidates of either of their records are written.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pairs", dir=spill_dir)
+    with os.fdopen(fd, "wb") as f:
+        dump_sorted_candidates(merge_candidates(results, k, either=True), f)
+    return path
+
+
+def dump_sorted_candidates(candidates: CandidatePairs, f: BinaryIO):
+    """Write sorted candidate pairs to a file.
+
+    The file is in the format of :func:`anonlink.serialization.dump_candidate_pairs`,
+    with double similarities and 4 byte indices, 24 bytes per pair, but
+    written with numpy rather than one pair at a time. It can be read with
+    :func:`load_sorted_candidates` or :func:`anonlink.serialization.load_candidate_pairs`.
+
+    :param candidates: The candidate pairs, in the format of
+        :mod:`anonlink` and sorted like it.
+    :param f: A binary file-like object to write to.
+    """
+    sims, (dset_is0, dset_is1), (rec_is0, rec_is1) = candidates
+    entries = np.empty(len(sims), dtype=_ENTRY_DTYPE)
+    entries["sim"] = sims
+    entries["dset0"], entries["dset1"] = dset_is0, dset_is1
+    entries["rec0"], entries["rec1"] = rec_is0, rec_is1
+    f.write(_ENTRY_HEADER)
+    f.write(entries.tobytes())
+
+
+def _merge_files(paths: List[str], tmp_dir: str) -> str:
+    """Merge sorted candidate pair files, `MERGE_FAN_IN` at a time."""
+    while len(paths) > 1:
+        merged = []
+        for start in range(0, len(paths), MERGE_FAN_IN):
+            group = paths[start : start + MERGE_FAN_IN]
+            fd, path = tempfile.mkstemp(suffix=".pairs", dir=tmp_dir)
+            with os.fdopen(fd, "wb") as f_out:
+                files = [open(p, "rb") for p in group]
+                try:
+                    merge_streams(files, f_out)
+                finally:
+                    for f in files:
+                        f.close()
+            for p in group:
+                os.remove(p)
+            merged.append(path)
+        paths = merged
+    return paths[0]
+
+
+def load_sorted_candidates(path: str, k: Optional[int] = None) -> CandidatePairs:
+    """Load a sorted candidate pair file, keeping every pair once.
+
+    :param path: A file of candidate pairs with double similarities and
+        4 byte indices, in the format of :mod:`anonlink.serialization`.
+    :param k: If given, only the `k` best candidates of every record are
+        kept, see :func:`anonlinkclient.candidates.top_k_candidates`.
+    :return: The candidate pairs, in the format of :mod:`anonlink`.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(_ENTRY_HEADER)) != _ENTRY_HEADER:
+            raise ValueError("Unsupported candidate pair file")
+    entries = np.memmap(path, dtype=_ENTRY_DTYPE, mode="r", offset=len(_ENTRY_HEADER))
+    keep = np.ones(len(entries), dtype=bool)
+    if len(entries):
+        keep[1:] = entries[1:] != entries[:-1]
+
+    candidates = tuple(entries[field][keep] for field in _ENTRY_DTYPE.names)
+    if k is not None:
+        candidates = top_k_candidates(candidates, k)
+    return to_candidate_pairs(candidates)
+
+
+def find_candidate_pairs_out_of_core(
+    datasets: Sequence[Sequence[bitarray]],
+    threshold: float,
+    parties: Optional[Sequence[CsrBlocks]] = None,
+    workers: Optional[int] = None,
+    tmp_dir: Optional[str] = None,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    unit_comparisons: int = DEFAULT_UNIT_COMPARISONS,
+    spill_pairs: int = DEFAULT_SPILL_PAIRS,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+) -> CandidatePairs:
+    """Find the candidate pairs of datasets larger than the memory.
+
+    The comparisons are divided into work units, tiles of records without
+    blocks or ranges of blocks with them. Whenever the units have found
+    `spill_pairs` candidate pairs, these are sorted and spilled to a
+    temporary file. The files are merged with
+    :func:`anonlink.serialization.merge_streams` and only the merged
+    candidate pairs are loaded. Use memory-mapped datasets, see
+    :func:`map_clks`, so the CLKs are paged in as units need them.
+
+    Gives the same result as
+    :func:`anonlinkclient.candidates.find_candidate_pairs_parallel`.
+
+    :param datasets: A sequence of datasets. Each dataset is a sequence
+        of Bloom filters as bitarrays.
+    :param threshold: The similarity threshold.
+    :param parties: The blocks of every dataset. `None` compares all
+        records.
+    :param workers: Number of processes scoring work units. `None` uses
+        one per core.
+    :param tmp_dir: Directory for the candidate pair files. Defaults to
+        the system's temporary directory.
+    :param tile_size: Records of each dataset per unit without blocks.
+    :param unit_comparisons: Comparisons per unit with blocks.
+    :param spill_pairs: Candidate pairs held in memory before spilling.
+    :param popcounts: The popcounts of every dataset, see
+        :func:`anonlinkclient.candidates.load_popcount_index`. Computed
+        if not given.
+    :param stats: Counts the comparisons and the pruned ones.
+    :param k: If given, every record keeps at most `k` candidates with
+        each other dataset. Every unit and every spilled file keeps only
+        the best candidates of either of their records.
+    :return: The candidate pairs, in the format of :mod:`anonlink`.
+    """
+    if popcounts is None:
+        popcounts = [dataset_popcounts(dataset) for dataset in datasets]
+    if parties is None:
+        units = tile_units(datasets, tile_size)
+    else:
+        units = block_units(parties, unit_comparisons)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+        paths = []
+        buffered = []  # type: List[Tuple[np.ndarray, ...]]
+        buffered_pairs = 0
+        scored = _scored_units(datasets, threshold, units, workers, popcounts, k)
+        for result in scored:
+            if stats is not None:
+                stats.add(result.comparisons, result.pruned)
+            buffered.append(result.candidates)
+            buffered_pairs += len(result.candidates[0])
+            if buffered_pairs >= spill_pairs:
+                paths.append(_spill(buffered, spill_dir, k))
+                buffered, buffered_pairs = [], 0
+        if buffered_pairs:
+            paths.append(_spill(buffered, spill_dir, k))
+        if not paths:
+            return merge_candidates([])
+        return load_sorted_candidates(_merge_files(paths, spill_dir), k)
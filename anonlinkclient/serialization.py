@@ -0,0 +1,460 @@
+import itertools
+import json
+import mmap
+import os
+import struct
+from typing import (
+    IO,
+    BinaryIO,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    overload,
+)
+
+import ijson
+import numpy as np
+from bitarray import bitarray
+from clkhash.serialization import serialize_bitarray
+
+# BINARY CLK FORMAT
+#   A header followed by the packed filters. The header is composed of
+# a magic string (4 bytes), the format version (2 bytes), two bytes of
+# padding, the length of each filter in bits (4 bytes) and the number of
+# filters (8 bytes). All values are unsigned little-endian integers.
+#   Every filter takes exactly `bits / 8` bytes and is stored as
+# `bitarray.tobytes()` of a big-endian bitarray, i.e. the same bytes as
+# the base64 payload in the JSON format. The filters follow the header
+# back to back without any separator.
+#   The number of filters is also implied by the file size. Writers that
+# cannot seek back to the header store UNKNOWN_COUNT instead.
+BINARY_MAGIC = b"CLKB"
+BINARY_VERSION = 1
+UNKNOWN_COUNT = 2**64 - 1
+_HEADER_STRUCT = struct.Struct("<4sH2xIQ")
+
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+_B64_INVALID = 0xFFFF
+
+
+def _b64_pair_table() -> np.ndarray:
+    """Lookup table from two base64 characters to their 12 bit value.
+
+    The index is a pair of characters read as a little-endian uint16. The
+    padding character decodes to zero; its position is checked separately.
+    """
+    sextets = np.full(256, _B64_INVALID, dtype=np.uint32)
+    sextets[np.frombuffer(_B64_ALPHABET, dtype=np.uint8)] = np.arange(64)
+    sextets[ord("=")] = 0
+    pairs = np.arange(2**16, dtype=np.uint32)
+    first, second = sextets[pairs & 0xFF], sextets[pairs >> 8]
+    valid = (first != _B64_INVALID) & (second != _B64_INVALID)
+    return np.where(valid, (first << 6) | second, _B64_INVALID).astype(np.uint16)
+
+
+_B64_PAIR_TABLE = _b64_pair_table()
+_B64_BLOCK_ROWS = 4096
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+DEFAULT_JSON_CHUNK_SIZE = 10000
+
+
+class JsonClkWriter:
+    """Incrementally write CLKs as a JSON document of the form `{"clks": [...]}`.
+
+    Nothing is written before the first CLK. :meth:`close` finishes the
+    document but does not close `clk_f`.
+
+    :param clk_f: A file-like object to write the JSON document to.
+    :param resume_count: The number of CLKs an earlier, interrupted writer
+        has written to `clk_f`. The document is continued from the current
+        position, which must be right after the last of these CLKs.
+    :ivar count: The total number of CLKs in the document.
+    """
+
+    def __init__(self, clk_f: TextIO, resume_count: int = 0):
+        self.clk_f = clk_f
+        self.count = resume_count
+
+    def write(self, clk: bitarray):
+        self.clk_f.write(", " if self.count else '{"clks": [')
+        self.clk_f.write(json.dumps(serialize_bitarray(clk)))
+        self.count += 1
+
+    def close(self) -> int:
+        self.clk_f.write("]}" if self.count else '{"clks": []}')
+        return self.count
+
+
+class BinaryClkWriter:
+    """Incrementally write CLKs in the binary CLK format.
+
+    Nothing is written before the first CLK. If `clk_f` is seekable
+    :meth:`close` patches the number of CLKs into the header. It does not
+    close `clk_f`.
+
+    :param clk_f: A binary file-like object to write to.
+    :param resume_count: The number of CLKs an earlier, interrupted writer
+        has written to `clk_f`. The file must then be opened for reading
+        and writing, start with the header and be positioned right after
+        the last of these CLKs.
+    :ivar count: The total number of CLKs in the file.
+    """
+
+    def __init__(self, clk_f: BinaryIO, resume_count: int = 0):
+        self.clk_f = clk_f
+        self.count = resume_count
+        self.bits = 0
+        self._start = None  # type: Optional[int]
+        if resume_count:
+            end = clk_f.tell()
+            clk_f.seek(0)
+            magic, _, self.bits, _ = _HEADER_STRUCT.unpack(
+                clk_f.read(_HEADER_STRUCT.size)
+            )
+            if magic != BINARY_MAGIC:
+                raise ValueError("Not a binary CLK file")
+            clk_f.seek(end)
+            self._start = 0
+
+    def write(self, clk: bitarray):
+        """Write a CLK.
+
+        :raises ValueError: If the CLK's length differs from the first one
+            or is not a multiple of 8.
+        """
+        if not self.count:
+            self.bits = len(clk)
+            if self.bits % 8:
+                raise ValueError(
+                    "only CLKs whose length is a multiple of 8 bits are "
+                    "supported, got {}".format(self.bits)
+                )
+            self._start = self.clk_f.tell() if self.clk_f.seekable() else None
+            self.clk_f.write(
+                _HEADER_STRUCT.pack(
+                    BINARY_MAGIC, BINARY_VERSION, self.bits, UNKNOWN_COUNT
+                )
+            )
+        elif len(clk) != self.bits:
+            raise ValueError(
+                "inconsistent CLK length: record {} has {} bits, expected {}".format(
+                    self.count, len(clk), self.bits
+                )
+            )
+        self.clk_f.write(clk.tobytes())
+        self.count += 1
+
+    def close(self) -> int:
+        if not self.count:
+            self.clk_f.write(_HEADER_STRUCT.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0))
+        elif self._start is not None:
+            end = self.clk_f.tell()
+            self.clk_f.seek(self._start)
+            self.clk_f.write(
+                _HEADER_STRUCT.pack(BINARY_MAGIC, BINARY_VERSION, self.bits, self.count)
+            )
+            self.clk_f.seek(end)
+        return self.count
+
+
+def dump_clks(clks: Iterable[bitarray], clk_f: TextIO, resume_count: int = 0) -> int:
+    """Write CLKs as a JSON document of the form `{"clks": [...]}`.
+
+    The CLKs are serialized and written one at a time as the iterable
+    produces them, so memory use does not grow with the number of
+    records. The output is identical to
+    `json.dump({"clks": [serialize_bitarray(clk) for clk in clks]}, clk_f)`.
+    Nothing is written before the first CLK is produced, so an error
+    raised by `clks` straight away leaves `clk_f` untouched.
+
+    :param clks: An iterable of Bloom filters as bitarrays.
+    :param clk_f: A file-like object to write the JSON document to.
+    :param resume_count: The number of CLKs an earlier, interrupted call
+        has written to `clk_f`, see :class:`JsonClkWriter`.
+    :return: The total number of CLKs in the document.
+    """
+    writer = JsonClkWriter(clk_f, resume_count)
+    for clk in clks:
+        writer.write(clk)
+    return writer.close()
+
+
+def dump_clks_binary(
+    clks: Iterable[bitarray], clk_f: BinaryIO, resume_count: int = 0
+) -> int:
+    """Write CLKs in the binary CLK format.
+
+    As with :func:`dump_clks` the CLKs are written as they are produced
+    and nothing is written before the first CLK. If `clk_f` is seekable
+    the number of CLKs is patched into the header at the end.
+
+    :param clks: An iterable of Bloom filters as bitarrays. All of them
+        must have the same length, which must be a multiple of 8.
+    :param clk_f: A binary file-like object to write to.
+    :param resume_count: The number of CLKs an earlier, interrupted call
+        has written to `clk_f`, see :class:`BinaryClkWriter`.
+    :raises ValueError: If the CLKs have different or unsupported lengths.
+    :return: The total number of CLKs in the file.
+    """
+    writer = BinaryClkWriter(clk_f, resume_count)
+    for clk in clks:
+        writer.write(clk)
+    return writer.close()
+
+
+def is_binary_clk_file(clk_f) -> bool:
+    """Check whether an opened CLK file is in the binary CLK format.
+
+    The check reads the magic string from the file the object was opened
+    from, so it also works for files that were opened in text mode.
+    Streams without a backing file, such as stdin, are never binary.
+
+    :param clk_f: A file-like object or a path.
+    """
+    path = (
+        clk_f if isinstance(clk_f, (str, os.PathLike)) else getattr(clk_f, "name", None)
+    )
+    if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+class ClkArray(Sequence[bitarray]):
+    """Sequence of CLKs stored in a single contiguous buffer.
+
+    The CLKs are the rows of a two dimensional `uint8` array, one byte per
+    eight bits of a big-endian bitarray. Each item is a bitarray sharing
+    memory with its row, so indexing does not copy any data.
+
+    :ivar array: The `(count, bytes per CLK)` array of the packed CLKs.
+    """
+
+    def __init__(self, array: np.ndarray):
+        if array.ndim != 2 or array.dtype != np.uint8:
+            raise ValueError("CLKs must be a two dimensional array of uint8")
+        self.array = np.ascontiguousarray(array)
+
+    @property
+    def bits(self) -> int:
+        """The length of each CLK in bits."""
+        return self.array.shape[1] * 8
+
+    def __len__(self) -> int:
+        return self.array.shape[0]
+
+    @overload
+    def __getitem__(self, index: int) -> bitarray:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "ClkArray":
+        ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ClkArray(self.array[index])
+        return bitarray(buffer=self.array[index], endian="big")
+
+    def popcounts(self) -> np.ndarray:
+        """Count the bits set in each CLK.
+
+        :return: An array with the popcount of every CLK.
+        """
+        # Count a block of rows at a time to bound the lookup table copy.
+        counts = np.empty(len(self), dtype=np.int64)
+        for start in range(0, len(self), _B64_BLOCK_ROWS):
+            rows = self.array[start : start + _B64_BLOCK_ROWS]
+            counts[start : start + len(rows)] = _POPCOUNT_TABLE[rows].sum(
+                axis=1, dtype=np.int64
+            )
+        return counts
+
+
+def deserialize_filters_bulk(filters: Sequence[str]) -> ClkArray:
+    """Decode a list of base64 encoded CLKs into one contiguous array.
+
+    All the CLKs are decoded at once with vectorized lookups instead of
+    one :func:`base64.b64decode` call per record. Records of different
+    lengths and invalid base64 characters are detected in the same pass.
+
+    Like :func:`base64.decodebytes`, whitespace such as the line breaks of
+    wrapped base64 is ignored.
+
+    :param filters: A sequence of base64 encoded CLKs, as found in the
+        `clks` list of a CLK JSON file.
+    :raises ValueError: If the CLKs do not all have the same length or
+        are not valid base64.
+    :return: The decoded CLKs.
+    """
+    try:
+        return _decode_filters(filters)
+    except ValueError:
+        # Whitespace is rare, so only look for it once decoding failed.
+        stripped = ["".join(f.split()) for f in filters]
+        if stripped == list(filters):
+            raise
+    return _decode_filters(stripped)
+
+
+def _decode_filters(filters: Sequence[str]) -> ClkArray:
+    """Decode base64 encoded CLKs without whitespace, see
+    :func:`deserialize_filters_bulk`."""
+    if not len(filters):
+        return ClkArray(np.empty((0, 0), dtype=np.uint8))
+    try:
+        encoded = np.array(filters, dtype=np.bytes_)
+    except UnicodeEncodeError:
+        raise ValueError("CLKs are not valid base64") from None
+    count, width = len(filters), encoded.dtype.itemsize
+    if width % 4:
+        raise ValueError("CLKs are not valid base64 or have inconsistent lengths")
+    chars = encoded.view(np.uint8).reshape(count, width)
+
+    # numpy pads shorter records with NUL bytes, which are not valid base64
+    # characters. Padding characters must be in the same place in all rows.
+    padding = len(filters[0]) - len(filters[0].rstrip("="))
+    if (
+        padding > 2
+        or not (chars[:, width - padding :] == ord("=")).all()
+        or (chars[:, : width - padding] == ord("=")).any()
+    ):
+        raise ValueError("inconsistent filter length or invalid base64")
+
+    # Every group of four characters is two pairs of 12 bits, i.e. 3 bytes.
+    # Work on blocks of rows so the intermediate arrays stay in cache.
+    pairs = chars.view("<u2").reshape(count, width // 4, 2)
+    decoded = np.empty((count, width // 4, 3), dtype=np.uint8)
+    for start in range(0, count, _B64_BLOCK_ROWS):
+        block = _B64_PAIR_TABLE[pairs[start : start + _B64_BLOCK_ROWS]]
+        if (block == _B64_INVALID).any():
+            raise ValueError("inconsistent filter length or invalid base64")
+        values = (block[:, :, 0].astype(np.uint32) << 12) | block[:, :, 1]
+        out = decoded[start : start + _B64_BLOCK_ROWS]
+        out[:, :, 0] = values >> 16
+        out[:, :, 1] = values >> 8
+        out[:, :, 2] = values
+    decoded = decoded.reshape(count, width // 4 * 3)
+    if padding:
+        decoded = decoded[:, :-padding]
+    return ClkArray(decoded)
+
+
+class _Utf8Reader:
+    """Bytes view of a text file-like object, as ijson reads bytes."""
+
+    def __init__(self, text_f: TextIO):
+        self.text_f = text_f
+
+    def read(self, size: int = -1) -> bytes:
+        return self.text_f.read(size).encode("utf-8")
+
+
+def iter_json_clks(clk_f: IO) -> Iterator[str]:
+    """Iterate over the base64 encoded CLKs of a CLK JSON file.
+
+    The document is parsed incrementally, so only the CLK being yielded
+    is held in memory rather than the whole JSON tree.
+
+    :param clk_f: A text or binary file-like object of the CLK JSON file.
+    :raises ValueError: If the file is not a JSON document with a `clks`
+        list of strings. As the file is parsed lazily, this is raised when
+        the iteration reaches the problem.
+    """
+    reader = _Utf8Reader(clk_f) if isinstance(clk_f.read(0), str) else clk_f
+    found = False
+    try:
+        for prefix, event, value in ijson.parse(reader):
+            if prefix == "clks.item":
+                if event != "string":
+                    raise ValueError("CLKs must be base64 encoded strings")
+                yield value
+            elif prefix == "clks" and event == "start_array":
+                found = True
+    except ijson.JSONError as e:
+        raise ValueError("Invalid CLK JSON file: {}".format(e)) from e
+    if not found:
+        raise ValueError("Invalid CLK JSON file: no clks list")
+
+
+def load_json_clks(clk_f: IO, chunk_size: int = DEFAULT_JSON_CHUNK_SIZE) -> ClkArray:
+    """Read and decode the CLKs of a CLK JSON file.
+
+    The CLKs are parsed incrementally and decoded `chunk_size` at a time
+    with :func:`deserialize_filters_bulk`, so the peak memory use is that
+    of the decoded CLKs rather than that of the JSON document.
+
+    :param clk_f: A text or binary file-like object of the CLK JSON file.
+    :param chunk_size: The number of CLKs decoded at once.
+    :raises ValueError: If the file is not a valid CLK JSON file or the
+        CLKs have different lengths.
+    :return: The decoded CLKs.
+    """
+    arrays = []
+    clks = iter_json_clks(clk_f)
+    while True:
+        chunk = list(itertools.islice(clks, chunk_size))
+        if not chunk:
+            break
+        array = deserialize_filters_bulk(chunk).array
+        if arrays and array.shape[1] != arrays[0].shape[1]:
+            raise ValueError("inconsistent filter length or invalid base64")
+        arrays.append(array)
+    if not arrays:
+        return ClkArray(np.empty((0, 0), dtype=np.uint8))
+    if len(arrays) == 1:
+        return ClkArray(arrays[0])
+    return ClkArray(np.concatenate(arrays))
+
+
+class MappedClks(ClkArray):
+    """Read-only sequence of the CLKs stored in a binary CLK file.
+
+    The file is memory-mapped, so opening it costs next to nothing and the
+    operating system pages in the filters as they are accessed. The
+    underlying array and each item share memory with the mapping.
+    Pickling it only pickles the path, the file is mapped again when it
+    is unpickled, e.g. in the worker processes of a process pool.
+
+    :ivar path: The path of the binary CLK file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(_HEADER_STRUCT.size)
+            if len(header) != _HEADER_STRUCT.size:
+                raise ValueError("Invalid binary CLK file: truncated header")
+            magic, version, bits, count = _HEADER_STRUCT.unpack(header)
+            if magic != BINARY_MAGIC:
+                raise ValueError("Not a binary CLK file")
+            if version != BINARY_VERSION:
+                raise ValueError(
+                    "Unsupported binary CLK file version {}".format(version)
+                )
+            size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        bytes_per_clk = bits // 8
+        payload = size - _HEADER_STRUCT.size
+        if bytes_per_clk:
+            actual_count, remainder = divmod(payload, bytes_per_clk)
+        else:
+            actual_count, remainder = 0, payload
+        if remainder or count not in (actual_count, UNKNOWN_COUNT):
+            raise ValueError(
+                "Invalid binary CLK file: expected {} CLKs of {} bits but "
+                "file has {} bytes of data".format(count, bits, payload)
+            )
+        array = np.frombuffer(
+            self._mmap,
+            dtype=np.uint8,
+            count=actual_count * bytes_per_clk,
+            offset=_HEADER_STRUCT.size,
+        )
+        super().__init__(array.reshape(actual_count, bytes_per_clk))
+
+    def __reduce__(self):
+        return MappedClks, (self.path,)
@@ -0,0 +1,260 @@
+import concurrent.futures
+import copy
+import hashlib
+import heapq
+import itertools
+from collections import defaultdict
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from .blocking import (
+    BlockStats,
+    blocks_to_csr,
+    compute_block_stats,
+    generate_candidate_blocks_streaming,
+    read_row_chunks,
+)
+
+DEFAULT_SAMPLE_SIZE = 10000
+DEFAULT_TARGET_RECALL = 0.95
+
+
+class Sample(NamedTuple):
+    """A sample of the records of one party.
+
+    :ivar header: The column names, or `None` without a header.
+    :ivar rows: The sampled rows, in the order of the file.
+    :ivar entity_ids: The entity of every sampled row, if known.
+    """
+
+    header: Optional[List[str]]
+    rows: List[Tuple[str, ...]]
+    entity_ids: Optional[List[str]]
+
+
+class TuningResult(NamedTuple):
+    """The outcome of blocking the samples with one configuration.
+
+    :ivar config: The blocking configuration.
+    :ivar stats: The comparison cost of the blocks, `None` on error.
+    :ivar recall: The fraction of the true matches sharing a block, or
+        `None` without ground truth.
+    :ivar error: Why the configuration could not be used, if it failed.
+    """
+
+    config: Dict[str, Any]
+    stats: Optional[BlockStats]
+    recall: Optional[float]
+    error: Optional[str]
+
+
+def _priority(value: str, seed: int) -> int:
+    digest = hashlib.blake2b(
+        value.encode(), digest_size=8, key=str(seed).encode()
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+def sample_rows(
+    input_f: TextIO,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    header: bool = True,
+    entity_id_column: Optional[Union[int, str]] = None,
+    seed: int = 0,
+) -> Sample:
+    """Sample rows of a CSV file in one pass.
+
+    The rows with the smallest hashes are kept. With an entity id column
+    the hash is that of the entity id, so the samples of different parties
+    contain the same entities and their true matches can be counted.
+    Otherwise the row number is hashed, which is a uniform sample.
+
+    :param input_f: A file-like object of csv data.
+    :param sample_size: The number of rows to sample.
+    :param header: Set to `False` if the CSV file does not have a header.
+    :param entity_id_column: The name or index of a column identifying
+        the entity of every row.
+    :param seed: Seed of the hash.
+    :return: The sample.
+    """
+    column_names, chunks = read_row_chunks(input_f, header)
+    if isinstance(entity_id_column, str):
+        if column_names is None or entity_id_column not in column_names:
+            raise ValueError("Unknown entity id column {}".format(entity_id_column))
+        entity_id_column = column_names.index(entity_id_column)
+
+    rows = enumerate(itertools.chain.from_iterable(chunks))
+    if entity_id_column is None:
+        prioritized = ((_priority(str(i), seed), i, row) for i, row in rows)
+    else:
+        prioritized = (
+            (_priority(row[entity_id_column], seed), i, row) for i, row in rows
+        )
+    sampled = sorted(heapq.nsmallest(sample_size, prioritized), key=lambda x: x[1])
+    sampled_rows = [row for _, _, row in sampled]
+    entity_ids = None
+    if entity_id_column is not None:
+        entity_ids = [row[entity_id_column] for row in sampled_rows]
+    return Sample(column_names, sampled_rows, entity_ids)
+
+
+def expand_grid(
+    blocking_config: Dict[str, Any], grid: Sequence[Tuple[str, Sequence[Any]]]
+) -> List[Dict[str, Any]]:
+    """All the combinations of the values of a parameter grid.
+
+    :param blocking_config: The blocking configuration to start from.
+    :param grid: Pairs of a parameter of the `config` section, with dots
+        separating nested keys, e.g. `filter.max`, and its values.
+    :return: One blocking configuration per combination of values.
+    """
+    configs = []
+    names = [name for name, _ in grid]
+    for values in itertools.product(*(values for _, values in grid)):
+        config = copy.deepcopy(blocking_config)
+        for name, value in zip(names, values):
+            *parents, key = name.split(".")
+            section = config["config"]
+            for parent in parents:
+                section = section.setdefault(parent, {})
+            section[key] = value
+        configs.append(config)
+    return configs
+
+
+def count_recall(
+    parties_blocks: Sequence[Dict[int, List[int]]],
+    entity_ids: Sequence[Sequence[str]],
+) -> Optional[float]:
+    """The fraction of the true matches between parties sharing a block.
+
+    :param parties_blocks: For every party, the block ids of every record.
+    :param entity_ids: For every party, the entity of every record.
+    :return: The recall, or `None` if there are no true matches.
+    """
+    matches = found = 0
+    records_by_entity = []
+    for ids in entity_ids:
+        by_entity = defaultdict(list)  # type: Dict[str, List[int]]
+        for rec, entity in enumerate(ids):
+            by_entity[entity].append(rec)
+        records_by_entity.append(by_entity)
+    for i, j in itertools.combinations(range(len(entity_ids)), 2):
+        for entity, records_i in records_by_entity[i].items():
+            for rec_i in records_i:
+                blocks_i = set(parties_blocks[i][rec_i])
+                for rec_j in records_by_entity[j].get(entity, ()):
+                    matches += 1
+                    if not blocks_i.isdisjoint(parties_blocks[j][rec_j]):
+                        found += 1
+    return found / matches if matches else None
+
+
+def evaluate_blocking_config(
+    blocking_config: Dict[str, Any], samples: Sequence[Sample]
+) -> TuningResult:
+    """Block the samples of all parties with one configuration.
+
+    Records are identified by their position in the sample, so a record
+    id column of the configuration is ignored.
+
+    :param blocking_config: The blocking configuration.
+    :param samples: The sample of every party.
+    :return: The result.
+    """
+    config = copy.deepcopy(blocking_config)
+    config["config"].pop("record-id-col", None)
+    try:
+        parties = []
+        for sample in samples:
+            blocking_obj, count = generate_candidate_blocks_streaming(
+                [sample.rows], config, header=sample.header
+            )
+            parties.append(blocks_to_csr(blocking_obj.blocks, count))
+    except (ValueError, AssertionError) as e:
+        return TuningResult(blocking_config, None, None, str(e) or repr(e))
+    stats = compute_block_stats(parties, largest=1)
+
+    recall = None
+    if all(sample.entity_ids is not None for sample in samples):
+        key_ids = {}  # type: Dict[bytes, int]
+        recall = count_recall(
+            [csr.record_to_blocks(key_ids) for csr in parties],
+            [sample.entity_ids for sample in samples],  # type: ignore
+        )
+    return TuningResult(blocking_config, stats, recall, None)
+
+
+_worker_samples = None  # type: Optional[Sequence[Sample]]
+
+
+def _init_worker(samples: Sequence[Sample]):
+    global _worker_samples
+    _worker_samples = samples
+
+
+def _evaluate_in_worker(blocking_config: Dict[str, Any]) -> TuningResult:
+    assert _worker_samples is not None
+    return evaluate_blocking_config(blocking_config, _worker_samples)
+
+
+def evaluate_blocking_configs(
+    configs: Iterable[Dict[str, Any]],
+    samples: Sequence[Sample],
+    workers: Optional[int] = 1,
+) -> List[TuningResult]:
+    """Evaluate blocking configurations on samples of the parties' data.
+
+    :param configs: The blocking configurations to try.
+    :param samples: The sample of every party.
+    :param workers: Number of processes evaluating configurations. `None`
+        uses one per core.
+    :return: The result of every configuration, in order.
+    """
+    if workers == 1:
+        return [evaluate_blocking_config(config, samples) for config in configs]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(samples,)
+    ) as executor:
+        return list(executor.map(_evaluate_in_worker, configs))
+
+
+def recommend(
+    results: Sequence[TuningResult], target_recall: float = DEFAULT_TARGET_RECALL
+) -> Tuple[Optional[TuningResult], bool]:
+    """Choose the configuration with the fewest comparisons.
+
+    With ground truth, only configurations reaching `target_recall` are
+    considered; if there are none, the one with the highest recall is
+    chosen. Without ground truth, only configurations putting every
+    record in a block are considered; if there are none, all of them are
+    and the target is not met.
+
+    :param results: The results of the configurations.
+    :param target_recall: The recall to reach.
+    :return: The recommended result, `None` if no configuration worked,
+        and whether it meets the target.
+    """
+    usable = [r for r in results if r.stats is not None]
+    if not usable:
+        return None, False
+    if all(r.recall is not None for r in usable):
+        good = [r for r in usable if r.recall >= target_recall]  # type: ignore
+        if not good:
+            return max(usable, key=lambda r: (r.recall, -r.stats.comparisons)), False
+    else:
+        good = [r for r in usable if not any(r.stats.unblocked_counts)]
+        if not good:
+            return min(usable, key=lambda r: r.stats.comparisons), False
+    best = min(good, key=lambda r: (r.stats.comparisons, -(r.recall or 0)))
+    return best, True
@@ -1,17 +1,66 @@
 import base64
 import csv
 import io
+import itertools
 import json
 import logging
+import os
 import time
-from collections import defaultdict
-from typing import TextIO, Any, List, Dict
+from typing import (
+    IO,
+    BinaryIO,
+    TextIO,
+    Any,
+    AnyStr,
+    Iterable,
+    List,
+    Dict,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import numpy as np
 from bitarray import bitarray
 from blocklib import generate_candidate_blocks
+from blocklib.candidate_blocks_generator import CandidateBlockingResult
+from blocklib.validation import validate_blocking_schema
+from clkhash.schema import Schema
+from clkhash.serialization import serialize_bitarray
+from clkhash.validate_data import validate_header
 from pydantic import BaseModel
-from anonlink.candidate_generation import find_candidate_pairs
 from anonlink.solving import probabilistic_greedy_solve
-from anonlink.similarities import dice_coefficient
+
+from .blocking import (
+    DEFAULT_BLOCKING_CHUNK_SIZE,
+    CsrBlocks,
+    blocks_to_csr,
+    cap_block_sizes,
+    chunked,
+    dump_blocks,
+    dump_blocking_state,
+    dump_blocks_binary,
+    generate_candidate_blocks_streaming,
+    load_blocks,
+    read_row_chunks,
+    record_blocks,
+)
+from .candidates import (
+    CandidatePairs,
+    ComparisonStats,
+    filter_candidates,
+    find_candidate_pairs_parallel,
+)
+from .compression import uncompressed_name
+from .outofcore import find_candidate_pairs_out_of_core, map_clks
+from .encoding import DEFAULT_CHUNK_SIZE, read_csv_chunks, stream_clks_from_chunks
+from .serialization import (
+    ClkArray,
+    MappedClks,
+    is_binary_clk_file,
+    iter_json_clks,
+    load_json_clks,
+)
 
 log = logging.getLogger("anonlink")
 
@@ -31,8 +80,57 @@ def deserialize_filters(filters):
     return res
 
 
+def load_clks(clk_f: TextIO) -> ClkArray:
+    """Load CLKs from a JSON or a binary CLK file.
+
+    Binary CLK files are memory-mapped rather than read, see
+    :class:`anonlinkclient.serialization.MappedClks`. The CLKs of a JSON
+    file are parsed incrementally and decoded into a single buffer, see
+    :func:`anonlinkclient.serialization.load_json_clks`.
+
+    :param clk_f: A file-like object of the CLK file.
+    :return: A sequence of Bloom filters as bitarrays.
+    """
+    if is_binary_clk_file(clk_f):
+        return MappedClks(clk_f.name)
+    return load_json_clks(clk_f)
+
+
+def generate_candidate_blocks_from_clks(
+    clks: Sequence[bitarray], blocking_config: Dict
+) -> CandidateBlockingResult:
+    """Generate lambda-fold candidate blocks from decoded CLKs.
+
+    This gives the same blocks as passing the serialized CLKs to
+    :func:`blocklib.generate_candidate_blocks`, but works directly on
+    bitarrays, e.g. the ones of a binary CLK file.
+
+    :param clks: A sequence of Bloom filters as bitarrays.
+    :param blocking_config: A lambda-fold blocking configuration with
+        `input-clks` set.
+    :return: The candidate blocking result.
+    """
+    blocking_model = validate_blocking_schema(blocking_config)
+    if (
+        blocking_model.type.value != "lambda-fold"
+        or not blocking_model.config.block_encodings
+    ):
+        raise ValueError(
+            "Blocking CLKs requires a lambda-fold configuration with input-clks set"
+        )
+    if blocking_model.config.record_id_column is not None:
+        raise ValueError("A record id column is not supported when blocking CLKs")
+    blocking_obj, _ = generate_candidate_blocks_streaming([clks], blocking_config)
+    return blocking_obj
+
+
 def generate_candidate_blocks_from_csv(
-    input_f: TextIO, schema_f: TextIO, header: bool = True, verbose: bool = False
+    input_f: TextIO,
+    schema_f: TextIO,
+    header: bool = True,
+    verbose: bool = False,
+    chunk_size: int = DEFAULT_BLOCKING_CHUNK_SIZE,
+    workers: Optional[int] = 1,
 ):
     """Generate candidate blocks from CSV file
 
@@ -46,63 +144,211 @@ def generate_candidate_blocks_from_csv(
         a header. Set to `'ignore'` if the CSV file does have a
         header but it should not be checked against the schema.
     :param verbose: enables output of extra information, i.e.: the stats for the individual PSig strategies.
+    :param chunk_size: Number of CSV rows blocked at a time.
+    :param workers: Number of worker processes computing block keys.
+        `None` uses one per core.
     :return: A dictionary of blocks, state and config
     """
+    blocking_config = load_blocking_config(schema_f)
+    blocking_obj, record_count = _block_input(
+        input_f, blocking_config, header, chunk_size, workers
+    )
+    return blocking_result_to_dict(
+        blocking_obj, blocking_config, record_count, verbose=verbose
+    )
+
+
+def write_candidate_blocks_from_csv(
+    input_f: TextIO,
+    schema_f: TextIO,
+    block_f: IO,
+    header: bool = True,
+    verbose: bool = False,
+    chunk_size: int = DEFAULT_BLOCKING_CHUNK_SIZE,
+    workers: Optional[int] = 1,
+    output_format: str = "json",
+    max_block_size: Optional[int] = None,
+    state_f: Optional[BinaryIO] = None,
+):
+    """Generate candidate blocks from CSV file and write them to a file.
+
+    Writes the JSON document returned by
+    :func:`generate_candidate_blocks_from_csv`, but the records to blocks
+    map is serialized as it is produced instead of being built in memory
+    first. Together with reading the CSV file in chunks, the memory used
+    depends on the size of the block index, not on the size of the PII.
+
+    :param input_f: A file-like object of csv data or CLKs to block.
+    :param schema_f: Schema specifying the blocking configuration
+    :param block_f: A file-like object to write the blocks to, opened in
+        binary mode for the binary output format.
+    :param header: Set to `False` if the CSV file does not have
+        a header.
+    :param verbose: enables output of extra information, i.e.: the stats for the individual PSig strategies.
+    :param chunk_size: Number of CSV rows blocked at a time.
+    :param workers: Number of worker processes computing block keys.
+        `None` uses one per core.
+    :param output_format: `"json"` for the JSON block file, `"binary"`
+        for the compact binary block file, see
+        :func:`anonlinkclient.blocking.dump_blocks_binary`.
+    :param max_block_size: Subsample blocks with more records, see
+        :func:`anonlinkclient.blocking.cap_block_sizes`.
+    :param state_f: A binary file-like object to write the blocking state
+        to instead of embedding it in the metadata, see
+        :func:`anonlinkclient.blocking.dump_blocking_state`. The metadata
+        refers to the file by its name and digest.
+    """
+    if output_format not in {"json", "binary"}:
+        raise ValueError("Unknown output format {}".format(output_format))
+    blocking_config = load_blocking_config(schema_f)
+    if (
+        output_format == "binary"
+        and blocking_config.get("config", {}).get("record-id-col") is not None
+    ):
+        raise ValueError(
+            "The binary block format identifies records by their number, "
+            "it does not support a record id column"
+        )
+    blocking_obj, record_count = _block_input(
+        input_f, blocking_config, header, chunk_size, workers
+    )
+    meta = blocking_meta(blocking_obj, blocking_config, record_count)
+    if state_f is not None:
+        digest = dump_blocking_state(meta.pop("state"), state_f)
+        meta["state_file"] = {
+            "name": _relative_path(state_f.name, getattr(block_f, "name", None)),
+            "sha256": digest,
+        }
+    if verbose:
+        blocking_obj.print_summary_statistics()
+    blocks = blocking_obj.blocks
+    if max_block_size is not None:
+        blocks, report = cap_block_sizes(blocks, max_block_size)
+        meta["large_blocks"] = report._asdict()
+        log.info(
+            "Subsampled {} blocks with more than {} records".format(
+                report.block_count, max_block_size
+            )
+        )
+    if output_format == "binary":
+        dump_blocks_binary(blocks_to_csr(blocks, record_count), meta, block_f)
+    else:
+        dump_blocks(record_blocks(blocks), meta, block_f)
+
+
+def _relative_path(path: str, block_path: Optional[str]) -> str:
+    """The path of a file relative to the directory of the block file.
+
+    The absolute path is used if there is no such relative path, e.g. for
+    files on different drives on Windows.
+    """
+    if not isinstance(block_path, str) or block_path in {"-", "<stdout>"}:
+        return os.path.abspath(path)
+    block_dir = os.path.dirname(os.path.abspath(block_path))
+    try:
+        return os.path.relpath(os.path.abspath(path), block_dir)
+    except ValueError:
+        return os.path.abspath(path)
+
+
+def _block_input(
+    input_f: TextIO,
+    blocking_config: Dict,
+    header: bool,
+    chunk_size: int,
+    workers: Optional[int],
+) -> Tuple[CandidateBlockingResult, int]:
     if header not in {False, True, "ignore"}:
         raise ValueError(
             "header must be False, True or 'ignore' but is {!s}.".format(header)
         )
 
     log.info("Hashing data")
-
-    # read blocking config as a dictionary
     start_time = time.time()
-    try:
-        blocking_config = json.load(schema_f)
-    except ValueError as e:
-        msg = "The schema is not a valid JSON file"
-        raise ValueError(msg) from e
 
     blocking_method = blocking_config["type"]
-    suffix_input = input_f.name.split(".")[-1]
+    suffix_input = uncompressed_name(input_f.name).split(".")[-1]
 
-    pii_data = []  # type: List[Any]
-    headers = None
+    is_binary_input = is_binary_clk_file(input_f)
     # read from clks
     if blocking_method == "lambda-fold" and blocking_config["config"]["input-clks"]:
-        try:
-            pii_data = json.load(input_f)["clks"]
-        except ValueError:  # since JSONDecodeError is inherited from ValueError
-            raise TypeError(f"Upload should be CLKs not {suffix_input.upper()} file")
+        if is_binary_input:
+            chunks = chunked(MappedClks(input_f.name), chunk_size)
+        else:
+            json_clks = iter_json_clks(input_f)
+            try:
+                first_chunk = list(itertools.islice(json_clks, chunk_size))
+            except ValueError:
+                raise TypeError(
+                    f"Upload should be CLKs not {suffix_input.upper()} file"
+                )
+            chunks = itertools.chain([first_chunk], chunked(json_clks, chunk_size))
+        blocking_obj, record_count = generate_candidate_blocks_streaming(
+            chunks, blocking_config, workers=workers
+        )
 
     # read from CSV file
     else:
         # sentinel check for input
-        if suffix_input == "json":
+        if suffix_input == "json" or is_binary_input:
             raise TypeError(f"Upload should be CSVs not CLKs")
-        else:
-            reader = csv.reader(input_f)
-            if header:
-                headers = next(reader)
-            for line in reader:
-                pii_data.append(tuple(element.strip() for element in line))
-
-    # generate candidate blocks
-    blocking_obj = generate_candidate_blocks(pii_data, blocking_config, header=headers)
+        headers, chunks = read_row_chunks(input_f, bool(header), chunk_size)
+        blocking_obj, record_count = generate_candidate_blocks_streaming(
+            chunks, blocking_config, header=headers, workers=workers
+        )
     log.info("Blocking took {:.2f} seconds".format(time.time() - start_time))
+    return blocking_obj, record_count
 
-    # save results to dictionary
-    # step1 - get blocks (need to convert numpy.int64 to normal int
-    blocks = blocking_obj.blocks
 
-    # make encoding to blocks map
-    encoding_to_blocks_map = defaultdict(list)
-    for block_id, indices in blocks.items():
-        for ind in indices:
-            encoding_to_blocks_map[ind].append(block_id)
+def load_blocking_config(schema_f: TextIO) -> Dict:
+    """Read a blocking configuration from a JSON file.
+
+    :param schema_f: A file-like object of the blocking configuration.
+    :raises ValueError: If the file is not valid JSON.
+    :return: The blocking configuration as a dictionary.
+    """
+    try:
+        return json.load(schema_f)
+    except ValueError as e:
+        msg = "The schema is not a valid JSON file"
+        raise ValueError(msg) from e
+
+
+def blocking_result_to_dict(
+    blocking_obj: CandidateBlockingResult,
+    blocking_config: Dict,
+    record_count: int,
+    verbose: bool = False,
+) -> Dict[str, Any]:
+    """Convert a candidate blocking result to the JSON output of `block`.
+
+    :param blocking_obj: The result of the blocking.
+    :param blocking_config: The blocking configuration.
+    :param record_count: The number of records that were blocked.
+    :param verbose: Print blocking statistics.
+    :return: A dictionary of blocks, state and config
+    """
+    # save results to dictionary
+    # step1 - make encoding to blocks map
     result = {}  # type: Dict[str, Any]
-    result["blocks"] = encoding_to_blocks_map
+    result["blocks"] = dict(record_blocks(blocking_obj.blocks))
+    result["meta"] = blocking_meta(blocking_obj, blocking_config, record_count)
+
+    if verbose:
+        blocking_obj.print_summary_statistics()
+    return result
+
 
+def blocking_meta(
+    blocking_obj: CandidateBlockingResult, blocking_config: Dict, record_count: int
+) -> Dict[str, Any]:
+    """The metadata written with the blocks by `block`.
+
+    :param blocking_obj: The result of the blocking.
+    :param blocking_config: The blocking configuration.
+    :param record_count: The number of records that were blocked.
+    :return: A dictionary of the blocking state, config, source and stats.
+    """
     # step2 - get all member variables in blocking state
     block_state_vars = {}  # type: Dict[str, Any]
     state = blocking_obj.state
@@ -120,49 +366,249 @@ def generate_candidate_blocks_from_csv(
             value = getattr(state, name)
             block_state_vars[name] = base_model_to_dict(value)
 
-    result["meta"] = {}  # type: Dict[str, Any]
-    result["meta"]["state"] = block_state_vars
+    meta = {}  # type: Dict[str, Any]
+    meta["state"] = block_state_vars
 
     # step3 - get config meta data
-    result["meta"]["config"] = blocking_config
+    meta["config"] = blocking_config
 
     # step4 - add CLK counts and blocking statistics to metadata
-    result["meta"]["source"] = {"clk_count": [len(pii_data)]}
-    result["meta"]["stats"] = blocking_obj.stats
+    meta["source"] = {"clk_count": [record_count]}
+    meta["stats"] = blocking_obj.stats
+    return meta
+
+
+def encode_and_block_csv(
+    input_f: Union[TextIO, Iterable[str]],
+    secret: AnyStr,
+    schema: Schema,
+    blocking_config: Dict,
+    clk_writer,
+    header: Union[bool, str] = True,
+    validate: bool = True,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress_bar: bool = False,
+    verbose: bool = False,
+) -> Dict[str, Any]:
+    """Encode and block a CSV file of PII, parsing it only once.
+
+    The rows are hashed as in :func:`anonlinkclient.encoding.stream_clks_from_csv`
+    and every CLK is handed to `clk_writer` as soon as it is produced.
+    Lambda-fold blocking with `input-clks` works directly on the in-memory
+    bitarrays, other blocking methods on the parsed rows. Either way the
+    data doesn't have to be serialized and read again.
 
-    if verbose:
-        blocking_obj.print_summary_statistics()
-    return result
+    :param input_f: A file-like object of csv data to encode.
+    :param secret: The secret used to derive the hashing keys.
+    :param schema: Schema specifying the record formats and hashing
+        settings.
+    :param blocking_config: The blocking configuration.
+    :param clk_writer: An object with a `write(clk)` method, e.g. a
+        :class:`anonlinkclient.serialization.JsonClkWriter`.
+    :param header: Set to `False` if the CSV file does not have
+        a header. Set to `'ignore'` if the CSV file does have a
+        header but it should not be checked against the schema.
+    :param validate: Set to `False` to disable validation of
+        data against the schema.
+    :param workers: Number of worker processes used for hashing.
+    :param chunk_size: Number of rows hashed per task.
+    :param progress_bar: Set to `True` to show a progress bar.
+    :param verbose: Print blocking statistics.
+    :return: A dictionary of blocks, state and config, as for
+        :func:`generate_candidate_blocks_from_csv`.
+    """
+    if header not in {False, True, "ignore"}:
+        raise ValueError(
+            "header must be False, True or 'ignore' but is {!s}.".format(header)
+        )
+    block_clks = (
+        blocking_config["type"] == "lambda-fold"
+        and blocking_config["config"]["input-clks"]
+    )
+
+    lines = iter(input_f)
+    column_names = None
+    if header:
+        column_names = next(csv.reader(lines))
+        if header != "ignore":
+            validate_header(schema.fields, column_names)
+    chunks = read_csv_chunks(lines, schema, validate, False, chunk_size)
+
+    pii_data = []  # type: List[Any]
+
+    def keep_rows(chunks):
+        for chunk in chunks:
+            pii_data.extend(chunk)
+            yield chunk
+
+    clks = stream_clks_from_chunks(
+        chunks if block_clks else keep_rows(chunks),
+        secret,
+        schema,
+        progress_bar=progress_bar,
+        workers=workers,
+    )
+    for clk in clks:
+        clk_writer.write(clk)
+        if block_clks:
+            pii_data.append(clk)
+
+    start_time = time.time()
+    if block_clks:
+        blocking_obj = generate_candidate_blocks_from_clks(pii_data, blocking_config)
+    else:
+        blocking_obj = generate_candidate_blocks(
+            pii_data, blocking_config, header=column_names
+        )
+    log.info("Blocking took {:.2f} seconds".format(time.time() - start_time))
+    return blocking_result_to_dict(
+        blocking_obj, blocking_config, len(pii_data), verbose=verbose
+    )
+
+
+def join_clks_blocks(
+    files: Iterable[Tuple[IO, IO]], tmp_dir: Optional[str] = None
+) -> Tuple[List[ClkArray], List[CsrBlocks]]:
+    """Load the CLKs and blocks of every party.
+
+    The CLKs are decoded and the blocks are read into arrays directly from
+    the files, without building an intermediate JSON document. Pass the
+    blocks to :func:`solver_blocks` to get the blocking input of
+    :func:`solve`.
+
+    :param files: Pairs of a CLK file and a block file, one per party.
+        Both can be in the JSON or the binary format.
+    :param tmp_dir: Memory-map the CLKs instead of reading them, see
+        :func:`anonlinkclient.outofcore.map_clks`, which converts JSON CLK
+        files to binary ones in this directory.
+    :raises ValueError: If a file is invalid or the blocks of a party are
+        not for the same number of records as its CLKs.
+    :return: The CLKs and the blocks of every party.
+    """
+    clk_groups = []
+    parties = []
+    for clk_f, block_f in files:
+        if tmp_dir is None:
+            clk_groups.append(load_clks(clk_f))
+        else:
+            clk_groups.append(map_clks(clk_f, tmp_dir))
+        parties.append(load_blocks(block_f, len(clk_groups[-1])))
+    return clk_groups, parties
+
+
+def solver_blocks(parties: Sequence[CsrBlocks]) -> Dict[int, Dict[int, List[int]]]:
+    """The records to blocks maps of all parties, as taken by :func:`solve`.
+
+    The block keys of all parties are mapped to the same integer ids,
+    which are cheaper to hash and compare than the keys.
+
+    :param parties: The blocks of every party.
+    :return: For every party, the block ids of every record.
+    """
+    key_ids = {}  # type: Dict[bytes, int]
+    return {i: blocks.record_to_blocks(key_ids) for i, blocks in enumerate(parties)}
 
 
 def combine_clks_blocks(clk_f: TextIO, block_f: TextIO):
     """Combine CLKs and blocks to produce a json stream of clknblocks.
     That's a list of lists, containing a CLK and its corresponding block IDs.
 
+    Kept for compatibility, :func:`join_clks_blocks` returns the same
+    data decoded and without serializing it.
+
     Example output:
         {'clknblocks': [['UG9vcA==', '001', '211'],
                         [...]]}
     """
     try:
-        blocks = json.load(block_f)["blocks"]
-        clks = json.load(clk_f)["clks"]
+        (clks,), (blocks,) = join_clks_blocks([(clk_f, block_f)])
     except ValueError as e:
         msg = "Invalid CLKs or Blocks"
         raise ValueError(msg) from e
 
-    clknblocks = [[clk] for clk in clks]
-
-    for rec_id, block_ids in blocks.items():
-        rec_id = int(rec_id)
-        for block_key in block_ids:
-            clknblocks[rec_id].append(block_key)
+    keys = [key.decode() for key in blocks.block_keys.tolist()]
     out_stream = io.StringIO()
-    json.dump({"clknblocks": clknblocks}, out_stream)
+    out_stream.write('{"clknblocks": [')
+    for rec_id, clk in enumerate(clks):
+        if rec_id:
+            out_stream.write(", ")
+        block_ids = blocks.block_ids[
+            blocks.offsets[rec_id] : blocks.offsets[rec_id + 1]
+        ]
+        json.dump(
+            [serialize_bitarray(clk)] + [keys[b] for b in block_ids.tolist()],
+            out_stream,
+        )
+    out_stream.write("]}")
     out_stream.seek(0)
     return out_stream
 
 
-def solve(encodings, rec_to_blocks, threshold: float = 0.8, blocking: bool = False):
+def find_candidates(
+    encodings,
+    rec_to_blocks,
+    threshold: float = 0.8,
+    blocking: bool = False,
+    workers: Optional[int] = 1,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+) -> CandidatePairs:
+    """Find the candidate pairs that :func:`solve` solves.
+
+    Takes the same parameters as :func:`solve`.
+
+    :return: The candidate pairs, in the format of :mod:`anonlink`.
+    """
+    return find_candidate_pairs_parallel(
+        encodings,
+        threshold,
+        rec_to_blocks=rec_to_blocks if blocking else None,
+        workers=workers,
+        popcounts=popcounts,
+        stats=stats,
+        k=k,
+    )
+
+
+def solve_candidates(
+    candidate_pairs: CandidatePairs,
+    threshold: Optional[float] = None,
+    merge_threshold: float = 1.0,
+):
+    """Solve candidate pairs, optionally at a higher threshold.
+
+    Candidate pairs found once at a low threshold can be solved at several
+    higher thresholds, without comparing the records again.
+
+    :param candidate_pairs: The candidate pairs, in the format of
+        :mod:`anonlink`.
+    :param threshold: Only solve the candidate pairs with at least this
+        similarity. `None` solves all of them.
+    :param merge_threshold: The proportion of candidate pairs between two
+        groups of records required to merge them, see
+        :func:`anonlink.solving.probabilistic_greedy_solve`. `1.0` only
+        matches records that are candidate pairs.
+    :return: same as :func:`solve`.
+    """
+    if threshold is not None:
+        candidate_pairs = filter_candidates(candidate_pairs, threshold)
+    # Need to use the probabilistic greedy solver to be able to remove the duplicate. It is not configurable
+    # with the native greedy solver.
+    return probabilistic_greedy_solve(candidate_pairs, merge_threshold=merge_threshold)
+
+
+def solve(
+    encodings,
+    rec_to_blocks,
+    threshold: float = 0.8,
+    blocking: bool = False,
+    workers: Optional[int] = 1,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+):
     """entity resolution, baby
 
     calls anonlink to do the heavy lifting.
@@ -171,22 +617,94 @@ def solve(encodings, rec_to_blocks, threshold: float = 0.8, blocking: bool = Fal
     :param rec_to_blocks: a sequence of dictionaries, mapping a record id to the list of blocks it is part of. Again,
                           one per data provider, same order as encodings.
     :param threshold: similarity threshold for solving
+    :param workers: Number of processes comparing the records, see
+        :func:`anonlinkclient.candidates.find_candidate_pairs_parallel`.
+        `None` uses one per core.
+    :param popcounts: The popcounts of every data provider's Bloom
+        filters, used to skip pairs that can't reach the threshold.
+        Computed if not given.
+    :param stats: Counts the comparisons and the pruned ones.
+    :param k: If given, a pair is only a candidate if each of its records
+        is among the `k` most similar partners of the other, so every
+        record has at most `k` candidates with each other data provider,
+        see :func:`anonlinkclient.candidates.top_k_candidates`.
     :return: same as the anonlink solver.
              An sequence of groups. Each group is an sequence of
              records. Two records are in the same group iff they represent
              the same entity. Here, a record is a two-tuple of dataset index
              and record index.
     """
+    return solve_candidates(
+        find_candidates(
+            encodings,
+            rec_to_blocks,
+            threshold,
+            blocking,
+            workers,
+            popcounts,
+            stats,
+            k,
+        )
+    )
+
+
+def find_candidates_out_of_core(
+    encodings,
+    parties: Optional[Sequence[CsrBlocks]],
+    threshold: float = 0.8,
+    workers: Optional[int] = 1,
+    tmp_dir: Optional[str] = None,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+) -> CandidatePairs:
+    """Find the candidate pairs that :func:`solve_out_of_core` solves.
 
-    def my_blocking_f(ds_idx, rec_idx, _):
-        return rec_to_blocks[ds_idx][rec_idx]
+    Takes the same parameters as :func:`solve_out_of_core`.
 
-    candidate_pairs = find_candidate_pairs(
+    :return: The candidate pairs, in the format of :mod:`anonlink`.
+    """
+    return find_candidate_pairs_out_of_core(
         encodings,
-        dice_coefficient,
-        threshold=threshold,
-        blocking_f=my_blocking_f if blocking else None,
+        threshold,
+        parties,
+        workers=workers,
+        tmp_dir=tmp_dir,
+        popcounts=popcounts,
+        stats=stats,
+        k=k,
+    )
+
+
+def solve_out_of_core(
+    encodings,
+    parties: Optional[Sequence[CsrBlocks]],
+    threshold: float = 0.8,
+    workers: Optional[int] = 1,
+    tmp_dir: Optional[str] = None,
+    popcounts: Optional[Sequence[np.ndarray]] = None,
+    stats: Optional[ComparisonStats] = None,
+    k: Optional[int] = None,
+):
+    """Like :func:`solve`, for datasets larger than the memory.
+
+    The candidate pairs are found with
+    :func:`anonlinkclient.outofcore.find_candidate_pairs_out_of_core`.
+
+    :param encodings: a sequence of sequences of Bloom filters, one per
+        data provider, ideally memory-mapped.
+    :param parties: the blocks of every data provider, or `None` to
+        compare all records.
+    :param threshold: similarity threshold for solving
+    :param workers: Number of processes comparing the records.
+    :param tmp_dir: Directory for the spilled candidate pairs.
+    :param popcounts: same as for :func:`solve`.
+    :param stats: same as for :func:`solve`.
+    :param k: same as for :func:`solve`.
+    :return: same as :func:`solve`.
+    """
+    return solve_candidates(
+        find_candidates_out_of_core(
+            encodings, parties, threshold, workers, tmp_dir, popcounts, stats, k
+        )
     )
-    # Need to use the probabilistic greedy solver to be able to remove the duplicate. It is not configurable
-    # with the native greedy solver.
-    return probabilistic_greedy_solve(candidate_pairs, merge_threshold=1.0)
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 import tempfile
@@ -43,6 +44,27 @@ class temporary_file(object):
         os.remove(self.tmpfile_name)
 
 
+class spawned_processes(object):
+    """
+    A context manager starting the processes of process pools by spawning
+    them, the default on macOS and Windows, so everything handed to the
+    workers must be picklable.
+
+    Usage:
+
+        with spawned_processes():
+            # start a process pool
+
+    """
+
+    def __enter__(self):
+        self.start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method("spawn", force=True)
+
+    def __exit__(self, *exc):
+        multiprocessing.set_start_method(self.start_method, force=True)
+
+
 def create_temp_file(suffix=""):
     """
     Creates, opens and returns a temporary file.
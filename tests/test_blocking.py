@@ -0,0 +1,460 @@
+"""Test streaming blocking."""
+import io
+from collections import Counter, defaultdict
+import json
+import os
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from blocklib import generate_candidate_blocks
+from click.testing import CliRunner
+
+import anonlinkclient.cli as cli
+from anonlinkclient.blocking import (
+    CsrBlocks,
+    blocks_to_csr,
+    bound_block_comparisons,
+    cap_block_sizes,
+    compute_block_stats,
+    dump_blocks,
+    dump_blocks_binary,
+    load_blocks,
+    load_blocks_binary,
+    generate_candidate_blocks_streaming,
+    load_blocking_state,
+    read_blocking_state,
+    read_blocks,
+    read_row_chunks,
+    record_blocks,
+)
+from anonlinkclient.serialization import ClkArray
+from anonlinkclient.utils import (
+    _relative_path,
+    generate_candidate_blocks_from_csv,
+    deserialize_filters,
+    load_clks,
+)
+from tests import *
+
+
+def decode_blocks(csr):
+    return {
+        rec_id: [csr.block_keys[b].decode() for b in block_ids]
+        for rec_id, block_ids in enumerate(np.split(csr.block_ids, csr.offsets[1:-1]))
+    }
+
+
+def load_config(name):
+    with open(os.path.join(TESTDATA, name)) as f:
+        return json.load(f)
+
+
+class TestStreamingBlocking(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TESTDATA, "dirty_1000_50_1.csv")) as f:
+            self.header, chunks = read_row_chunks(f, chunk_size=1000)
+            self.rows = [row for chunk in chunks for row in chunk]
+
+    def assertSameBlocking(self, config, records, header=None):
+        expected = generate_candidate_blocks(records, config, header=header)
+        for chunk_size in 1, 7, 1000:
+            chunks = [
+                records[i : i + chunk_size] for i in range(0, len(records), chunk_size)
+            ]
+            actual, count = generate_candidate_blocks_streaming(
+                chunks, config, header=header
+            )
+            self.assertEqual(count, len(records))
+            self.assertEqual(actual.blocks, expected.blocks)
+            self.assertEqual(actual.stats, expected.stats)
+            self.assertEqual(vars(actual.state).keys(), vars(expected.state).keys())
+
+    def test_workers(self):
+        for schema in "p-sig-schema.json", "dirty-data-blocking-schema.json":
+            config = load_config(schema)
+            serial, _ = generate_candidate_blocks_streaming([self.rows], config)
+            chunks = [self.rows[i : i + 90] for i in range(0, len(self.rows), 90)]
+            parallel, count = generate_candidate_blocks_streaming(
+                chunks, config, workers=2
+            )
+            self.assertEqual(count, len(self.rows))
+            self.assertEqual(parallel.blocks, serial.blocks)
+            self.assertEqual(parallel.stats, serial.stats)
+
+    def test_read_row_chunks(self):
+        self.assertEqual(len(self.rows), 1000)
+        self.assertEqual(self.header[1], "given_name")
+        self.assertEqual(self.rows[0][1], "naomi")
+        with open(os.path.join(TESTDATA, "dirty_1000_50_1.csv")) as f:
+            header, chunks = read_row_chunks(f, header=False, chunk_size=300)
+            self.assertIsNone(header)
+            self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 101])
+
+    def test_psig(self):
+        self.assertSameBlocking(load_config("p-sig-schema.json"), self.rows)
+
+    def test_psig_feature_names(self):
+        config = load_config("p-sig-schema.json")
+        config["config"]["blocking-features"] = ["given_name", "surname"]
+        for spec in config["config"]["signatureSpecs"]:
+            for strategy in spec:
+                strategy["feature"] = self.header[strategy["feature"]]
+        self.assertSameBlocking(config, self.rows, header=self.header)
+
+        with self.assertRaises(ValueError):
+            generate_candidate_blocks_streaming([self.rows], config)
+
+    def test_psig_record_id_column(self):
+        config = load_config("p-sig-schema.json")
+        config["config"]["record-id-col"] = 0
+        self.assertSameBlocking(config, self.rows)
+
+    def test_lambda_fold(self):
+        config = load_config("dirty-data-blocking-schema.json")
+        self.assertSameBlocking(config, self.rows)
+
+    def test_lambda_fold_clks(self):
+        config = load_config("lambda_fold_schema.json")
+        config["config"]["input-clks"] = True
+        with open(os.path.join(TESTDATA, "small_clk.json")) as f:
+            clks = json.load(f)["clks"]
+        self.assertSameBlocking(config, clks)
+
+        expected = generate_candidate_blocks(clks, config)
+        actual, _ = generate_candidate_blocks_streaming(
+            [deserialize_filters(clks)], config
+        )
+        self.assertEqual(actual.blocks, expected.blocks)
+
+    def test_record_blocks(self):
+        blocks = {"a": [2, 0], "b": [1], "c": [0, 1]}
+        self.assertEqual(
+            list(record_blocks(blocks)), [(0, ["a", "c"]), (1, ["b", "c"]), (2, ["a"])]
+        )
+        blocks = {"a": ["02", "x"], "b": ["x"]}
+        self.assertEqual(dict(record_blocks(blocks)), {"02": ["a"], "x": ["a", "b"]})
+        self.assertEqual(list(record_blocks({})), [])
+
+    def test_blocks_to_csr(self):
+        csr = blocks_to_csr({"a": [2, 0], "b": [1], "c": [0, 1]}, 4)
+        self.assertEqual(csr.record_count, 4)
+        self.assertEqual(csr.block_keys.tolist(), [b"a", b"b", b"c"])
+        self.assertEqual(csr.offsets.tolist(), [0, 2, 4, 5, 5])
+        self.assertEqual(csr.block_ids.tolist(), [0, 2, 1, 2, 0])
+
+        key_ids = {b"c": 0}
+        self.assertEqual(
+            csr.record_to_blocks(key_ids),
+            {0: [1, 0], 1: [2, 0], 2: [1], 3: []},
+        )
+        self.assertEqual(key_ids, {b"c": 0, b"a": 1, b"b": 2})
+
+        rec_to_blocks = {"0": ["a", "c"], "1": ["b", "c"], "2": ["a"]}
+        from_json = CsrBlocks.from_record_blocks(rec_to_blocks, 4)
+        self.assertEqual(decode_blocks(from_json), decode_blocks(csr))
+
+    def test_blocks_of_unknown_records(self):
+        for rec_id in "4", "-1", "01", "id-7":
+            blocks = {"0": ["a"], rec_id: ["b"]}
+            with self.assertRaises(ValueError):
+                CsrBlocks.from_record_blocks(blocks, 4)
+            with self.assertRaises(ValueError):
+                load_blocks(io.StringIO(json.dumps({"blocks": blocks})), 4)
+        with self.assertRaises(ValueError):
+            read_blocks(io.StringIO(json.dumps({"blocks": {"id-7": ["b"]}})))
+
+    def test_binary_round_trip(self):
+        csr = blocks_to_csr({"a": [2, 0], "b": [1], "c": [0, 1]})
+        meta = {"source": {"clk_count": [3]}}
+        with temporary_file() as path:
+            with open(path, "wb") as f:
+                dump_blocks_binary(csr, meta, f)
+            loaded, loaded_meta = load_blocks_binary(path)
+            self.assertEqual(loaded_meta, meta)
+            for expected, actual in zip(csr, loaded):
+                self.assertEqual(expected.tolist(), actual.tolist())
+            with open(path) as f:
+                self.assertEqual(
+                    load_blocks(f, 3).record_to_blocks(), csr.record_to_blocks()
+                )
+                with self.assertRaises(ValueError):
+                    load_blocks(f, 4)
+
+    def test_dump_blocks(self):
+        meta = {"source": {"clk_count": [3]}, "stats": {}}
+        f = io.StringIO()
+        dump_blocks(iter([(0, ["a", "c"]), (2, ["a"])]), meta, f)
+        self.assertEqual(
+            json.loads(f.getvalue()),
+            {"blocks": {"0": ["a", "c"], "2": ["a"]}, "meta": meta},
+        )
+        f = io.StringIO()
+        dump_blocks(iter([]), meta, f)
+        self.assertEqual(json.loads(f.getvalue()), {"blocks": {}, "meta": meta})
+
+
+class TestBlockStats(unittest.TestCase):
+    def test_three_parties(self):
+        parties = [
+            blocks_to_csr({"a": [0, 1], "b": [1, 2]}, 4),
+            blocks_to_csr({"a": [0], "c": [1]}, 2),
+            blocks_to_csr({"a": [1, 2, 3], "b": [0]}, 4),
+        ]
+        stats = compute_block_stats(parties, largest=2)
+        self.assertEqual(stats.record_counts, [4, 2, 4])
+        self.assertEqual(stats.unblocked_counts, [1, 0, 0])
+        self.assertEqual(stats.block_count, 3)
+        # a: 2*1 + 2*3 + 1*3, b: 2*1, c: nothing to compare
+        self.assertEqual(stats.comparisons, 13)
+        self.assertEqual(stats.naive_comparisons, 4 * 2 + 4 * 4 + 2 * 4)
+        self.assertAlmostEqual(stats.reduction_ratio, 1 - 13 / 32)
+        self.assertEqual(
+            stats.largest_blocks, [("a", [2, 1, 3], 11), ("b", [2, 0, 1], 2)]
+        )
+        self.assertEqual(stats.size_histogram, [(1, 1, 1), (2, 3, 1), (4, 7, 1)])
+
+    def test_same_as_counting(self):
+        parties = []
+        counters = []
+        for i in 0, 1:
+            with open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))) as f:
+                blocks = json.load(f)["blocks"]
+            parties.append(CsrBlocks.from_record_blocks(blocks, 5000))
+            counters.append(Counter(key for keys in blocks.values() for key in keys))
+        stats = compute_block_stats(parties)
+        expected = sum(counters[0][key] * counters[1][key] for key in counters[0])
+        self.assertEqual(stats.comparisons, expected)
+        self.assertEqual(len(stats.largest_blocks), 10)
+
+    def test_block_stats_command(self):
+        block_files = [
+            os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)) for i in (0, 1)
+        ]
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ["block-stats", "--largest", "1"] + block_files)
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Comparisons:            5717361", result.output)
+        self.assertIn("Reduction ratio:        0.771306", result.output)
+        self.assertIn("1125, 1125", result.output)
+
+
+class TestLargeBlocks(unittest.TestCase):
+    def setUp(self):
+        self.parties = []
+        self.clks = []
+        for i in 0, 1:
+            with open(os.path.join(TESTDATA, "novt_clk_{}.json".format(i))) as f:
+                self.clks.append(load_clks(f))
+            with open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))) as f:
+                blocks = json.load(f)["blocks"]
+            self.parties.append(CsrBlocks.from_record_blocks(blocks, 5000))
+
+    def test_cap_block_sizes(self):
+        blocks = {"a": list(range(10)), "b": [3, 4]}
+        capped, report = cap_block_sizes(blocks, 4)
+        self.assertEqual(capped["b"], [3, 4])
+        self.assertEqual(len(capped["a"]), 4)
+        self.assertEqual(capped["a"], sorted(capped["a"]))
+        self.assertEqual(capped, cap_block_sizes(blocks, 4)[0])
+        self.assertEqual(report, (1, 10, 4, 0.4))
+
+    def test_split(self):
+        before = compute_block_stats(self.parties)
+        bounded, report = bound_block_comparisons(self.parties, self.clks, 100000)
+        after = compute_block_stats(bounded)
+        self.assertEqual(report.block_count, 13)
+        self.assertEqual(
+            before.comparisons - after.comparisons,
+            report.cost_before - report.cost_after,
+        )
+        self.assertLessEqual(after.largest_blocks[0][2], 100000)
+        self.assertTrue(0 < report.expected_recall < 1)
+        for party, bounded_party in zip(self.parties, bounded):
+            # every record is in as many blocks as before
+            self.assertEqual(party.offsets.tolist(), bounded_party.offsets.tolist())
+        # the parts of a split block have the same keys for both parties
+        keys = [set(k for k in party.block_keys if b"/" in k) for party in bounded]
+        self.assertTrue(keys[0] & keys[1])
+
+    def test_sample(self):
+        bounded, report = bound_block_comparisons(
+            self.parties, self.clks, 100000, method="sample"
+        )
+        after = compute_block_stats(bounded)
+        self.assertLessEqual(after.largest_blocks[0][2], 100000)
+        self.assertAlmostEqual(
+            report.expected_recall, report.cost_after / report.cost_before
+        )
+        self.assertLess(bounded[0].offsets[-1], self.parties[0].offsets[-1])
+
+    def test_split_different_lengths(self):
+        clks = [self.clks[0], ClkArray(self.clks[1].array[:, :-1])]
+        with self.assertRaises(ValueError):
+            bound_block_comparisons(self.parties, clks, 100000)
+
+    def test_no_large_blocks(self):
+        bounded, report = bound_block_comparisons(self.parties, self.clks, 10**9)
+        self.assertEqual(report, (0, 0, 0, 1.0))
+        self.assertEqual(
+            compute_block_stats(bounded).comparisons,
+            compute_block_stats(self.parties).comparisons,
+        )
+
+    def test_find_similarity_with_budget(self):
+        files = []
+        for i in 0, 1:
+            files += [
+                "--files",
+                os.path.join(TESTDATA, "novt_clk_{}.json".format(i)),
+                os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)),
+            ]
+        runner = CliRunner()
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                ["find-similarity", "0.8", output, "--max-block-comparisons", "100000"]
+                + files,
+            )
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn(
+            "Split 13 blocks with more than 100000 comparisons", result.output
+        )
+        self.assertIn("Found 1285 matches", result.output)
+
+
+class TestBlockCommand(unittest.TestCase):
+    def test_block_in_chunks(self):
+        data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        with open(data_path) as f:
+            header, chunks = read_row_chunks(f)
+            rows = [row for chunk in chunks for row in chunk]
+        for schema in "p-sig-schema.json", "dirty-data-blocking-schema.json":
+            schema_path = os.path.join(TESTDATA, schema)
+            with open(data_path) as f, open(schema_path) as schema_f:
+                expected = json.loads(
+                    json.dumps(generate_candidate_blocks_from_csv(f, schema_f))
+                )
+            blocklib_blocks = defaultdict(list)
+            blocking_obj = generate_candidate_blocks(rows, load_config(schema))
+            for block_id, rec_ids in blocking_obj.blocks.items():
+                for rec_id in rec_ids:
+                    blocklib_blocks[str(rec_id)].append(block_id)
+            self.assertEqual(expected["blocks"], blocklib_blocks)
+            with temporary_file() as output:
+                runner = CliRunner()
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "block",
+                        data_path,
+                        schema_path,
+                        output,
+                        "--chunk-size",
+                        "33",
+                        "--workers",
+                        "2",
+                    ],
+                )
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+                with open(output) as f:
+                    self.assertEqual(json.load(f), expected)
+
+    def test_block_max_size(self):
+        data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        schema_path = os.path.join(TESTDATA, "dirty-data-blocking-schema.json")
+        runner = CliRunner()
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                ["block", data_path, schema_path, output, "--max-block-size", "20"],
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            with open(output) as f:
+                blocks = json.load(f)
+        sizes = Counter(key for keys in blocks["blocks"].values() for key in keys)
+        self.assertLessEqual(max(sizes.values()), 20)
+        self.assertGreater(blocks["meta"]["large_blocks"]["block_count"], 0)
+
+    def test_block_binary_output(self):
+        data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        schema_path = os.path.join(TESTDATA, "p-sig-schema.json")
+        runner = CliRunner()
+        with temporary_file() as json_output, temporary_file() as binary_output:
+            outputs = {"json": json_output, "binary": binary_output}
+            for output_format, output in outputs.items():
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "block",
+                        data_path,
+                        schema_path,
+                        output,
+                        "--workers",
+                        "1",
+                        "--output-format",
+                        output_format,
+                    ],
+                )
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertLess(
+                os.path.getsize(binary_output), os.path.getsize(json_output)
+            )
+            with open(json_output) as f:
+                expected = json.load(f)
+            with open(json_output) as f:
+                json_blocks = load_blocks(f, 1000)
+            csr, meta = load_blocks_binary(binary_output)
+            self.assertEqual(meta, expected["meta"])
+            self.assertEqual(decode_blocks(csr), decode_blocks(json_blocks))
+            self.assertEqual(
+                {str(r): keys for r, keys in decode_blocks(csr).items() if keys},
+                expected["blocks"],
+            )
+
+    def test_block_state_file(self):
+        data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        schema_path = os.path.join(TESTDATA, "p-sig-schema.json")
+        runner = CliRunner()
+        with temporary_file() as embedded, temporary_file() as output:
+            state_path = output + ".state"
+            for args in [[embedded], [output, "--state-file", state_path]]:
+                result = runner.invoke(
+                    cli.cli,
+                    ["block", data_path, schema_path, "--workers", "1"] + args,
+                )
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+            with open(embedded) as f:
+                expected = json.load(f)
+            with open(output) as f:
+                blocks = json.load(f)
+            try:
+                meta = blocks["meta"]
+                self.assertEqual(blocks["blocks"], expected["blocks"])
+                self.assertNotIn("state", meta)
+                self.assertEqual(
+                    meta["state_file"]["name"], os.path.basename(state_path)
+                )
+                self.assertEqual(
+                    read_blocking_state(meta, output), expected["meta"]["state"]
+                )
+                self.assertEqual(
+                    read_blocking_state(expected["meta"], embedded),
+                    expected["meta"]["state"],
+                )
+
+                with open(state_path, "ab") as f:
+                    f.write(b"\0")
+                with self.assertRaises(ValueError):
+                    read_blocking_state(meta, output)
+                with self.assertRaises(ValueError):
+                    load_blocking_state(data_path)
+            finally:
+                os.remove(state_path)
+
+    def test_state_file_on_other_drive(self):
+        # relpath fails for paths on different drives on Windows
+        with mock.patch("os.path.relpath", side_effect=ValueError):
+            name = _relative_path(os.path.join("d", "blocks.state"), "blocks.json")
+        self.assertEqual(name, os.path.abspath(os.path.join("d", "blocks.state")))
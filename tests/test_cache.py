@@ -0,0 +1,99 @@
+"""Test the on-disk CLK cache."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from clkhash.clk import generate_clk_from_csv
+from clkhash.schema import from_json_file
+
+from anonlinkclient.cache import ClkCache, schema_fingerprint, secret_fingerprint
+from anonlinkclient.encoding import stream_clks_from_csv
+from tests import *
+
+
+class TestClkCache(unittest.TestCase):
+    def setUp(self):
+        with open(SAMPLE_DATA_SCHEMA_PATH) as f:
+            self.schema = from_json_file(f)
+        self.data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, "clks.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, data_path, secret="secret", max_entries=10000, workers=1):
+        with ClkCache(self.cache_path, self.schema, secret, max_entries) as cache:
+            with open(data_path) as f:
+                clks = list(
+                    stream_clks_from_csv(
+                        f,
+                        secret,
+                        self.schema,
+                        workers=workers,
+                        chunk_size=100,
+                        clk_cache=cache,
+                    )
+                )
+        return clks, cache
+
+    def test_reencode_uses_cache(self):
+        with open(self.data_path) as f:
+            expected = generate_clk_from_csv(
+                f, "secret", self.schema, progress_bar=False, max_workers=1
+            )
+        clks, cache = self.encode(self.data_path)
+        self.assertEqual(clks, expected)
+        self.assertEqual(cache.hits, 0)
+
+        clks, cache = self.encode(self.data_path, workers=2)
+        self.assertEqual(clks, expected)
+        self.assertEqual(cache.misses, 0)
+
+    def test_changed_rows_are_rehashed(self):
+        self.encode(self.data_path)
+        with open(self.data_path) as f:
+            lines = f.readlines()
+        lines[1] = lines[1].replace("naomi", "naomie")
+        changed_path = os.path.join(self.tmp_dir, "changed.csv")
+        with open(changed_path, "w") as f:
+            f.writelines(lines)
+
+        clks, cache = self.encode(changed_path)
+        self.assertEqual(cache.misses, 1)
+        with open(changed_path) as f:
+            expected = generate_clk_from_csv(
+                f, "secret", self.schema, progress_bar=False, max_workers=1
+            )
+        self.assertEqual(clks, expected)
+
+    def test_different_secret_is_not_reused(self):
+        self.encode(self.data_path)
+        _, cache = self.encode(self.data_path, secret="other secret")
+        self.assertEqual(cache.hits, 0)
+
+    def test_eviction(self):
+        self.encode(self.data_path, max_entries=300)
+        with ClkCache(self.cache_path, self.schema, "secret") as cache:
+            self.assertEqual(len(cache), 300)
+
+    def test_no_secret_or_pii_stored(self):
+        self.encode(self.data_path)
+        with open(self.cache_path, "rb") as f:
+            content = f.read()
+        self.assertNotIn(b"secret", content)
+        self.assertNotIn(b"naomi", content)
+        self.assertNotIn(b"robson", content)
+
+    def test_fingerprints(self):
+        with open(SIMPLE_SCHEMA_PATH) as f:
+            other_schema = from_json_file(f)
+        self.assertEqual(
+            schema_fingerprint(self.schema), schema_fingerprint(self.schema)
+        )
+        self.assertNotEqual(
+            schema_fingerprint(self.schema), schema_fingerprint(other_schema)
+        )
+        self.assertNotEqual(secret_fingerprint("a"), secret_fingerprint("b"))
+        self.assertNotIn(b"secret", secret_fingerprint("secret"))
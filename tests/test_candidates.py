@@ -0,0 +1,390 @@
+"""Test parallel candidate generation."""
+from collections import Counter
+import heapq
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from anonlink.candidate_generation import find_candidate_pairs
+from anonlink.similarities import dice_coefficient
+from click.testing import CliRunner
+
+import anonlinkclient.candidates as candidates_module
+import anonlinkclient.cli as cli
+from anonlinkclient.candidates import (
+    POPCOUNT_INDEX_SUFFIX,
+    ComparisonStats,
+    build_block_index,
+    dataset_popcounts,
+    filter_candidates,
+    find_candidate_pairs_parallel,
+    load_popcount_index,
+    merge_candidates,
+    partition_blocks,
+    popcount_bands,
+    score_unit,
+    top_k_candidates,
+)
+from anonlinkclient.serialization import ClkArray, MappedClks, dump_clks_binary
+from anonlinkclient.utils import join_clks_blocks, solve, solver_blocks
+from tests import *
+
+
+def top_k_reference(candidates, k):
+    """Keep the candidates among the k best of both records, with heaps."""
+    sims, (dset_is0, dset_is1), (rec_is0, rec_is1) = candidates
+    pairs = list(zip(sims, dset_is0, dset_is1, rec_is0, rec_is1))
+    best = {}
+    for pair in pairs:
+        sim, d0, d1, r0, r1 = pair
+        for key in (d0, r0, d1), (d1, r1, d0):
+            heap = best.setdefault(key, [])
+            entry = (sim, -d0, -d1, -r0, -r1)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+    best = {key: set(heap) for key, heap in best.items()}
+    return [
+        (sim, d0, d1, r0, r1)
+        for sim, d0, d1, r0, r1 in pairs
+        if (sim, -d0, -d1, -r0, -r1) in best[d0, r0, d1]
+        and (sim, -d0, -d1, -r0, -r1) in best[d1, r1, d0]
+    ]
+
+
+def load_parties():
+    files = [
+        (
+            open(os.path.join(TESTDATA, "novt_clk_{}.json".format(i))),
+            open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))),
+        )
+        for i in range(2)
+    ]
+    try:
+        clk_groups, parties = join_clks_blocks(files)
+    finally:
+        for clk_f, block_f in files:
+            clk_f.close()
+            block_f.close()
+    return clk_groups, solver_blocks(parties)
+
+
+class TestParallelCandidates(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.clk_groups, cls.rec_to_blocks = load_parties()
+
+    def test_same_as_anonlink(self):
+        def blocking_f(ds_idx, rec_idx, _):
+            return self.rec_to_blocks[ds_idx][rec_idx]
+
+        expected = find_candidate_pairs(
+            self.clk_groups, dice_coefficient, 0.8, blocking_f=blocking_f
+        )
+        for workers in 1, 2:
+            result = find_candidate_pairs_parallel(
+                self.clk_groups, 0.8, self.rec_to_blocks, workers=workers
+            )
+            self.assertEqual(result, expected)
+
+    def test_mapped_clks_in_spawned_workers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            datasets = []
+            for i, clks in enumerate(self.clk_groups):
+                path = os.path.join(tmp_dir, "clks_{}.bin".format(i))
+                with open(path, "wb") as f:
+                    dump_clks_binary(clks, f)
+                datasets.append(MappedClks(path))
+            expected = find_candidate_pairs_parallel(
+                self.clk_groups, 0.8, self.rec_to_blocks, workers=1
+            )
+            with spawned_processes():
+                result = find_candidate_pairs_parallel(
+                    datasets, 0.8, self.rec_to_blocks, workers=2
+                )
+            self.assertEqual(result, expected)
+            del datasets
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_without_blocking(self):
+        datasets = [clks[:300] for clks in self.clk_groups]
+        expected = find_candidate_pairs(datasets, dice_coefficient, 0.5)
+        result = find_candidate_pairs_parallel(datasets, 0.5, workers=2)
+        self.assertEqual(result, expected)
+        self.assertGreater(len(result[0]), 0)
+
+    def test_filter_candidates(self):
+        datasets = [clks[:300] for clks in self.clk_groups]
+        candidates = find_candidate_pairs(datasets, dice_coefficient, 0.5)
+        for threshold in 0.5, 0.7, 0.9, 1.1:
+            self.assertEqual(
+                filter_candidates(candidates, threshold),
+                find_candidate_pairs(datasets, dice_coefficient, threshold),
+            )
+
+    def test_three_parties(self):
+        datasets = [
+            self.clk_groups[0][:200],
+            self.clk_groups[1][:200],
+            self.clk_groups[0][100:300],
+        ]
+        expected = find_candidate_pairs(datasets, dice_coefficient, 0.7)
+        result = find_candidate_pairs_parallel(datasets, 0.7, workers=1)
+        self.assertEqual(result, expected)
+        self.assertEqual(set(result[1][0]) | set(result[1][1]), {0, 1, 2})
+
+    def test_partition_blocks(self):
+        blocks = list(build_block_index(2, self.rec_to_blocks).values())
+        units = partition_blocks(blocks, 8)
+        self.assertEqual(len(units), 8)
+        costs = [
+            sum(len(rows0) * len(rows1) for _, _, rows0, rows1 in unit)
+            for unit in units
+        ]
+        self.assertEqual(
+            sum(costs), sum(len(block[0]) * len(block[1]) for block in blocks)
+        )
+        self.assertLess(max(costs), 1.1 * min(costs))
+
+        # a single block is sliced into units of equal cost
+        units = partition_blocks([(list(range(100)), list(range(10)))], 4)
+        self.assertEqual(
+            [sum(len(t[2]) * len(t[3]) for t in unit) for unit in units],
+            [250, 250, 250, 250],
+        )
+        self.assertEqual(partition_blocks([([1, 2], [])], 4), [])
+
+    def test_merge_nothing(self):
+        self.assertEqual([len(a) for a in merge_candidates([])[1]], [0, 0])
+
+    def test_solve(self):
+        expected = solve(self.clk_groups, self.rec_to_blocks, 0.8, blocking=True)
+        result = solve(
+            self.clk_groups, self.rec_to_blocks, 0.8, blocking=True, workers=2
+        )
+        self.assertEqual(
+            {frozenset(group) for group in result},
+            {frozenset(group) for group in expected},
+        )
+        self.assertEqual(len(result), 1309)
+
+    def test_find_similarity_workers(self):
+        runner = CliRunner()
+        args = ["find-similarity", "0.8"]
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                args
+                + [output, "--workers", "2"]
+                + [
+                    arg
+                    for i in range(2)
+                    for arg in (
+                        "--files",
+                        os.path.join(TESTDATA, "novt_clk_{}.json".format(i)),
+                        os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)),
+                    )
+                ],
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertIn("Found 1309 matches", result.output)
+
+
+class TestPopcountPruning(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.clk_groups, cls.rec_to_blocks = load_parties()
+        # lower the popcount of half the records, so they can't match the others
+        array = cls.clk_groups[0].array.copy()
+        array[:2500, :64] = 0
+        cls.mixed = [ClkArray(array), cls.clk_groups[1]]
+
+    def test_bands_keep_possible_matches(self):
+        popcounts = [dataset_popcounts(clks) for clks in self.mixed]
+        rows0, rows1 = list(range(0, 5000, 7)), list(range(0, 5000, 3))
+        sorted0, sorted1, ranges = popcount_bands(
+            rows0, rows1, popcounts[0], popcounts[1], 0.8
+        )
+        self.assertEqual(sorted(sorted0), rows0)
+        self.assertEqual(sorted(sorted1), rows1)
+        compared = set()
+        for start0, stop0, start1, stop1 in ranges:
+            for r0 in sorted0[start0:stop0]:
+                compared.update((r0, r1) for r1 in sorted1[start1:stop1])
+        for r0 in rows0:
+            for r1 in rows1:
+                a, b = int(popcounts[0][r0]), int(popcounts[1][r1])
+                if 2 * min(a, b) >= 0.8 * (a + b):
+                    self.assertIn((r0, r1), compared)
+        self.assertLess(len(compared), len(rows0) * len(rows1))
+
+    def test_pruning(self):
+        for threshold in 0.7, 0.9:
+            expected = find_candidate_pairs(self.mixed, dice_coefficient, threshold)
+            stats = ComparisonStats()
+            result = find_candidate_pairs_parallel(
+                self.mixed, threshold, workers=1, stats=stats
+            )
+            self.assertEqual(result, expected)
+            self.assertEqual(stats.comparisons, 5000 * 5000)
+            self.assertGreaterEqual(stats.pruning_ratio, 0.4)
+        self.assertEqual(ComparisonStats().pruning_ratio, 0)
+
+    def test_popcount_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            clk_path = os.path.join(tmp_dir, "clks.json")
+            shutil.copyfile(os.path.join(TESTDATA, "novt_clk_0.json"), clk_path)
+            expected = dataset_popcounts(self.clk_groups[0])
+            popcounts = load_popcount_index(self.clk_groups[0], clk_path)
+            self.assertEqual(popcounts.tolist(), expected.tolist())
+            index_path = clk_path + POPCOUNT_INDEX_SUFFIX
+            self.assertTrue(os.path.exists(index_path))
+
+            # the stored index is used while the CLK file is unchanged
+            with np.load(index_path) as index:
+                stamp = index["stamp"]
+            np.savez(index_path, popcounts=np.zeros(5000, np.uint32), stamp=stamp)
+            reused = load_popcount_index(self.clk_groups[0], clk_path)
+            self.assertFalse(reused.any())
+            os.utime(clk_path, ns=(0, 0))
+            popcounts = load_popcount_index(self.clk_groups[0], clk_path)
+            self.assertEqual(popcounts.tolist(), expected.tolist())
+
+            runner = CliRunner()
+            with temporary_file() as output:
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "find-similarity",
+                        "0.8",
+                        output,
+                        "--workers",
+                        "1",
+                        "--popcount-index",
+                        "-v",
+                        "--clk",
+                        clk_path,
+                        "--clk",
+                        os.path.join(TESTDATA, "novt_clk_1.json"),
+                    ],
+                )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertIn(
+                "Skipped 0.0% of 25000000 comparisons by popcount", result.output
+            )
+            self.assertIn("Found 1338 matches", result.output)
+        finally:
+            shutil.rmtree(tmp_dir)
+            index_path = os.path.join(
+                TESTDATA, "novt_clk_1.json" + POPCOUNT_INDEX_SUFFIX
+            )
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+
+class TestTopK(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.clk_groups, cls.rec_to_blocks = load_parties()
+
+    def assertTopK(self, result, candidates, k):
+        sims, (dset_is0, dset_is1), (rec_is0, rec_is1) = result
+        self.assertEqual(
+            list(zip(sims, dset_is0, dset_is1, rec_is0, rec_is1)),
+            top_k_reference(candidates, k),
+        )
+
+    def test_same_as_heaps(self):
+        datasets = [
+            self.clk_groups[0][:300],
+            self.clk_groups[1][:300],
+            self.clk_groups[0][200:400],
+        ]
+        candidates = find_candidate_pairs(datasets, dice_coefficient, 0.5)
+        for k in 1, 3:
+            for workers in 1, 2:
+                result = find_candidate_pairs_parallel(
+                    datasets, 0.5, workers=workers, k=k
+                )
+                self.assertTopK(result, candidates, k)
+
+    def test_with_blocks(self):
+        candidates = find_candidate_pairs_parallel(
+            self.clk_groups, 0.5, self.rec_to_blocks, workers=1
+        )
+        result = find_candidate_pairs_parallel(
+            self.clk_groups, 0.5, self.rec_to_blocks, workers=1, k=2
+        )
+        self.assertTopK(result, candidates, 2)
+        self.assertLess(len(result[0]), len(candidates[0]))
+        for rec_is in result[2]:
+            self.assertLessEqual(max(Counter(rec_is).values()), 2)
+
+    def test_hub_record(self):
+        hub = self.clk_groups[0][0]
+        datasets = [[hub], [hub] * 20]
+        sims, dset_is, (rec_is0, rec_is1) = find_candidate_pairs_parallel(
+            datasets, 0.5, workers=1, k=1
+        )
+        self.assertEqual(list(rec_is0), [0])
+        self.assertEqual(list(rec_is1), [0])
+
+    def test_unit_holds_k_per_record(self):
+        datasets = [clks[:300] for clks in self.clk_groups]
+        popcounts = [dataset_popcounts(clks) for clks in datasets]
+        blocks = [(list(range(300)), list(range(300))), ([0, 1, 2], [5, 6, 7])]
+        (unit,) = partition_blocks(blocks, 1)
+        records = sum(len(rows0) + len(rows1) for _, _, rows0, rows1 in unit)
+        for unit_popcounts in None, popcounts:
+            with mock.patch(
+                "anonlinkclient.candidates._sort_candidates",
+                wraps=candidates_module._sort_candidates,
+            ) as sort:
+                score_unit(datasets, 0.2, unit, unit_popcounts, k=2)
+            (held,), _ = sort.call_args
+            self.assertLessEqual(len(held[0]), 2 * records)
+        all_pairs = score_unit(datasets, 0.2, unit, popcounts).candidates
+        self.assertGreater(len(all_pairs[0]), 2 * records)
+
+    def test_top_k_of_parts(self):
+        datasets = [clks[:300] for clks in self.clk_groups]
+        sims, dset_is, rec_is = find_candidate_pairs(datasets, dice_coefficient, 0.5)
+        columns = [np.frombuffer(sims, dtype=np.float64)] + [
+            np.frombuffer(a, dtype=np.uint32) for a in dset_is + rec_is
+        ]
+        half = len(columns[0]) // 2
+        parts = [
+            top_k_candidates([c[:half] for c in columns], 2, either=True),
+            top_k_candidates([c[half:] for c in columns], 2, either=True),
+        ]
+        self.assertEqual(merge_candidates(parts, 2), merge_candidates([columns], 2))
+
+    def test_find_similarity_top_k(self):
+        runner = CliRunner()
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "find-similarity",
+                    "0.5",
+                    output,
+                    "--workers",
+                    "1",
+                    "--top-k",
+                    "1",
+                    "--clk",
+                    os.path.join(TESTDATA, "novt_clk_0.json"),
+                    "--clk",
+                    os.path.join(TESTDATA, "novt_clk_1.json"),
+                ],
+            )
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        self.assertIn("Found 2556 matches", result.output)
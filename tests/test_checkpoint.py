@@ -0,0 +1,145 @@
+"""Test checkpointed encoding."""
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+from clkhash.schema import from_json_file
+
+import anonlinkclient.cli as cli
+from anonlinkclient.checkpoint import (
+    Checkpointer,
+    checkpoint_path,
+    encoding_fingerprint,
+    load_checkpoint,
+)
+from anonlinkclient.encoding import CsvLines, stream_clks_from_csv
+from anonlinkclient.serialization import dump_clks, dump_clks_binary
+from anonlinkclient.utils import load_clks
+from tests import *
+
+
+class TestResumeEncoding(unittest.TestCase):
+    def setUp(self):
+        with open(SAMPLE_DATA_SCHEMA_PATH) as f:
+            self.schema = from_json_file(f)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tmp_dir, "pii.csv")
+        shutil.copyfile(os.path.join(TESTDATA, "dirty_1000_50_1.csv"), self.data_path)
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, output_path, output_format, *options):
+        result = self.runner.invoke(
+            cli.cli,
+            [
+                "encode",
+                self.data_path,
+                "secret",
+                SAMPLE_DATA_SCHEMA_PATH,
+                output_path,
+                "--workers",
+                "1",
+                "--chunk-size",
+                "50",
+                "--checkpoint-every",
+                "100",
+                "--output-format",
+                output_format,
+            ]
+            + list(options),
+        )
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        return result
+
+    def interrupted_encode(self, output_path, output_format, rows):
+        """Encode the first `rows` rows like the CLI, then stop."""
+        fingerprint = encoding_fingerprint(
+            self.data_path, self.schema, "secret", output_format
+        )
+        mode = "wb" if output_format == "binary" else "w"
+        with open(self.data_path, "rb") as pii_f, open(output_path, mode) as clk_f:
+            clks = stream_clks_from_csv(
+                CsvLines(pii_f),
+                "secret",
+                self.schema,
+                workers=1,
+                chunk_size=50,
+                on_chunk=Checkpointer(
+                    checkpoint_path(output_path), clk_f, fingerprint, 100
+                ),
+            )
+            dump = dump_clks_binary if output_format == "binary" else dump_clks
+            dump(itertools.islice(clks, rows), clk_f)
+        return fingerprint
+
+    def test_resume(self):
+        for output_format in "json", "binary":
+            expected_path = os.path.join(self.tmp_dir, "expected")
+            self.encode(expected_path, output_format)
+            self.assertFalse(os.path.exists(checkpoint_path(expected_path)))
+
+            output_path = os.path.join(self.tmp_dir, "clks." + output_format)
+            fingerprint = self.interrupted_encode(output_path, output_format, 430)
+            checkpoint = load_checkpoint(checkpoint_path(output_path), fingerprint)
+            self.assertEqual(checkpoint.rows, 400)
+
+            result = self.encode(output_path, output_format, "--resume")
+            self.assertIn("Resuming after row 400", result.output)
+            self.assertFalse(os.path.exists(checkpoint_path(output_path)))
+            with open(output_path, "rb") as f, open(expected_path, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+            with open(output_path) as f:
+                self.assertEqual(len(load_clks(f)), 1000)
+
+    def test_checkpoints_are_opt_in(self):
+        output_path = os.path.join(self.tmp_dir, "clks.json")
+        with open(self.data_path, "a") as f:
+            f.write("1,a\n")
+        result = self.runner.invoke(
+            cli.cli,
+            [
+                "encode",
+                self.data_path,
+                "secret",
+                SAMPLE_DATA_SCHEMA_PATH,
+                output_path,
+                "--workers",
+                "1",
+                "--chunk-size",
+                "50",
+            ],
+        )
+        self.assertIn("Encoding failed", result.output)
+        self.assertEqual(os.listdir(self.tmp_dir), ["pii.csv"])
+
+    def test_resume_without_checkpoint(self):
+        output_path = os.path.join(self.tmp_dir, "clks.json")
+        result = self.encode(output_path, "json", "--resume")
+        self.assertIn("No checkpoint found", result.output)
+        with open(output_path) as f:
+            self.assertEqual(len(json.load(f)["clks"]), 1000)
+
+    def test_resume_modified_input(self):
+        output_path = os.path.join(self.tmp_dir, "clks.json")
+        self.interrupted_encode(output_path, "json", 250)
+        with open(self.data_path, "a") as f:
+            f.write("1,a,b,1,a,,a,1,a,19000101,,1,1,1\n")
+        result = self.runner.invoke(
+            cli.cli,
+            [
+                "encode",
+                self.data_path,
+                "secret",
+                SAMPLE_DATA_SCHEMA_PATH,
+                output_path,
+                "--resume",
+            ],
+        )
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("different input file", result.output)
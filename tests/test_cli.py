@@ -6,6 +6,7 @@ import json
 import logging
 import os
 import random
+import tempfile
 import unittest
 
 from click.testing import CliRunner
@@ -13,6 +14,9 @@ from clkhash import randomnames, schema
 
 import anonlinkclient
 import anonlinkclient.cli as cli
+from anonlinkclient.blocking import CsrBlocks, dump_blocks_binary
+from anonlinkclient.serialization import dump_clks_binary
+from anonlinkclient.utils import deserialize_filters
 from tests import *
 
 ES_TIMEOUT = os.environ.get("ES_TIMEOUT", 60)
@@ -156,6 +160,32 @@ class BasicCLITests(unittest.TestCase):
             result = runner.invoke(cli.cli, ["describe", "out.json"])
             assert result.exit_code == 0
 
+    def test_describe_binary(self):
+        runner = CliRunner()
+
+        with runner.isolated_filesystem():
+            with open("in.csv", "w") as f:
+                f.write("Alice,1967/09/27\nBob,1970/01/01")
+
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "encode",
+                    "in.csv",
+                    "a",
+                    SIMPLE_SCHEMA_PATH,
+                    "out.bin",
+                    "--no-header",
+                    "--output-format",
+                    "binary",
+                ],
+            )
+            assert result.exit_code == 0
+
+            result = runner.invoke(cli.cli, ["describe", "out.bin"])
+            assert result.exit_code == 0
+            assert "observations: 2" in result.output
+
 
 class TestSchemaValidationCommand(unittest.TestCase):
     @staticmethod
@@ -300,6 +330,99 @@ class TestEncodeCommand(unittest.TestCase):
             with open("out.json") as f:
                 self.assertIn("clks", json.load(f))
 
+    def test_encode_with_clk_cache(self):
+        runner = self.runner
+
+        with runner.isolated_filesystem():
+            with open("in.csv", "w") as f:
+                f.write("Alice,1967/09/27\nBob,1970/01/01\n")
+
+            outputs = []
+            for _ in range(2):
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "encode",
+                        "in.csv",
+                        "a",
+                        SIMPLE_SCHEMA_PATH,
+                        "out.json",
+                        "--no-header",
+                        "--clk-cache",
+                        "clks.db",
+                        "--verbose",
+                    ],
+                )
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+                with open("out.json") as f:
+                    outputs.append(json.load(f))
+            self.assertIn("Reused 2 of 2 CLKs", result.output)
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_encode_several(self):
+        runner = self.runner
+
+        with runner.isolated_filesystem():
+            with open("in.csv", "w") as f:
+                f.write("Alice,1967/09/27\nBob,1970/01/01\n")
+
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "encode",
+                    "in.csv",
+                    "a",
+                    SIMPLE_SCHEMA_PATH,
+                    "out-a.json",
+                    "--no-header",
+                    "--also-encode",
+                    "b",
+                    SIMPLE_SCHEMA_PATH,
+                    "out-b.json",
+                ],
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            for secret in "a", "b":
+                result = runner.invoke(
+                    cli.cli,
+                    [
+                        "encode",
+                        "in.csv",
+                        secret,
+                        SIMPLE_SCHEMA_PATH,
+                        "expected.json",
+                        "--no-header",
+                    ],
+                )
+                with open("expected.json") as f, open(f"out-{secret}.json") as g:
+                    self.assertEqual(json.load(f), json.load(g))
+
+    def test_encode_several_invalid_data_leaves_no_output(self):
+        runner = self.runner
+        with runner.isolated_filesystem():
+            with open("in.csv", "w") as f:
+                f.write("Alice,2000/01/01\n" * 200 + "Alice,\n")
+
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "encode",
+                    "in.csv",
+                    "a",
+                    SIMPLE_SCHEMA_PATH,
+                    "out-a.json",
+                    "--no-header",
+                    "--chunk-size",
+                    "50",
+                    "--also-encode",
+                    "b",
+                    SIMPLE_SCHEMA_PATH,
+                    "out-b.json",
+                ],
+            )
+            self.assertIn("Invalid entry", result.output)
+            self.assertEqual(os.listdir("."), ["in.csv"])
+
     def test_encode_febrl_data(self):
         runner = self.runner
         schema_file = os.path.join(
@@ -379,6 +502,33 @@ class TestEncodeCommand(unittest.TestCase):
 
             assert "Invalid entry" in result.output
 
+    def test_encode_invalid_data_leaves_no_output(self):
+        runner = self.runner
+        with runner.isolated_filesystem():
+            with open("in.csv", "w") as f:
+                f.write("Alice,2000/01/01\n" * 200 + "Alice,\n")
+
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "encode",
+                    "in.csv",
+                    "a",
+                    SIMPLE_SCHEMA_PATH,
+                    "out.json",
+                    "--no-header",
+                    "--workers",
+                    "1",
+                    "--chunk-size",
+                    "50",
+                    "--checkpoint-every",
+                    "0",
+                ],
+            )
+
+            self.assertIn("Invalid entry", result.output)
+            self.assertEqual(os.listdir("."), ["in.csv"])
+
 
 class TestBlockCommand(unittest.TestCase):
     def test_cli_includes_help(self):
@@ -416,6 +566,91 @@ class TestBlockCommand(unittest.TestCase):
                 self.assertIn("config", outjson["meta"])
 
 
+class TestEncodeAndBlockCommand(unittest.TestCase):
+    def setUp(self):
+        self.runner = CliRunner()
+        self.data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+
+    def invoke(self, args):
+        result = self.runner.invoke(cli.cli, args)
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+
+    def check_same_as_separate_commands(self, blocking_schema_path, input_clks):
+        with self.runner.isolated_filesystem():
+            self.invoke(
+                [
+                    "encode-and-block",
+                    self.data_path,
+                    "secret",
+                    SAMPLE_DATA_SCHEMA_PATH,
+                    blocking_schema_path,
+                    "clks.json",
+                    "blocks.json",
+                ]
+            )
+            self.invoke(
+                [
+                    "encode",
+                    self.data_path,
+                    "secret",
+                    SAMPLE_DATA_SCHEMA_PATH,
+                    "expected-clks.json",
+                ]
+            )
+            block_input = "expected-clks.json" if input_clks else self.data_path
+            self.invoke(
+                ["block", block_input, blocking_schema_path, "expected-blocks.json"]
+            )
+            with open("clks.json") as f, open("expected-clks.json") as g:
+                self.assertEqual(json.load(f), json.load(g))
+            with open("blocks.json") as f, open("expected-blocks.json") as g:
+                blocks, expected_blocks = json.load(f), json.load(g)
+            self.assertEqual(blocks["blocks"], expected_blocks["blocks"])
+            self.assertEqual(
+                blocks["meta"]["source"], expected_blocks["meta"]["source"]
+            )
+
+    def test_p_sig(self):
+        self.check_same_as_separate_commands(
+            os.path.join(TESTDATA, "p-sig-schema.json"), False
+        )
+
+    def test_lambda_fold(self):
+        self.check_same_as_separate_commands(
+            os.path.join(TESTDATA, "lambda_fold_schema.json"), False
+        )
+
+    def test_lambda_fold_input_clks(self):
+        with open(os.path.join(TESTDATA, "lambda_fold_schema.json")) as f:
+            blocking_schema = json.load(f)
+        blocking_schema["config"]["input-clks"] = True
+        with temporary_file() as blocking_schema_path:
+            with open(blocking_schema_path, "w") as f:
+                json.dump(blocking_schema, f)
+            self.check_same_as_separate_commands(blocking_schema_path, True)
+
+    def test_invalid_data_leaves_no_output(self):
+        with self.runner.isolated_filesystem():
+            with open(self.data_path) as f, open("in.csv", "w") as g:
+                g.write(f.read() + "1,a\n")
+            result = self.runner.invoke(
+                cli.cli,
+                [
+                    "encode-and-block",
+                    "in.csv",
+                    "secret",
+                    SAMPLE_DATA_SCHEMA_PATH,
+                    os.path.join(TESTDATA, "p-sig-schema.json"),
+                    "clks.json",
+                    "blocks.json",
+                    "--chunk-size",
+                    "100",
+                ],
+            )
+            self.assertIn("Encoding failed", result.output)
+            self.assertEqual(os.listdir("."), ["in.csv"])
+
+
 class TestCompareSchemaCommand(unittest.TestCase):
     def setUp(self):
         self.runner = CliRunner()
@@ -727,3 +962,155 @@ class TestFindSimilarityCommand(unittest.TestCase):
                 )
             self.assertEqual(result.exit_code, 0, msg=result.output)
             self.assertEqual(result.output.rstrip(), "Found 4962 matches")
+
+    def test_find_similarities_binary(self):
+        runner = self.runner
+        clks = []
+        for name in "clks_a.json", "clks_b.json":
+            binary_clk_file = create_temp_file(suffix=".bin")
+            binary_clk_file.close()
+            with open(os.path.join(TESTDATA, name)) as f:
+                filters = deserialize_filters(json.load(f)["clks"])
+            with open(binary_clk_file.name, "wb") as f:
+                dump_clks_binary(filters, f)
+            clks.extend(["--clk", binary_clk_file.name])
+
+        with temporary_file() as output_filename:
+            result = runner.invoke(
+                cli.cli, ["find-similarity", "0.8", output_filename] + clks
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(result.output.rstrip(), "Found 4962 matches")
+
+    def test_find_similarities_binary_blocks(self):
+        runner = self.runner
+        files = []
+        for i in 0, 1:
+            clk_path = os.path.join(TESTDATA, "novt_clk_{}.json".format(i))
+            with open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))) as f:
+                blocks = json.load(f)
+            with open(clk_path) as f:
+                record_count = len(json.load(f)["clks"])
+            block_file = create_temp_file(suffix=".npz")
+            block_file.close()
+            if i == 0:
+                csr = CsrBlocks.from_record_blocks(blocks["blocks"], record_count)
+                with open(block_file.name, "wb") as f:
+                    dump_blocks_binary(csr, blocks["meta"], f)
+            else:
+                with open(block_file.name, "w") as f:
+                    json.dump(blocks, f)
+            files.extend(["--files", clk_path, block_file.name])
+
+        with temporary_file() as output_filename:
+            result = runner.invoke(
+                cli.cli, ["find-similarity", "0.8", output_filename] + files
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(result.output.rstrip(), "Found 1309 matches")
+
+    def test_find_similarities_thresholds(self):
+        runner = self.runner
+        files = []
+        for i in 0, 1:
+            files += [
+                "--files",
+                os.path.join(TESTDATA, "novt_clk_{}.json".format(i)),
+                os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)),
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "result.json")
+            result = runner.invoke(
+                cli.cli,
+                ["find-similarity", "0.8", output, "--thresholds", "0.85,0.7"] + files,
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            lines = result.output.splitlines()
+            self.assertEqual(lines[0], "Found 1309 matches")
+            self.assertEqual(lines[1].split(), ["threshold", "matches", "file"])
+            self.assertEqual(
+                [line.split()[:2] for line in lines[2:]],
+                [["0.7", "2060"], ["0.8", "1309"], ["0.85", "1161"]],
+            )
+            self.assertEqual(
+                sorted(os.listdir(tmp_dir)),
+                ["result.json", "result_0.7.json", "result_0.85.json"],
+            )
+
+            # the same matches as solving at each threshold on its own
+            for threshold in "0.7", "0.85":
+                single_output = os.path.join(tmp_dir, "single.json")
+                result = runner.invoke(
+                    cli.cli, ["find-similarity", threshold, single_output] + files
+                )
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+                groups = []
+                for path in single_output, output[:-5] + "_" + threshold + ".json":
+                    with open(path) as f:
+                        groups.append(
+                            {frozenset(map(tuple, group)) for group in json.load(f)}
+                        )
+                self.assertEqual(groups[0], groups[1])
+
+    def test_find_similarities_invalid_thresholds(self):
+        with temporary_file() as output_filename:
+            result = self.runner.invoke(
+                cli.cli,
+                [
+                    "find-similarity",
+                    "0.8",
+                    output_filename,
+                    "--thresholds",
+                    "0.7,high",
+                    "--clk",
+                    os.path.join(TESTDATA, "clks_a.json"),
+                    "--clk",
+                    os.path.join(TESTDATA, "clks_b.json"),
+                ],
+            )
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("--thresholds", result.output)
+
+    def test_save_and_solve_candidates(self):
+        runner = self.runner
+        files = []
+        for i in 0, 1:
+            files += [
+                "--files",
+                os.path.join(TESTDATA, "novt_clk_{}.json".format(i)),
+                os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)),
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            candidates = os.path.join(tmp_dir, "candidates.bin")
+            outputs = [os.path.join(tmp_dir, name) for name in ("a.json", "b.json")]
+            result = runner.invoke(
+                cli.cli,
+                ["find-similarity", "0.8", outputs[0], "--save-candidates", candidates]
+                + files,
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(result.output.rstrip(), "Found 1309 matches")
+
+            result = runner.invoke(cli.cli, ["solve", candidates, outputs[1]])
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(result.output.rstrip(), "Found 1309 matches")
+            groups = []
+            for path in outputs:
+                with open(path) as f:
+                    groups.append(
+                        {frozenset(map(tuple, group)) for group in json.load(f)}
+                    )
+            self.assertEqual(groups[0], groups[1])
+
+            result = runner.invoke(
+                cli.cli, ["solve", candidates, outputs[1], "--threshold", "0.85"]
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(result.output.rstrip(), "Found 1161 matches")
+
+            with open(candidates, "wb") as f:
+                f.write(bytes([1, 4, 4, 4]))
+            result = runner.invoke(cli.cli, ["solve", candidates, outputs[1]])
+            self.assertNotEqual(result.exit_code, 0)
@@ -0,0 +1,166 @@
+"""Test reading compressed input."""
+import bz2
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+import anonlinkclient.cli as cli
+from anonlinkclient.compression import (
+    detect_compression,
+    open_input,
+    open_text_input,
+    uncompressed_name,
+)
+from tests import *
+
+OPENERS = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+
+
+class TestCompressedInput(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+        with open(self.data_path, "rb") as f:
+            self.data = f.read()
+        self.paths = {}
+        for name, opener in OPENERS.items():
+            path = os.path.join(self.tmp_dir, "pii.csv." + name)
+            with opener(path, "wb") as f:
+                f.write(self.data)
+            self.paths[name] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_detect_compression(self):
+        self.assertIsNone(detect_compression(self.data_path))
+        self.assertEqual(detect_compression(self.paths["bz2"]), "bz2")
+        for name, path in self.paths.items():
+            without_extension = os.path.join(self.tmp_dir, "pii_" + name)
+            shutil.copyfile(path, without_extension)
+            self.assertEqual(detect_compression(without_extension), name)
+        self.assertEqual(uncompressed_name("a/pii.csv.GZ"), "a/pii.csv")
+        self.assertEqual(uncompressed_name("pii.csv"), "pii.csv")
+
+    def test_open_input(self):
+        for path in list(self.paths.values()) + [self.data_path]:
+            for threaded in False, True:
+                with open_input(path, threaded=threaded) as f:
+                    self.assertEqual(f.read(), self.data)
+                with open_input(path, offset=100, threaded=threaded) as f:
+                    self.assertEqual(f.tell(), 100)
+                    self.assertEqual(
+                        f.readline(), self.data[100:].split(b"\n")[0] + b"\n"
+                    )
+
+    def test_threaded_small_blocks(self):
+        with open_input(self.paths["gzip"], threaded=True, block_size=7) as f:
+            self.assertEqual(list(f), self.data.splitlines(keepends=True))
+
+    def test_threaded_error(self):
+        path = os.path.join(self.tmp_dir, "truncated.csv.gz")
+        with open(self.paths["gzip"], "rb") as f, open(path, "wb") as g:
+            g.write(f.read()[:1000])
+        with open_input(path, threaded=True) as f:
+            with self.assertRaises(EOFError):
+                f.read()
+
+    def test_open_text_input_keeps_name(self):
+        with open_text_input(self.paths["xz"], threaded=True) as f:
+            self.assertEqual(f.name, self.paths["xz"])
+            self.assertEqual(f.read(), self.data.decode())
+
+    def test_encode_compressed(self):
+        runner = CliRunner()
+        outputs = []
+        for path in [self.data_path] + list(self.paths.values()):
+            output = os.path.join(self.tmp_dir, "clks.json")
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "encode",
+                    path,
+                    "secret",
+                    SAMPLE_DATA_SCHEMA_PATH,
+                    output,
+                    "--read-ahead",
+                ],
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            with open(output) as f:
+                outputs.append(json.load(f))
+        self.assertEqual(len(outputs[0]["clks"]), 1000)
+        for output in outputs[1:]:
+            self.assertEqual(output, outputs[0])
+
+    def test_block_compressed(self):
+        runner = CliRunner()
+        schema_path = os.path.join(TESTDATA, "lambda_fold_schema.json")
+        data_path = os.path.join(TESTDATA, "small.csv")
+        compressed_path = os.path.join(self.tmp_dir, "small.csv.gz")
+        with open(data_path, "rb") as f, gzip.open(compressed_path, "wb") as g:
+            g.write(f.read())
+
+        outputs = []
+        for path in data_path, compressed_path:
+            output = os.path.join(self.tmp_dir, "blocks.json")
+            result = runner.invoke(cli.cli, ["block", path, schema_path, output])
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            with open(output) as f:
+                outputs.append(json.load(f)["blocks"])
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestInputEncoding(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(TESTDATA, "dirty_1000_50_1.csv"), encoding="ascii") as f:
+            text = f.read().replace("naomi", "naomï").replace("robson", "röbson")
+        self.paths = {}
+        for encoding in "utf-8", "latin-1":
+            path = os.path.join(self.tmp_dir, "pii-{}.csv".format(encoding))
+            with open(path, "w", encoding=encoding, newline="") as f:
+                f.write(text)
+            self.paths[encoding] = path
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_command(self, args, path, encoding, stdin=False):
+        output = os.path.join(self.tmp_dir, "output.json")
+        input_bytes = None
+        if stdin:
+            with open(path, "rb") as f:
+                input_bytes = f.read()
+            path = "-"
+        result = self.runner.invoke(
+            cli.cli,
+            [args[0], path] + args[1:] + [output, "--encoding", encoding],
+            input=input_bytes,
+        )
+        self.assertEqual(result.exit_code, 0, msg=result.output)
+        with open(output) as f:
+            return json.load(f)
+
+    def test_encode(self):
+        args = ["encode", "secret", SAMPLE_DATA_SCHEMA_PATH]
+        expected = self.run_command(args, self.paths["utf-8"], "utf-8")
+        for stdin in False, True:
+            self.assertEqual(
+                self.run_command(args, self.paths["latin-1"], "latin-1", stdin),
+                expected,
+            )
+
+    def test_block(self):
+        args = ["block", os.path.join(TESTDATA, "p-sig-schema.json")]
+        expected = self.run_command(args, self.paths["utf-8"], "utf-8")["blocks"]
+        for stdin in False, True:
+            blocks = self.run_command(args, self.paths["latin-1"], "latin-1", stdin)
+            self.assertEqual(blocks["blocks"], expected)
@@ -0,0 +1,128 @@
+"""Test encoding."""
+import io
+import json
+import unittest
+
+from clkhash.clk import generate_clk_from_csv
+from clkhash.schema import from_json_dict, from_json_file
+from clkhash.validate_data import EntryError, FormatError
+
+from anonlinkclient.encoding import (
+    CacheStats,
+    MultiHasher,
+    read_csv_chunks,
+    stream_clks_from_csv,
+    stream_multi_clks_from_csv,
+)
+from tests import *
+
+
+class TestStreamClks(unittest.TestCase):
+    def setUp(self):
+        with open(SAMPLE_DATA_SCHEMA_PATH) as f:
+            self.schema = from_json_file(f)
+        self.data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+
+    def test_same_as_clkhash(self):
+        with open(self.data_path) as f:
+            expected = generate_clk_from_csv(
+                f, "secret", self.schema, progress_bar=False, max_workers=1
+            )
+        for workers in 1, 2:
+            with open(self.data_path) as f:
+                clks = list(
+                    stream_clks_from_csv(
+                        f, "secret", self.schema, workers=workers, chunk_size=64
+                    )
+                )
+            self.assertEqual(clks, expected)
+
+    def test_cache_same_as_clkhash(self):
+        with open(self.data_path) as f:
+            expected = generate_clk_from_csv(
+                f, "secret", self.schema, progress_bar=False, max_workers=1
+            )
+        for workers in 1, 2:
+            stats = CacheStats([f.identifier for f in self.schema.fields])
+            with open(self.data_path) as f:
+                clks = list(
+                    stream_clks_from_csv(
+                        f,
+                        "secret",
+                        self.schema,
+                        workers=workers,
+                        chunk_size=64,
+                        cache_size=100,
+                        cache_stats=stats,
+                    )
+                )
+            self.assertEqual(clks, expected)
+            self.assertEqual(sum(stats.hits) + sum(stats.misses), 1000 * 14)
+            self.assertGreater(stats.hit_rate, 0)
+
+    def test_chunks(self):
+        with open(self.data_path) as f:
+            chunks = list(read_csv_chunks(f, self.schema, chunk_size=300))
+        self.assertEqual([len(c) for c in chunks], [300, 300, 300, 100])
+
+    def test_invalid_entry_reports_file_row(self):
+        with open(SIMPLE_SCHEMA_PATH) as f:
+            schema = from_json_file(f)
+        data = io.StringIO("Alice,1967/09/27\n" * 5 + "Bob,\n")
+        with self.assertRaises(EntryError) as e:
+            list(read_csv_chunks(data, schema, header=False, chunk_size=2))
+        self.assertIn("row 5", e.exception.args[0])
+        self.assertEqual(e.exception.row_index, 5)
+
+
+class TestMultiEncoding(unittest.TestCase):
+    def setUp(self):
+        with open(SAMPLE_DATA_SCHEMA_PATH) as f:
+            schema_dict = json.load(f)
+        self.schema = from_json_dict(schema_dict)
+        # Same features, except for the bigrams of the first name
+        schema_dict["clkConfig"]["l"] = 512
+        schema_dict["features"][1]["hashing"]["ngram"] = 3
+        self.other_schema = from_json_dict(schema_dict)
+        self.data_path = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+
+    def test_same_as_clkhash(self):
+        encodings = [
+            ("secret", self.schema),
+            ("other secret", self.schema),
+            ("secret", self.other_schema),
+        ]
+        expected = []
+        for secret, schema in encodings:
+            with open(self.data_path) as f:
+                expected.append(
+                    generate_clk_from_csv(
+                        f, secret, schema, progress_bar=False, max_workers=1
+                    )
+                )
+        for workers in 1, 2:
+            with open(self.data_path) as f:
+                rows = list(
+                    stream_multi_clks_from_csv(
+                        f, encodings, workers=workers, chunk_size=100
+                    )
+                )
+            self.assertEqual([list(clks) for clks in zip(*rows)], expected)
+
+    def test_shared_tokenization(self):
+        hasher = MultiHasher(
+            [([], self.schema), ([], self.schema), ([], self.other_schema)]
+        )
+        features = len(self.schema.fields)
+        self.assertEqual(hasher.shared_tokenizations, 3 * features - features - 1)
+
+    def test_validates_against_every_schema(self):
+        with open(SIMPLE_SCHEMA_PATH) as f:
+            simple_schema = from_json_file(f)
+        with open(self.data_path) as f:
+            with self.assertRaises(FormatError):
+                list(
+                    stream_multi_clks_from_csv(
+                        f, [("secret", self.schema), ("secret", simple_schema)]
+                    )
+                )
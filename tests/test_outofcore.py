@@ -0,0 +1,174 @@
+"""Test out-of-core candidate generation."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from anonlink.serialization import load_candidate_pairs
+from click.testing import CliRunner
+
+import anonlinkclient.cli as cli
+from anonlinkclient.candidates import find_candidate_pairs_parallel
+from anonlinkclient.outofcore import (
+    block_units,
+    dump_sorted_candidates,
+    find_candidate_pairs_out_of_core,
+    load_sorted_candidates,
+    map_clks,
+    tile_units,
+)
+from anonlinkclient.serialization import MappedClks, dump_clks_binary
+from anonlinkclient.utils import join_clks_blocks, solver_blocks
+from tests import *
+
+
+def novt_files():
+    return [
+        (
+            os.path.join(TESTDATA, "novt_clk_{}.json".format(i)),
+            os.path.join(TESTDATA, "novt_blocks_{}.json".format(i)),
+        )
+        for i in range(2)
+    ]
+
+
+class TestOutOfCore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        files = [(open(c), open(b)) for c, b in novt_files()]
+        try:
+            self.clk_groups, self.parties = join_clks_blocks(files, self.tmp_dir)
+        finally:
+            for clk_f, block_f in files:
+                clk_f.close()
+                block_f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_map_clks(self):
+        self.assertIsInstance(self.clk_groups[0], MappedClks)
+        with open(novt_files()[0][0]) as f:
+            clks = json.load(f)["clks"]
+        with open(novt_files()[0][0]) as f:
+            mapped = map_clks(f, self.tmp_dir, chunk_size=999)
+        self.assertEqual(len(mapped), len(clks))
+        self.assertEqual(list(mapped), list(self.clk_groups[0]))
+
+        path = os.path.join(self.tmp_dir, "clks.bin")
+        with open(path, "wb") as f:
+            dump_clks_binary(mapped, f)
+        with open(path) as f:
+            self.assertEqual(
+                map_clks(f, self.tmp_dir).array.tolist(), mapped.array.tolist()
+            )
+
+    def test_same_as_in_memory(self):
+        expected = find_candidate_pairs_parallel(
+            self.clk_groups, 0.8, solver_blocks(self.parties), workers=1
+        )
+        for workers, unit_comparisons in (1, 10**8), (2, 10**5):
+            result = find_candidate_pairs_out_of_core(
+                self.clk_groups,
+                0.8,
+                self.parties,
+                workers=workers,
+                tmp_dir=self.tmp_dir,
+                unit_comparisons=unit_comparisons,
+                spill_pairs=100,
+            )
+            self.assertEqual(result, expected)
+        # only the binary copies of the CLKs are left, the spills are removed
+        self.assertTrue(all(f.endswith(".bin") for f in os.listdir(self.tmp_dir)))
+
+    def test_top_k(self):
+        datasets = [clks[:1000] for clks in self.clk_groups]
+        expected = find_candidate_pairs_parallel(datasets, 0.5, workers=1, k=2)
+        result = find_candidate_pairs_out_of_core(
+            datasets, 0.5, workers=1, tile_size=300, spill_pairs=500, k=2
+        )
+        self.assertEqual(result, expected)
+
+    def test_spawned_workers(self):
+        expected = find_candidate_pairs_parallel(
+            self.clk_groups, 0.8, solver_blocks(self.parties), workers=1
+        )
+        with spawned_processes():
+            result = find_candidate_pairs_out_of_core(
+                self.clk_groups,
+                0.8,
+                self.parties,
+                workers=2,
+                tmp_dir=self.tmp_dir,
+                unit_comparisons=10**5,
+            )
+        self.assertEqual(result, expected)
+
+    def test_tiles_without_blocks(self):
+        datasets = [clks[:1000] for clks in self.clk_groups]
+        expected = find_candidate_pairs_parallel(datasets, 0.6, workers=1)
+        result = find_candidate_pairs_out_of_core(
+            datasets, 0.6, workers=1, tile_size=300, spill_pairs=5000
+        )
+        self.assertEqual(result, expected)
+        self.assertEqual(len(list(tile_units(datasets, 300))), 16)
+
+    def test_block_units(self):
+        units = list(block_units(self.parties, 10000))
+        comparisons = sum(
+            len(rows0) * len(rows1) for unit in units for _, _, rows0, rows1 in unit
+        )
+        with open(novt_files()[0][1]) as f0, open(novt_files()[1][1]) as f1:
+            blocks = [json.load(f)["blocks"] for f in (f0, f1)]
+        sizes = [{}, {}]
+        for party, party_blocks in enumerate(blocks):
+            for keys in party_blocks.values():
+                for key in keys:
+                    sizes[party][key] = sizes[party].get(key, 0) + 1
+        self.assertEqual(
+            comparisons,
+            sum(n * sizes[1].get(key, 0) for key, n in sizes[0].items()),
+        )
+        self.assertTrue(all(len(unit) for unit in units))
+
+    def test_dump_sorted_candidates(self):
+        datasets = [clks[:500] for clks in self.clk_groups]
+        candidates = find_candidate_pairs_parallel(datasets, 0.6, workers=1)
+        path = os.path.join(self.tmp_dir, "pairs")
+        with open(path, "wb") as f:
+            dump_sorted_candidates(candidates, f)
+        self.assertEqual(os.path.getsize(path), 4 + 24 * len(candidates[0]))
+        self.assertEqual(load_sorted_candidates(path), candidates)
+        with open(path, "rb") as f:
+            self.assertEqual(load_candidate_pairs(f), candidates)
+
+    def test_load_invalid(self):
+        path = os.path.join(self.tmp_dir, "pairs")
+        with open(path, "wb") as f:
+            f.write(bytes([1, 4, 4, 4]))
+        with self.assertRaises(ValueError):
+            load_sorted_candidates(path)
+
+    def test_find_similarity_out_of_core(self):
+        runner = CliRunner()
+        outputs = []
+        for extra in (
+            [],
+            ["--out-of-core", "--temp-dir", self.tmp_dir],
+            ["--out-of-core", "--workers", "2"],
+        ):
+            with temporary_file() as output:
+                args = ["find-similarity", "0.8", output]
+                for clk_path, block_path in novt_files():
+                    args += ["--files", clk_path, block_path]
+                with spawned_processes():
+                    result = runner.invoke(cli.cli, args + extra)
+                self.assertEqual(result.exit_code, 0, msg=result.output)
+                self.assertIn("Found 1309 matches", result.output)
+                with open(output) as f:
+                    outputs.append(
+                        {frozenset(map(tuple, group)) for group in json.load(f)}
+                    )
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
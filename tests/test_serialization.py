@@ -0,0 +1,175 @@
+"""Test serialization."""
+import base64
+import io
+import json
+import pickle
+import unittest
+
+from bitarray import bitarray
+from clkhash.serialization import serialize_bitarray
+
+from anonlinkclient.serialization import (
+    MappedClks,
+    deserialize_filters_bulk,
+    dump_clks,
+    dump_clks_binary,
+    is_binary_clk_file,
+    iter_json_clks,
+    load_json_clks,
+)
+from anonlinkclient.utils import deserialize_filters
+from tests import *
+
+
+class TestDumpClks(unittest.TestCase):
+    def test_same_as_json_dump(self):
+        clks = [bitarray("10100101" * 4), bitarray("11110000" * 4)]
+        for n in range(len(clks) + 1):
+            out = io.StringIO()
+            self.assertEqual(dump_clks(iter(clks[:n]), out), n)
+            expected = json.dumps({"clks": [serialize_bitarray(c) for c in clks[:n]]})
+            self.assertEqual(out.getvalue(), expected)
+
+    def test_nothing_written_on_early_error(self):
+        def failing():
+            raise ValueError("boom")
+            yield
+
+        out = io.StringIO()
+        with self.assertRaises(ValueError):
+            dump_clks(failing(), out)
+        self.assertEqual(out.getvalue(), "")
+
+
+class TestBinaryClks(unittest.TestCase):
+    def setUp(self):
+        self.clks = [bitarray("10100101" * 4), bitarray("11110000" * 4)]
+
+    def test_roundtrip(self):
+        with temporary_file() as fname:
+            with open(fname, "wb") as f:
+                self.assertEqual(dump_clks_binary(iter(self.clks), f), 2)
+            self.assertTrue(is_binary_clk_file(fname))
+            clks = MappedClks(fname)
+            self.assertEqual(len(clks), 2)
+            self.assertEqual(clks.bits, 32)
+            self.assertEqual(list(clks), self.clks)
+            self.assertEqual(clks[-1], self.clks[-1])
+            with self.assertRaises(IndexError):
+                clks[2]
+
+    def test_pickle(self):
+        with temporary_file() as fname:
+            with open(fname, "wb") as f:
+                dump_clks_binary(iter(self.clks), f)
+            clks = pickle.loads(pickle.dumps(MappedClks(fname)))
+            self.assertIsInstance(clks, MappedClks)
+            self.assertEqual(clks.path, fname)
+            self.assertEqual(list(clks), self.clks)
+            del clks
+
+    def test_smaller_than_json(self):
+        with temporary_file() as fname:
+            with open(fname, "wb") as f:
+                dump_clks_binary(iter(self.clks), f)
+            binary_size = os.path.getsize(fname)
+        out = io.StringIO()
+        dump_clks(iter(self.clks), out)
+        self.assertLess(binary_size, len(out.getvalue()))
+
+    def test_json_is_not_binary(self):
+        self.assertFalse(is_binary_clk_file(os.path.join(TESTDATA, "clks_a.json")))
+        self.assertFalse(is_binary_clk_file(io.StringIO()))
+
+    def test_inconsistent_length(self):
+        with self.assertRaises(ValueError):
+            dump_clks_binary(iter(self.clks + [bitarray(8)]), io.BytesIO())
+
+    def test_truncated_file(self):
+        with temporary_file() as fname:
+            with open(fname, "wb") as f:
+                dump_clks_binary(iter(self.clks), f)
+                f.truncate(f.tell() - 1)
+            with self.assertRaises(ValueError):
+                MappedClks(fname)
+
+
+class TestBulkDeserialization(unittest.TestCase):
+    def test_same_as_deserialize_filters(self):
+        with open(os.path.join(TESTDATA, "clks_a.json")) as f:
+            filters = json.load(f)["clks"]
+        clks = deserialize_filters_bulk(filters)
+        expected = deserialize_filters(filters)
+        self.assertEqual(list(clks), expected)
+        self.assertEqual(clks.popcounts().tolist(), [c.count() for c in expected])
+        self.assertEqual(clks.array.shape, (len(filters), 128))
+
+    def test_padding(self):
+        for length in range(1, 7):
+            clks = [bitarray("10110011" * length), bitarray("01000000" * length)]
+            filters = [serialize_bitarray(c) for c in clks]
+            self.assertEqual(list(deserialize_filters_bulk(filters)), clks)
+
+    def test_views_share_memory(self):
+        clks = deserialize_filters_bulk([serialize_bitarray(bitarray(16))])
+        clks.array[0, 0] = 0xFF
+        self.assertEqual(clks[0][:8], bitarray("11111111"))
+
+    def test_inconsistent_length(self):
+        filters = [serialize_bitarray(bitarray("1" * 1024))] * 2
+        for other in bitarray("1" * 1016), bitarray("1" * 1032):
+            with self.assertRaises(ValueError):
+                deserialize_filters_bulk(filters + [serialize_bitarray(other)])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            deserialize_filters_bulk(["AAA*"])
+
+    def test_wrapped(self):
+        clks = [bitarray("10110011" * 128), bitarray("01000001" * 128)]
+        filters = [serialize_bitarray(c) for c in clks]
+        wrapped = [base64.encodebytes(c.tobytes()).decode() for c in clks]
+        self.assertIn("\n", wrapped[0][:-1])
+        self.assertEqual(list(deserialize_filters_bulk(wrapped)), clks)
+        self.assertEqual(list(deserialize_filters_bulk([filters[0], wrapped[1]])), clks)
+        self.assertEqual(deserialize_filters(wrapped), clks)
+        document = json.dumps({"clks": wrapped})
+        self.assertEqual(list(load_json_clks(io.StringIO(document))), clks)
+
+    def test_empty(self):
+        self.assertEqual(len(deserialize_filters_bulk([])), 0)
+
+
+class TestIncrementalJsonClks(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TESTDATA, "clks_a.json")) as f:
+            self.filters = json.load(f)["clks"]
+
+    def test_iter_json_clks(self):
+        path = os.path.join(TESTDATA, "clks_a.json")
+        with open(path) as f:
+            self.assertEqual(list(iter_json_clks(f)), self.filters)
+        with open(path, "rb") as f:
+            self.assertEqual(list(iter_json_clks(f)), self.filters)
+        document = json.dumps({"version": 2, "clks": self.filters[:3], "meta": {}})
+        self.assertEqual(list(iter_json_clks(io.StringIO(document))), self.filters[:3])
+
+    def test_load_json_clks_in_chunks(self):
+        expected = deserialize_filters_bulk(self.filters)
+        for chunk_size in 1, 7, len(self.filters) + 1:
+            f = io.StringIO(json.dumps({"clks": self.filters}))
+            clks = load_json_clks(f, chunk_size=chunk_size)
+            self.assertEqual(clks.array.tolist(), expected.array.tolist())
+        self.assertEqual(len(load_json_clks(io.StringIO('{"clks": []}'))), 0)
+
+    def test_invalid(self):
+        longer = serialize_bitarray(bitarray("1" * 1032))
+        for document in [
+            "rec_id,name\n1,a",
+            '{"blocks": {}}',
+            '{"clks": [1]}',
+            '{"clks": ["AAAA"',
+            json.dumps({"clks": self.filters[:2] + [longer]}),
+        ]:
+            with self.assertRaises(ValueError):
+                load_json_clks(io.StringIO(document), chunk_size=2)
@@ -0,0 +1,141 @@
+"""Test tuning blocking parameters."""
+import io
+import json
+import os
+import unittest
+
+from click.testing import CliRunner
+
+import anonlinkclient.cli as cli
+from anonlinkclient.tuning import (
+    Sample,
+    evaluate_blocking_config,
+    evaluate_blocking_configs,
+    expand_grid,
+    recommend,
+    sample_rows,
+)
+from tests import *
+
+DATA_PATH = os.path.join(TESTDATA, "dirty_1000_50_1.csv")
+SCHEMA_PATH = os.path.join(TESTDATA, "dirty-data-blocking-schema.json")
+
+
+def load_schema():
+    with open(SCHEMA_PATH) as f:
+        return json.load(f)
+
+
+class TestTuning(unittest.TestCase):
+    def setUp(self):
+        with open(DATA_PATH) as f:
+            self.sample = sample_rows(f, 300, entity_id_column="rec_id")
+
+    def test_sample_rows(self):
+        self.assertEqual(len(self.sample.rows), 300)
+        self.assertEqual(self.sample.header[0], "rec_id")
+        self.assertEqual(self.sample.entity_ids, [row[0] for row in self.sample.rows])
+
+        # the same entities are sampled from every party
+        shuffled = io.StringIO()
+        with open(DATA_PATH) as f:
+            lines = f.readlines()
+        shuffled.write(lines[0] + "".join(reversed(lines[1:])))
+        shuffled.seek(0)
+        other = sample_rows(shuffled, 300, entity_id_column=0)
+        self.assertEqual(set(other.entity_ids), set(self.sample.entity_ids))
+
+        with open(DATA_PATH) as f:
+            uniform = sample_rows(f, 300, seed=1)
+        self.assertIsNone(uniform.entity_ids)
+        self.assertEqual(len(uniform.rows), 300)
+        with self.assertRaises(ValueError):
+            with open(DATA_PATH) as f:
+                sample_rows(f, 10, entity_id_column="unknown")
+
+    def test_expand_grid(self):
+        configs = expand_grid(
+            {"type": "p-sig", "config": {"filter": {"max": 1}}},
+            [("filter.max", [10, 20]), ("blocking-features", [[1], [1, 2]])],
+        )
+        self.assertEqual(len(configs), 4)
+        self.assertEqual(configs[1]["config"]["filter"]["max"], 10)
+        self.assertEqual(configs[1]["config"]["blocking-features"], [1, 2])
+        self.assertEqual(configs[3]["config"]["filter"]["max"], 20)
+
+    def test_evaluate_with_ground_truth(self):
+        samples = [self.sample, self.sample]
+        configs = expand_grid(load_schema(), [("K", [2, 8, 2000])])
+        results = evaluate_blocking_configs(configs, samples)
+        self.assertEqual(
+            results, evaluate_blocking_configs(configs, samples, workers=2)
+        )
+        self.assertIsNotNone(results[2].error)
+        # identical records always share their blocks
+        self.assertEqual([r.recall for r in results[:2]], [1.0, 1.0])
+        self.assertGreater(results[0].stats.comparisons, results[1].stats.comparisons)
+
+        best, meets_target = recommend(results, 0.95)
+        self.assertTrue(meets_target)
+        self.assertIs(best, results[1])
+
+    def test_recommend_without_ground_truth(self):
+        sample = Sample(self.sample.header, self.sample.rows, None)
+        configs = expand_grid(load_schema(), [("K", [2, 8])])
+        results = [evaluate_blocking_config(c, [sample, sample]) for c in configs]
+        self.assertIsNone(results[0].recall)
+        best, meets_target = recommend(results)
+        self.assertTrue(meets_target)
+        self.assertEqual(best.config["config"]["K"], 8)
+        self.assertEqual(recommend([]), (None, False))
+
+        unblocked = [
+            r._replace(stats=r.stats._replace(unblocked_counts=[1, 0])) for r in results
+        ]
+        best, meets_target = recommend(unblocked)
+        self.assertFalse(meets_target)
+        self.assertEqual(best.config["config"]["K"], 8)
+
+
+class TestTuneBlockingCommand(unittest.TestCase):
+    def test_tune_blocking(self):
+        runner = CliRunner()
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                [
+                    "tune-blocking",
+                    SCHEMA_PATH,
+                    DATA_PATH,
+                    DATA_PATH,
+                    output,
+                    "--grid",
+                    "K",
+                    "[2, 8]",
+                    "--grid",
+                    "Lambda",
+                    "[1, 2]",
+                    "--sample-size",
+                    "200",
+                    "--entity-id-column",
+                    "rec_id",
+                    "--workers",
+                    "1",
+                ],
+            )
+            self.assertEqual(result.exit_code, 0, msg=result.output)
+            self.assertEqual(len(result.output.splitlines()), 6)
+            with open(output) as f:
+                recommended = json.load(f)
+        self.assertEqual(recommended["config"]["K"], 8)
+        self.assertEqual(recommended["config"]["Lambda"], 1)
+
+    def test_invalid_grid(self):
+        runner = CliRunner()
+        with temporary_file() as output:
+            result = runner.invoke(
+                cli.cli,
+                ["tune-blocking", SCHEMA_PATH, DATA_PATH, output, "--grid", "K", "8"],
+            )
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("JSON list", result.output)
@@ -8,10 +8,14 @@ from click.testing import CliRunner
 from clkhash.serialization import serialize_bitarray
 
 import anonlinkclient.cli as cli
+from anonlinkclient.serialization import dump_clks_binary
 from anonlinkclient.utils import (
     combine_clks_blocks,
     deserialize_filters,
     generate_candidate_blocks_from_csv,
+    join_clks_blocks,
+    load_clks,
+    solver_blocks,
 )
 from tests import *
 
@@ -103,3 +107,65 @@ class TestUtils(unittest.TestCase):
         with open(fname_clks, "r") as f:
             clks = json.load(f)["clks"]
         assert [row[0] for row in clknblocks] == clks
+        with open(fname_blks, "r") as f:
+            blocks = json.load(f)["blocks"]
+        assert [row[1:] for row in clknblocks] == [
+            blocks.get(str(i), []) for i in range(len(clks))
+        ]
+
+    def test_join_clks_blocks(self):
+        """Test loading the CLKs and blocks of several parties for solve."""
+        files = [
+            (
+                open(os.path.join(TESTDATA, "novt_clk_{}.json".format(i))),
+                open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))),
+            )
+            for i in range(2)
+        ]
+        clk_groups, parties = join_clks_blocks(files)
+        for clk_f, block_f in files:
+            clk_f.close()
+            block_f.close()
+        assert [len(clks) for clks in clk_groups] == [5000, 5000]
+        with open(os.path.join(TESTDATA, "novt_clk_0.json")) as f:
+            assert list(clk_groups[0]) == deserialize_filters(json.load(f)["clks"])
+
+        rec_to_blocks = solver_blocks(parties)
+        # equal block keys get equal ids in all parties
+        key_of_id = {}
+        for i in range(2):
+            with open(os.path.join(TESTDATA, "novt_blocks_{}.json".format(i))) as f:
+                blocks = json.load(f)["blocks"]
+            assert len(rec_to_blocks[i]) == 5000
+            for rec_id, block_ids in rec_to_blocks[i].items():
+                keys = blocks.get(str(rec_id), [])
+                assert len(block_ids) == len(keys)
+                for block_id, key in zip(block_ids, keys):
+                    assert key_of_id.setdefault(block_id, key) == key
+        assert len(set(key_of_id.values())) == len(key_of_id)
+
+    def test_lambda_fold_binary_clks(self):
+        """Test lambda-fold blocking of a binary CLK file matches the JSON one."""
+        schema = json.load(open(os.path.join(TESTDATA, "lambda_fold_schema.json")))
+        schema["config"]["input-clks"] = True
+        clk_path = os.path.join(TESTDATA, "clks_a.json")
+        with open(clk_path) as f:
+            clks = load_clks(f)
+        _, fname = tempfile.mkstemp(suffix=".bin")
+        with open(fname, "wb") as f:
+            dump_clks_binary(clks, f)
+
+        expected = generate_candidate_blocks_from_csv(
+            open(clk_path), io.StringIO(json.dumps(schema))
+        )
+        result = generate_candidate_blocks_from_csv(
+            open(fname), io.StringIO(json.dumps(schema))
+        )
+        assert result["blocks"] == expected["blocks"]
+        assert result["meta"] == expected["meta"]
+
+        # binary CLKs are not a valid input for P-Sig
+        with self.assertRaises(TypeError):
+            generate_candidate_blocks_from_csv(
+                open(fname), open(os.path.join(TESTDATA, "p-sig-schema.json"))
+            )